@@ -0,0 +1,319 @@
+"""
+Methods for backfilling schedd history over a fixed range of dates.
+
+The range is split into time windows per schedd, the windows are
+processed concurrently by the worker pool and every finished window
+is recorded in a manifest so that an interrupted backfill can be resumed.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import traceback
+
+import classad
+import htcondor
+
+from . import elastic, utils, convert
+from .history import index_time
+
+# Settings for the indices created during a backfill for the days it
+# covers entirely, the refresh interval is restored when it ends.
+BACKFILL_INDEX_SETTINGS = {"refresh_interval": "-1"}
+
+DAY = 24 * 3600
+
+
+def parse_date(value):
+    """
+    Parse a UTC date given as YYYY-MM-DD, YYYY-MM-DDTHH:MM[:SS]
+    or as seconds since the epoch
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            date = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+    raise ValueError(f"Could not parse date {value!r}, expected YYYY-MM-DD[THH:MM[:SS]]")
+
+
+def make_windows(start, end, window_secs):
+    """
+    Split [start, end) in consecutive windows of at most window_secs
+    """
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window_secs, end)))
+        start += window_secs
+    return windows
+
+
+def window_key(window):
+    return "%d-%d" % window
+
+
+def format_window(window):
+    return " - ".join(
+        datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M") for t in window
+    )
+
+
+def load_manifest(filename):
+    try:
+        with open(filename, "r") as fd:
+            manifest = json.load(fd)
+    except IOError:
+        manifest = {}
+    manifest.setdefault("windows", {})
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as fd:
+        json.dump(manifest, fd, indent=4)
+    os.replace(tmpname, filename)
+
+
+def covered_days(start, end):
+    """
+    Return the (UTC) days entirely within [start, end) and already over,
+    as a range of timestamps. Other indices may be written by the feed.
+    """
+    return range(-(-start // DAY) * DAY, min(end, int(time.time())) // DAY * DAY, DAY)
+
+
+def restore_refresh_interval(days, args):
+    """Restore the refresh interval of the indices of the given days"""
+    indices = [
+        elastic.get_index(day, template=args.es_index_name, update_es=False) for day in days
+    ]
+    try:
+        elastic.get_server_handle(args).set_refresh_interval(indices)
+    except Exception:
+        logging.exception(
+            "Failed to restore the refresh interval of %d indices, "
+            "it is restored by the next backfill of the same range",
+            len(indices),
+        )
+
+
+def process_schedd_window(window, schedd_ad, args, metadata=None, days=range(0)):
+    """
+    Given a schedd and a time window, process the history of jobs
+    that entered their current status within the window.
+
+    Indices created for the given days (see covered_days) have their
+    refresh disabled.
+
+    Errors when querying or uploading are raised so that the window
+    is not marked as done in the manifest.
+    """
+    my_start = time.time()
+    metadata = metadata or {}
+    schedd = htcondor.Schedd(schedd_ad)
+    history_query = classad.ExprTree(
+        f"( EnteredCurrentStatus >= {window[0]:d} ) && ( EnteredCurrentStatus < {window[1]:d} )"
+    )
+    # History is returned newest first, stop scanning the history
+    # files once we are well past the start of the window
+    since = None
+    if args.backfill_scan_slack_hours >= 0:
+        since = classad.ExprTree(
+            f"EnteredCurrentStatus < {window[0] - args.backfill_scan_slack_hours * 3600:d}"
+        )
+    logging.info(
+        "Querying %s for history in window %s: %s",
+        schedd_ad["Name"],
+        format_window(window),
+        history_query,
+    )
+    update_es = args.es_feed_schedd_history and not args.read_only
+    buffered_ads = {}
+    count = 0
+    total_upload = 0
+    sent_warnings = False
+    poster = None
+    if update_es or (args.parquet_dir and not args.read_only):
+        # Not spooled, the manifest already resumes an interrupted backfill
+        poster = elastic.make_poster(
+            args,
+            metadata=metadata,
+            request_timeout=args.backfill_request_timeout,
+            spool=False,
+            feed=update_es,
+        )
+
+    if not args.dry_run:
+        history_iter = schedd.history(
+            history_query, [], args.process_max_documents or -1, since=since
+        )
+    else:
+        history_iter = []
+
+    for job_ad in history_iter:
+        try:
+            dict_ad = convert.to_json(job_ad, return_dict=True)
+        except Exception as e:
+            message = f"Failure when converting document on {schedd_ad['Name']} history: {e}"
+            exc = traceback.format_exc()
+            message += f"\n{exc}"
+            logging.warning(message)
+            if not sent_warnings:
+                utils.send_email_alert(
+                    args.email_alerts,
+                    "spider backfill document conversion error",
+                    message,
+                )
+                sent_warnings = True
+
+            continue
+
+        timestamp = index_time(args.es_index_date_attr, job_ad)
+        idx = elastic.get_index(
+            timestamp,
+            template=args.es_index_name,
+            update_es=update_es,
+            extra_settings=(
+                BACKFILL_INDEX_SETTINGS if int(timestamp) // DAY * DAY in days else None
+            ),
+        )
+        ad_list = buffered_ads.setdefault(idx, [])
+        ad_list.append((convert.unique_doc_id(dict_ad), dict_ad))
+
+        if len(ad_list) == args.backfill_bunch_size:
+            if poster:
+                poster.post(idx, ad_list)
+            buffered_ads[idx] = []
+
+        count += 1
+
+    # Post the remaining ads and wait for the uploads in flight
+    for idx, ad_list in list(buffered_ads.items()):
+        if ad_list and poster:
+            poster.post(idx, ad_list)
+    if poster:
+        poster.close()
+        total_upload = poster.upload_time
+
+    return {
+        "name": schedd_ad["Name"],
+        "window": window,
+        "count": count,
+        "query_time": max(0, time.time() - my_start - total_upload),
+        "upload_time": total_upload,
+    }
+
+
+def process_backfill(schedd_ads, start, end, pool, args, metadata=None):
+    """
+    Backfill the history of each schedd between start and end,
+    running the time windows of all schedds in the given pool
+    """
+    my_start = time.time()
+    metadata = metadata or {}
+    metadata["spider_source"] = "condor_history"
+
+    manifest = load_manifest(args.backfill_manifest)
+    windows = make_windows(start, end, args.backfill_window_hours * 3600)
+
+    # Interleave the schedds so that the windows of a single schedd
+    # are spread out over the run instead of hitting it all at once
+    todo = []
+    for window in reversed(windows):
+        for schedd_ad in schedd_ads:
+            done = manifest["windows"].get(schedd_ad["Name"], {})
+            if window_key(window) not in done:
+                todo.append((window, schedd_ad))
+    n_skipped = len(windows) * len(schedd_ads) - len(todo)
+    logging.warning(
+        "Backfilling %d schedds from %s in %d windows of %d hours, "
+        "%d windows already done according to %s",
+        len(schedd_ads),
+        format_window((start, end)),
+        len(windows),
+        args.backfill_window_hours,
+        n_skipped,
+        args.backfill_manifest,
+    )
+
+    progress = {"done": 0, "failed": 0, "docs": 0}
+
+    # Callbacks run in the result handler thread of the pool, one at a time
+    # (an exception there would stop the thread and hang the futures)
+    def _window_done(result):
+        try:
+            name, window = result["name"], tuple(result["window"])
+            manifest["windows"].setdefault(name, {})[window_key(window)] = result["count"]
+            if not args.read_only:
+                save_manifest(args.backfill_manifest, manifest)
+            progress["done"] += 1
+            progress["docs"] += result["count"]
+            logging.warning(
+                "Backfill %-25s window %s: %6d docs; query time %.2f min; "
+                "upload time %.2f min; %d/%d windows done",
+                name,
+                format_window(window),
+                result["count"],
+                result["query_time"] / 60.0,
+                result["upload_time"] / 60.0,
+                progress["done"],
+                len(todo),
+            )
+        except Exception:
+            progress["failed"] += 1
+            logging.exception(
+                "Failed to record backfill window %s of %s",
+                result.get("window"),
+                result.get("name"),
+            )
+
+    # Restored even for the indices of an earlier, interrupted run
+    days = covered_days(start, end)
+    futures = []
+    try:
+        for window, schedd_ad in todo:
+            future = pool.apply_async(
+                process_schedd_window,
+                (window, schedd_ad, args, metadata, days),
+                callback=_window_done,
+            )
+            futures.append((schedd_ad["Name"], window, future))
+
+        for name, window, future in futures:
+            try:
+                future.wait()
+                future.get()
+            except Exception as exn:
+                progress["failed"] += 1
+                message = (
+                    f"Backfill of {name} window {format_window(window)} failed "
+                    f"and will be retried on the next run: {str(exn)}"
+                )
+                logging.error(message)
+                utils.send_email_alert(
+                    args.email_alerts, "spider backfill window error", message
+                )
+    except BaseException:
+        # No more indices may be created once the refresh is restored
+        pool.terminate()
+        raise
+    finally:
+        if args.es_feed_schedd_history and not args.read_only and days:
+            restore_refresh_interval(days, args)
+
+    logging.warning(
+        "Processing time for backfill: %.2f mins, %d docs in %d windows, %d windows failed",
+        (time.time() - my_start) / 60.0,
+        progress["docs"],
+        progress["done"],
+        progress["failed"],
+    )
+    return progress["failed"] == 0
@@ -335,6 +335,29 @@ RUNNING_FIELDS = {
     "HasBeenTimingTuned",
 }
 
+# Job attributes read by to_json to compute the fields in RUNNING_FIELDS,
+# together with RUNNING_FIELDS it is the projection of a slim queue query
+RUNNING_INPUT_ATTRS = {
+    "CompletionDate",
+    "CpusProvisioned",
+    "CreamAttributes",
+    "GlideinEntryName",
+    "GpusProvisioned",
+    "JobStatus",
+    "JobUniverse",
+    "LastRemoteHost",
+    "MachineAttrDIRACBenchmark0",
+    "MATCH_EXP_JOBGLIDEIN_ResourceName",
+    "NordugridRSL",
+    "RemoteSysCpu",
+    "RemoteUserCpu",
+    "RemoteWallClockTime",
+    "RequestGpus",
+    "ResidentSetSize_RAW",
+    "x509UserProxyVOName",
+    "xcount",
+}
+
 STATUS = {
     0: "Unexpanded",
     1: "Idle",
@@ -391,9 +414,17 @@ NORDUGRID_RE = re.compile(r"\(count=(\d+)\)")
 WMCORE_EXE_EXMSG_RE = re.compile(r"^Chirp_WMCore_[A-Za-z0-9]+_Exception_Message$")
 
 
-def to_json(ad, return_dict=False, reduce_data=False):
+def to_json(ad, return_dict=False, reduce_data=False, keep_attrs=None):
+    """
+    Convert a job ClassAd to a document. With reduce_data, running,
+    idle and held jobs only keep RUNNING_FIELDS; keep_attrs restricts
+    the document of any job to the given fields. Attributes of the ad
+    that are not kept are not converted at all.
+    """
     if ad.get("TaskType") == "ROOT":
         return None
+    if keep_attrs is None and reduce_data and ad.get("JobStatus") in (1, 2, 5):
+        keep_attrs = RUNNING_FIELDS
     result = {}
 
     result["RecordTime"] = record_time(ad)
@@ -412,7 +443,7 @@ def to_json(ad, return_dict=False, reduce_data=False):
     if "GpusProvisioned" in ad:
         ad["GpusProvisioned"] = ad_pop(ad, "GpusProvisioned")
 
-    bulk_convert_ad_data(ad, result)
+    bulk_convert_ad_data(ad, result, keep_attrs)
 
     # Classify failed jobs
     result["JobFailed"] = job_failed(ad)
@@ -572,8 +603,8 @@ def to_json(ad, return_dict=False, reduce_data=False):
         result["CPUModelName"] = str(ad["MachineAttrCPUModel0"])
         result["Processor"] = str(ad["MachineAttrCPUModel0"])
 
-    if reduce_data:
-        result = drop_fields_for_running_jobs(result)
+    if keep_attrs is not None:
+        result = {key: result[key] for key in keep_attrs if key in result}
 
     if return_dict:
         return result
@@ -620,15 +651,13 @@ def common_exit_code(ad):
     return ad.get("JobExitCode", ad.get("ExitCode", 0))
 
 
-_CONVERT_COUNT = 0
-_CONVERT_CPU = 0
-
-
-def bulk_convert_ad_data(ad, result):
+def bulk_convert_ad_data(ad, result, keep_attrs=None):
     """
     Given a ClassAd, bulk convert to a python dictionary.
     """
     _keys = set(ad.keys()) - IGNORE_ATTRS
+    if keep_attrs is not None:
+        _keys &= set(keep_attrs)
     for key in _keys:
         try:
             value = ad.eval(key)
@@ -0,0 +1,165 @@
+"""
+Methods for skipping documents that were already sent.
+
+The queue query includes the jobs that completed during the last
+TIMEOUT_MINS, which the history pass of the same run has just sent.
+The history pass records the ids of those documents in a Bloom filter,
+which is handed to the queue workers to skip them before conversion.
+
+The history query of a schedd includes the jobs at its checkpoint
+(EnteredCurrentStatus >= last_completion), which the previous run
+already sent. The ids of those are kept from run to run in a rotating
+Bloom filter per schedd, stored next to the checkpoint.
+"""
+
+import os
+import math
+import json
+import base64
+import hashlib
+
+from . import convert
+
+
+class BloomFilter(object):
+    """
+    Set of strings with no false negatives and a false positive
+    rate of about error_rate once capacity items were added
+    """
+
+    def __init__(self, capacity, error_rate=1e-4):
+        capacity = max(capacity, 1)
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing of a single digest (Kirsch & Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class RotatingBloomFilter(object):
+    """
+    Pair of Bloom filters of capacity items each, when the current one
+    is full it replaces the previous one, so that the most recent
+    capacity to 2 * capacity items are remembered
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+
+    def add(self, item):
+        if len(self.current) >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        self.current.add(item)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self.current or (self.previous is not None and item in self.previous)
+
+    def to_dict(self):
+        return {
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "filters": [
+                {"count": bloom.count, "bits": base64.b64encode(bloom.bits).decode()}
+                for bloom in (self.current, self.previous) if bloom is not None
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rotating = cls(data["capacity"], data["error_rate"])
+        blooms = []
+        for saved in data["filters"]:
+            bloom = BloomFilter(rotating.capacity, rotating.error_rate)
+            bits = base64.b64decode(saved["bits"])
+            if len(bits) != len(bloom.bits):
+                raise ValueError("Bloom filter size does not match its capacity")
+            bloom.bits = bytearray(bits)
+            bloom.count = saved["count"]
+            blooms.append(bloom)
+        rotating.current = blooms[0]
+        rotating.previous = blooms[1] if len(blooms) > 1 else None
+        return rotating
+
+
+def recent_docs_file(directory, name):
+    return os.path.join(directory, name.replace(os.sep, "_") + ".json")
+
+
+def load_recent_docs(directory, name, capacity):
+    """
+    Return the filter of the documents recently sent for a daemon,
+    a new one if there is none or it was made with another capacity
+    """
+    try:
+        with open(recent_docs_file(directory, name), "r") as fd:
+            recent = RotatingBloomFilter.from_dict(json.load(fd))
+        if recent.capacity == capacity:
+            return recent
+    except (IOError, ValueError, KeyError, IndexError):
+        pass
+    return RotatingBloomFilter(capacity)
+
+
+def save_recent_docs(directory, name, recent):
+    os.makedirs(directory, exist_ok=True)
+    filename = recent_docs_file(directory, name)
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as fd:
+        json.dump(recent.to_dict(), fd)
+    os.replace(tmpname, filename)
+
+
+def ad_doc_id(ad):
+    """
+    Return the convert.unique_doc_id of the document of a job ad,
+    without converting it, or None if the ad has no GlobalJobId
+    """
+    try:
+        return "%s#%d" % (ad["GlobalJobId"], convert.record_time(ad))
+    except KeyError:
+        return None
+
+
+def ad_in(docs, ad):
+    """
+    Return whether the document of a job ad is in docs (a Bloom filter)
+    """
+    doc_id = ad_doc_id(ad)
+    return doc_id is not None and doc_id in docs
+
+
+def recent_since(starttime, timeout_mins):
+    """
+    Return the EnteredCurrentStatus from which completed jobs are
+    also part of the queue query (see queues.query_schedd_queue)
+    """
+    return int(starttime - (timeout_mins + 1) * 60)
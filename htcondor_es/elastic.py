@@ -1,17 +1,19 @@
 #!/usr/bin/python
 
+import os
 import re
+import sys
 import json
 import time
+import queue
 import datetime
 import logging
 import socket
+import threading
 import collections
-
-import elasticsearch
 import importlib.util
 
-from . import convert
+from . import convert, metrics
 
 
 def filter_name(keys):
@@ -23,7 +25,18 @@ def filter_name(keys):
         yield key
 
 
-def make_mappings():
+# Scaling factors of the float fields stored as scaled_float by the
+# optimized mapping profile, by suffix: 0.36 s for hours, 1 kB for MB
+SCALED_FLOAT_SUFFIXES = {"Hr": 10000, "MB": 1000}
+
+
+def make_mappings(profile="default"):
+    """
+    Return the mappings of the job indices. The optimized profile (see
+    utils.MAPPING_PROFILES) drops the doc values of the keywords that are
+    not indexed and stores the hours and MB as scaled floats.
+    """
+    optimized = profile == "optimized"
     props = {}
     for name in filter_name(convert.TEXT_ATTRS):
         props[name] = {"type": "text"}
@@ -31,8 +44,13 @@ def make_mappings():
         props[name] = {"type": "keyword"}
     for name in filter_name(convert.NOINDEX_KEYWORD_ATTRS):
         props[name] = {"type": "keyword", "index": "false"}
+        if optimized:
+            props[name]["doc_values"] = False
     for name in filter_name(convert.FLOAT_ATTRS):
         props[name] = {"type": "double"}
+        for suffix, factor in SCALED_FLOAT_SUFFIXES.items():
+            if optimized and name.endswith(suffix):
+                props[name] = {"type": "scaled_float", "scaling_factor": factor}
     for name in filter_name(convert.INT_ATTRS):
         props[name] = {"type": "long"}
     for name in filter_name(convert.DATE_ATTRS):
@@ -86,7 +104,37 @@ def make_mappings():
     return mappings
 
 
-def make_settings():
+def make_summary_mappings():
+    """
+    Return the mappings of the queue summary indices (see
+    queues.make_summary_docs), unknown strings are keywords
+    """
+    from .queues import SUMMARY_KEYS, SUMMARY_SUMS
+
+    props = {name: {"type": "keyword"} for name in SUMMARY_KEYS + ["ScheddName"]}
+    for name in SUMMARY_SUMS:
+        props[name] = {"type": "double"}
+    props["Jobs"] = {"type": "long"}
+    props["SnapshotDate"] = {"type": "date", "format": "epoch_second"}
+    props["metadata"] = {
+        "properties": {"spider_runtime": {"type": "date", "format": "epoch_millis"}}
+    }
+    dynamic_templates = [
+        {"strings_as_keywords": {
+            "match_mapping_type": "string",
+            "mapping": {"type": "keyword", "norms": "false", "ignore_above": 256},
+        }},
+    ]
+    return {"dynamic_templates": dynamic_templates, "properties": props}
+
+
+def make_settings(profile="default", shards=None, replicas=None, sort_field="RecordTime"):
+    """
+    Return the index settings. The optimized profile compresses the
+    stored fields harder and sorts the segments by sort_field, newest
+    first, which suits the write-once daily indices. shards and replicas
+    override the counts of the profile (of ES by default).
+    """
     settings = {
         "analysis": {
             "analyzer": {
@@ -95,14 +143,45 @@ def make_settings():
         },
         "mapping.total_fields.limit": 2000,
     }
+    if profile == "optimized":
+        settings.update({
+            "codec": "best_compression",
+            "sort.field": sort_field,
+            "sort.order": "desc",
+            "number_of_shards": 1,
+            "number_of_replicas": 1,
+        })
+    if shards is not None:
+        settings["number_of_shards"] = shards
+    if replicas is not None:
+        settings["number_of_replicas"] = replicas
     return settings
 
 
+def transport_errors():
+    """
+    Return the exception classes of failed ES requests, as a tuple for
+    except clauses, empty if elasticsearch was never imported (and so
+    no request was made)
+    """
+    es = sys.modules.get("elasticsearch")
+    if es is None:
+        return ()
+    return (es.exceptions.TransportError,)
+
+
 _ES_HANDLE = None
+_ES_HANDLE_PID = None  # Process that created _ES_HANDLE
+_ES_ARGS = None
 
 
 def get_server_handle(args=None):
-    global _ES_HANDLE
+    global _ES_HANDLE, _ES_HANDLE_PID, _ES_ARGS
+    # A handle inherited by a forked pool worker shares the open connections
+    # of its parent, requests from both would interleave on the same sockets
+    if _ES_HANDLE and _ES_HANDLE_PID != os.getpid():
+        _ES_HANDLE = None
+    args = args or _ES_ARGS
     if not _ES_HANDLE:
         if not args:
             logging.error(
@@ -110,14 +189,24 @@ def get_server_handle(args=None):
             )
             return _ES_HANDLE
         _ES_HANDLE = ElasticInterface(hostname=args.es_host, port=args.es_port,
-          username=args.es_username, password=args.es_password, use_https=args.es_use_https)
+          username=args.es_username, password=args.es_password, use_https=args.es_use_https,
+          mapping_profile=args.es_mapping_profile, shards=args.es_index_shards,
+          replicas=args.es_index_replicas)
+        _ES_HANDLE_PID = os.getpid()
+        _ES_ARGS = args
     return _ES_HANDLE
 
 
 class ElasticInterface(object):
     """Interface to elasticsearch"""
 
-    def __init__(self, hostname="localhost", port=9200, username=None, password=None, use_https=False):
+    def __init__(
+        self, hostname="localhost", port=9200, username=None, password=None, use_https=False,
+        mapping_profile="default", shards=None, replicas=None,
+    ):
+        # Only runs that send something pay for importing elasticsearch
+        import elasticsearch
+        import elasticsearch.client
 
         es_client = {
             'host': hostname,
@@ -141,8 +230,13 @@ class ElasticInterface(object):
                 es_client['verify_certs'] = True
 
         self.handle = elasticsearch.Elasticsearch([es_client])
+        self.mapping_profile = mapping_profile
+        self.shards = shards
+        self.replicas = replicas
 
     def fix_mapping(self, idx, template="htcondor"):
+        import elasticsearch.client
+
         idx_clt = elasticsearch.client.IndicesClient(self.handle)
         mappings = make_mappings()
         custom_mappings = {
@@ -160,11 +254,24 @@ class ElasticInterface(object):
             )
         )
 
-    def make_mapping(self, idx, template="htcondor"):
+    def make_mapping(self, idx, template="htcondor", extra_settings=None, kind="jobs"):
+        """
+        Create idx with our mappings and settings, those of the job
+        indices or of the queue summary indices (kind="summary"),
+        returns True if the index was created by this call
+        """
+        import elasticsearch.client
+
         idx_clt = elasticsearch.client.IndicesClient(self.handle)
-        mappings = make_mappings()
+        if kind == "summary":
+            mappings = make_summary_mappings()
+            sort_field = "SnapshotDate"
+        else:
+            mappings = make_mappings(self.mapping_profile)
+            sort_field = "RecordTime"
         # print(idx_clt.put_mapping(index=idx, body=json.dumps({"properties": mappings}), ignore=400))
-        settings = make_settings()
+        settings = make_settings(self.mapping_profile, self.shards, self.replicas, sort_field)
+        settings.update(extra_settings or {})
         # print(idx_clt.put_settings(index=idx, body=json.dumps(settings), ignore=400))
 
         body = json.dumps({"mappings": mappings, "settings": {"index": settings}})
@@ -177,33 +284,61 @@ class ElasticInterface(object):
         )
         if result.get("status") != 400:
             logging.warning(f"Creation of index {idx}: {str(result)}")
+            return True
         elif "already exists" not in result.get("error", "").get("reason", ""):
             logging.error(
                 f'Creation of index {idx} failed: {str(result.get("error", ""))}'
             )
+        return False
+
+    def set_refresh_interval(self, indices, interval=None):
+        """
+        Set the refresh interval of indices, None restores the ES default.
+        Missing indices are skipped.
+        """
+        indices = sorted(indices)
+        # Keep the request line short for long lists of indices
+        for i in range(0, len(indices), 100):
+            result = self.handle.indices.put_settings(
+                index=",".join(indices[i:i + 100]),
+                body=json.dumps({"index": {"refresh_interval": interval}}),
+                ignore_unavailable=True,
+                ignore=404,
+            )
+            logging.info(
+                f"Setting refresh_interval={interval} on {len(indices[i:i + 100])} indices: {str(result)}"
+            )
 
 
 _INDEX_CACHE = set()
 
 
-def get_index(timestamp, template="htcondor", update_es=True):
-    global _INDEX_CACHE
+def get_index(timestamp, template="htcondor", update_es=True, extra_settings=None):
     idx = time.strftime(
         "%s-%%Y-%%m-%%d" % template,
         datetime.datetime.utcfromtimestamp(timestamp).timetuple(),
     )
 
     if update_es:
-        if idx in _INDEX_CACHE:
-            return idx
-
-        _es_handle = get_server_handle()
-        _es_handle.make_mapping(idx, template=template)
-        _INDEX_CACHE.add(idx)
+        ensure_index(idx, template=template, extra_settings=extra_settings)
 
     return idx
 
 
+def ensure_index(idx, template="htcondor", extra_settings=None, kind="jobs"):
+    """
+    Create idx with our mappings (see ESInterface.make_mapping)
+    unless this process already did
+    """
+    global _INDEX_CACHE
+    if idx in _INDEX_CACHE:
+        return
+
+    _es_handle = get_server_handle()
+    _es_handle.make_mapping(idx, template=template, extra_settings=extra_settings, kind=kind)
+    _INDEX_CACHE.add(idx)
+
+
 def make_es_body(ads, metadata=None):
     metadata = metadata or {}
     body = ""
@@ -229,11 +364,56 @@ def parse_errors(result):
     return n_failed
 
 
-def post_ads(es, idx, ads, metadata=None):
+def record_bulk(daemon, res, elapsed, n_failed, n_bytes):
+    """Record the metrics of a bulk request"""
+    metrics.observe(daemon, "bulk_post", elapsed)
+    if "took" in res:
+        metrics.observe(daemon, "es_took", res["took"] / 1000.0)
+    metrics.incr(daemon, "bulk_requests")
+    metrics.incr(daemon, "bytes_sent", n_bytes)
+    metrics.incr(daemon, "docs_sent", len(res.get("items", [])) - (n_failed or 0))
+    if n_failed:
+        metrics.incr(daemon, "docs_failed", n_failed)
+        # Rejected by a full ES write queue, worth sending again
+        n_rejected = sum(
+            1 for d in res.get("items", []) if d.get("index", {}).get("status") == 429
+        )
+        if n_rejected:
+            metrics.incr(daemon, "docs_rejected", n_rejected)
+
+
+def post_ads(es, idx, ads, metadata=None, request_timeout=60, daemon=metrics.SHARED):
     body = make_es_body(ads, metadata)
-    res = es.bulk(body=body, index=idx, request_timeout=60)
-    if res.get("errors"):
-        return parse_errors(res)
+    return post_body(es, idx, body, request_timeout=request_timeout, daemon=daemon)
+
+
+def post_body(es, idx, body, request_timeout=60, daemon=metrics.SHARED):
+    """
+    Post a body already serialized by make_es_body
+    """
+    return bulk_body(es, idx, body, request_timeout=request_timeout, daemon=daemon)[1]
+
+
+def bulk_body(es, idx, body, request_timeout=60, daemon=metrics.SHARED):
+    """Like post_body, returns the response of ES and the number of failed documents"""
+    start = time.perf_counter()
+    res = es.bulk(body=body, index=idx, request_timeout=request_timeout)
+    n_failed = parse_errors(res) if res.get("errors") else None
+    record_bulk(daemon, res, time.perf_counter() - start, n_failed, len(body))
+    return res, n_failed
+
+
+def failed_items(body, res):
+    """
+    Return the (status, action and document lines) of the documents
+    of a bulk body made by make_es_body that ES failed to index
+    """
+    lines = body.splitlines(keepends=True)
+    return [
+        (item["index"].get("status"), lines[2 * i] + lines[2 * i + 1])
+        for i, item in enumerate(res.get("items", []))
+        if item.get("index", {}).get("error")
+    ]
 
 
 def post_ads_nohandle(idx, ads, args, metadata=None):
@@ -244,3 +424,177 @@ def post_ads_nohandle(idx, ads, args, metadata=None):
         return parse_errors(res)
 
     return len(ads)
+
+
+def make_routed_es_body(ads, metadata=None):
+    """
+    Like make_es_body, for (idx, id, ad) tuples, each action line
+    carrying the index of its document
+    """
+    metadata = metadata or {}
+    body = ""
+    for idx, id_, ad in ads:
+        if metadata:
+            ad.setdefault("metadata", {}).update(metadata)
+
+        body += json.dumps({"index": {"_index": idx, "_id": id_}}) + "\n"
+        body += json.dumps(ad) + "\n"
+
+    return body
+
+
+def post_routed_body(es, body, n_docs, request_timeout=60, daemon=metrics.SHARED):
+    """
+    Post a body made by make_routed_es_body, returns the number
+    of indexed documents and the time spent uploading
+    """
+    starttime = time.time()
+    res = es.bulk(body=body, request_timeout=request_timeout)
+    n_failed = parse_errors(res) if res.get("errors") else 0
+    record_bulk(daemon, res, time.time() - starttime, n_failed, len(body))
+    return n_docs - n_failed, time.time() - starttime
+
+
+class BulkPoster(object):
+    """
+    Posts bunches of ads to ES as they are handed over.
+
+    An error while posting is kept and raised again by close(),
+    so that callers can tell whether everything was uploaded.
+    """
+
+    # Whether the indices must be created before posting to them
+    # (not when the ads go to the spool, which creates them itself)
+    needs_index = True
+
+    def __init__(self, es, metadata=None, request_timeout=60, daemon=metrics.SHARED):
+        self.es = es
+        self.metadata = metadata
+        self.request_timeout = request_timeout
+        self.daemon = daemon
+        self.error = None
+        self.upload_time = 0
+        self.n_posted = 0
+        self.n_failed = 0
+
+    def _post(self, idx, ads):
+        start = time.perf_counter()
+        body = make_es_body(ads, self.metadata)
+        metrics.observe(self.daemon, "serialize", time.perf_counter() - start)
+        self._post_body(idx, body, len(ads))
+
+    def _post_body(self, idx, body, n_docs):
+        st = time.time()
+        n_failed = post_body(
+            self.es, idx, body, request_timeout=self.request_timeout, daemon=self.daemon
+        )
+        self.upload_time += time.time() - st
+        self.n_posted += n_docs
+        self.n_failed += n_failed or 0
+
+    def _submit(self, method, *args):
+        try:
+            method(*args)
+        except Exception as exn:
+            self.error = exn
+            raise
+
+    def post(self, idx, ads):
+        self._submit(self._post, idx, ads)
+
+    def post_body(self, idx, body, n_docs):
+        """Post n_docs already serialized by make_es_body"""
+        self._submit(self._post_body, idx, body, n_docs)
+
+    def close(self):
+        if self.error is not None:
+            raise self.error
+
+
+class PipelinedBulkPoster(BulkPoster):
+    """
+    Posts bunches of ads from a background thread, so that the caller
+    can keep querying and converting while a bulk request is in flight.
+
+    At most queue_depth bunches are waiting for upload, post() blocks
+    when the queue is full. An error in the uploader thread is raised
+    in the caller by the next post() or by close().
+    """
+
+    def __init__(self, es, metadata=None, request_timeout=60, queue_depth=4, daemon=metrics.SHARED):
+        super(PipelinedBulkPoster, self).__init__(
+            es, metadata=metadata, request_timeout=request_timeout, daemon=daemon
+        )
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            bunch = self.queue.get()
+            if bunch is None:  # Swallow poison pill
+                break
+            if self.error is not None:
+                # Keep draining the queue so that post() does not block
+                continue
+            method, args = bunch
+            try:
+                method(*args)
+            except Exception as exn:
+                logging.exception("Bulk upload failed in uploader thread")
+                self.error = exn
+
+    def _submit(self, method, *args):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put((method, args))
+        metrics.observe(self.daemon, "queue_wait", time.perf_counter() - start)
+
+    def close(self):
+        """Wait for the bunches in flight to be posted"""
+        self.queue.put(None)
+        self.thread.join()
+        super(PipelinedBulkPoster, self).close()
+
+
+def make_poster(
+    args, metadata=None, request_timeout=60, daemon=metrics.SHARED, spool=True, feed=True
+):
+    """
+    Return the BulkPoster selected by args (--es_spool_dir unless not
+    spool, --es_pipelined_upload), recording its metrics for the given daemon.
+    With --parquet_dir the ads are also written to Parquet files, or only
+    there if not feed.
+    """
+    poster = None
+    if feed:
+        poster = make_es_poster(args, metadata, request_timeout, daemon, spool)
+    if args.parquet_dir:
+        from .parquet import ParquetPoster, make_sink
+
+        return ParquetPoster(make_sink(args), poster, daemon=daemon)
+    return poster
+
+
+def make_es_poster(args, metadata, request_timeout, daemon, spool):
+    if spool and args.es_spool_dir:
+        from .spool import SpoolPoster
+
+        return SpoolPoster(
+            args.es_spool_dir,
+            metadata=metadata,
+            template=args.es_index_name,
+            segment_mb=args.es_spool_segment_mb,
+            daemon=daemon,
+        )
+    es = get_server_handle(args).handle
+    if args.es_pipelined_upload:
+        return PipelinedBulkPoster(
+            es,
+            metadata=metadata,
+            request_timeout=request_timeout,
+            queue_depth=args.es_upload_queue_depth,
+            daemon=daemon,
+        )
+    return BulkPoster(es, metadata=metadata, request_timeout=request_timeout, daemon=daemon)
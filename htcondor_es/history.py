@@ -6,14 +6,16 @@ import json
 import time
 import logging
 import datetime
+import threading
 import traceback
+import collections
 import multiprocessing
+import concurrent.futures
 
 import classad
 import htcondor
-import elasticsearch
 
-from . import elastic, utils, convert
+from . import dedup, elastic, metrics, utils, convert
 
 _LAUNCH_TIME = int(time.time())
 
@@ -41,14 +43,74 @@ def index_time(index_attr, ad):
     return _LAUNCH_TIME
 
 
+def daemon_time_remaining(start_time, budget_end=None):
+    """
+    Return the remaining time (in seconds) until either the global
+    deadline of the run or the end of the daemon's own budget
+    """
+    remaining = utils.time_remaining(start_time)
+    if budget_end is not None:
+        remaining = min(remaining, max(0, budget_end - time.time()))
+    return remaining
+
+
+def make_stats(count, total_time, query_time, upload_time, timed_out):
+    """
+    Return the statistics of processing a daemon (times in minutes)
+    """
+    return {
+        "count": count,
+        "total_time": total_time,
+        "query_time": query_time,
+        "upload_time": upload_time,
+        "timed_out": timed_out,
+    }
+
+
+def load_boundary_docs(name, args):
+    """
+    Return the filter of the documents at the checkpoint of a daemon
+    that previous runs sent, None if these are not kept
+    """
+    if not args.process_boundary_cache_size:
+        return None
+    return dedup.load_recent_docs(
+        args.process_boundary_cache_dir, name, args.process_boundary_cache_size
+    )
+
+
+def save_boundary_docs(name, boundary_docs, doc_ids, args):
+    """
+    Add the ids of the uploaded documents at the new checkpoint
+    of a daemon to its filter and save it
+    """
+    if boundary_docs is None or not doc_ids:
+        return
+    boundary_docs.update(doc_ids)
+    try:
+        dedup.save_recent_docs(args.process_boundary_cache_dir, name, boundary_docs)
+    except OSError as e:
+        logging.warning("Cannot save the documents at the checkpoint of %s: %s", name, e)
+
+
 def process_schedd(
-    start_time, last_completion, checkpoint_queue, schedd_ad, args, metadata=None
+    start_time, last_completion, schedd_ad, args, metadata=None,
+    budget=None,
 ):
     """
     Given a schedd, process its entire set of history since last checkpoint.
+
+    The schedd is given up on when the run is out of time or after
+    budget seconds, if given.
+
+    Returns the checkpoint updates as a list of (name, checkpoint, stats,
+    sent_ids), the checkpoint is None unless all jobs were processed and
+    uploaded, sent_ids are the ids of the uploaded documents of jobs that
+    the queue query of this run will return again (see dedup).
     """
     my_start = time.time()
-    if utils.time_remaining(start_time) < 0:
+    budget_end = my_start + budget if budget else None
+    if daemon_time_remaining(start_time, budget_end) <= 0:
         message = (
             "No time remaining to process %s history; exiting." % schedd_ad["Name"]
         )
@@ -56,7 +118,7 @@ def process_schedd(
         utils.send_email_alert(
             args.email_alerts, "spider history timeout warning", message
         )
-        return last_completion
+        return []
 
     metadata = metadata or {}
     schedd = htcondor.Schedd(schedd_ad)
@@ -67,22 +129,46 @@ def process_schedd(
         history_query,
         (time.time() - last_completion) / 60.0,
     )
+    recent_since = None
+    if args.process_dedup_capacity:
+        recent_since = dedup.recent_since(start_time, utils.TIMEOUT_MINS)
+    sent_ids = []
+    # Jobs at the checkpoint were already sent if the previous
+    # run saw them, skip those before converting them
+    checkpoint_time = last_completion
+    boundary_docs = load_boundary_docs(schedd_ad["Name"], args)
+    boundary_ids = []
+    n_skipped = 0
     buffered_ads = {}
     count = 0
     total_upload = 0
     sent_warnings = False
     timed_out = False
-    if not args.read_only and args.es_feed_schedd_history:
-        es = elastic.get_server_handle(args)
+    upload_failed = False
+    poster = None
+    if not args.read_only and (args.es_feed_schedd_history or args.parquet_dir):
+        poster = elastic.make_poster(
+            args, metadata=metadata, daemon=schedd_ad["Name"], feed=args.es_feed_schedd_history
+        )
     try:
         if not args.dry_run:
             history_iter = schedd.history(history_query, [], max(10000, args.process_max_documents))
         else:
             history_iter = []
 
-        for job_ad in history_iter:
+        for job_ad in metrics.timed_iter(history_iter, schedd_ad["Name"]):
+            if (
+                boundary_docs is not None
+                and job_ad.get("EnteredCurrentStatus") == checkpoint_time
+                and dedup.ad_in(boundary_docs, job_ad)
+            ):
+                n_skipped += 1
+                continue
+
             try:
+                start = time.perf_counter()
                 dict_ad = convert.to_json(job_ad, return_dict=True)
+                metrics.observe(schedd_ad["Name"], "convert", time.perf_counter() - start)
             except Exception as e:
                 message = f"Failure when converting document on {schedd_ad['Name']} history: {e}"
                 exc = traceback.format_exc()
@@ -101,15 +187,17 @@ def process_schedd(
             idx = elastic.get_index(
                 index_time(args.es_index_date_attr, job_ad),
                 template=args.es_index_name,
-                update_es=(args.es_feed_schedd_history and not args.read_only),
+                update_es=(poster is not None and poster.needs_index),
             )
             ad_list = buffered_ads.setdefault(idx, [])
             ad_list.append((convert.unique_doc_id(dict_ad), dict_ad))
+            if recent_since is not None and job_ad.get("EnteredCurrentStatus", 0) >= recent_since:
+                sent_ids.append(ad_list[-1][0])
 
             if len(ad_list) == args.es_bunch_size:
                 st = time.time()
-                if not args.read_only and args.es_feed_schedd_history:
-                    elastic.post_ads(es.handle, idx, ad_list, metadata=metadata)
+                if poster:
+                    poster.post(idx, ad_list)
                 logging.debug(
                     "...posting %d ads from %s (process_schedd)",
                     len(ad_list),
@@ -125,9 +213,12 @@ def process_schedd(
             job_completion = job_ad.get("EnteredCurrentStatus")
             if job_completion > last_completion:
                 last_completion = job_completion
+                boundary_ids = []
+            if job_completion == last_completion:
+                boundary_ids.append(ad_list[-1][0])
 
-            if utils.time_remaining(start_time) < 0:
-                message = f"History crawler on {schedd_ad['Name']} has been running for more than {utils.TIMEOUT_MINS:d} minutes; exiting."
+            if daemon_time_remaining(start_time, budget_end) <= 0:
+                message = f"History crawler on {schedd_ad['Name']} is out of time after running for {(time.time() - my_start) / 60:.1f} minutes; exiting."
                 logging.error(message)
                 utils.send_email_alert(
                     args.email_alerts, "spider history timeout warning", message
@@ -157,49 +248,81 @@ def process_schedd(
             args.email_alerts, "spider schedd history query error", message
         )
 
-    # Post the remaining ads
-    for idx, ad_list in list(buffered_ads.items()):
-        if ad_list:
-            logging.debug(
-                "...posting remaining %d ads from %s " "(process_schedd)",
-                len(ad_list),
-                schedd_ad["Name"],
-            )
-            if not args.read_only:
-                if args.es_feed_schedd_history:
-                    elastic.post_ads(es.handle, idx, ad_list, metadata=metadata)
+    # Post the remaining ads and wait for the uploads in flight
+    st = time.time()
+    try:
+        for idx, ad_list in list(buffered_ads.items()):
+            if ad_list:
+                logging.debug(
+                    "...posting remaining %d ads from %s " "(process_schedd)",
+                    len(ad_list),
+                    schedd_ad["Name"],
+                )
+                if poster:
+                    poster.post(idx, ad_list)
+        if poster:
+            poster.close()
+    except Exception as exn:
+        message = f"Failure when uploading schedd history of {schedd_ad['Name']}: {str(exn)}"
+        exc = traceback.format_exc()
+        message += f"\n{exc}"
+        logging.error(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider schedd history upload error", message
+        )
+        upload_failed = True
+    total_upload += time.time() - st
 
+    # With pipelined uploads, total_upload only counts the time spent
+    # waiting for the uploader, the upload itself ran in the background
     total_time = (time.time() - my_start) / 60.0
-    total_upload /= 60.0
+    query_time = total_time - total_upload / 60.0
+    total_upload = (poster.upload_time if poster else total_upload) / 60.0
     last_formatted = datetime.datetime.fromtimestamp(last_completion).strftime(
         "%Y-%m-%d %H:%M:%S"
     )
     logging.warning(
-        "Schedd %-25s history: response count: %5d; last completion %s; query time %.2f min; upload time %.2f min",
+        "Schedd %-25s history: response count: %5d; skipped at checkpoint: %d; last completion %s; query time %.2f min; upload time %.2f min",
         schedd_ad["Name"],
         count,
+        n_skipped,
         last_formatted,
-        total_time - total_upload,
+        query_time,
         total_upload,
     )
 
-    # If we got to this point without a timeout, all these jobs have
-    # been processed and uploaded, so we can update the checkpoint
-    if not timed_out:
-        checkpoint_queue.put((schedd_ad["Name"], last_completion))
-
-    return last_completion
+    # If we got to this point without a timeout or a failed upload, all
+    # these jobs have been processed and uploaded, so we can update the checkpoint
+    stats = make_stats(count, total_time, query_time, total_upload, timed_out)
+    if not poster or upload_failed:
+        sent_ids = []
+    else:
+        save_boundary_docs(schedd_ad["Name"], boundary_docs, boundary_ids, args)
+    if not args.es_feed_schedd_history:
+        # Only written to Parquet files, the queue documents still go to ES
+        sent_ids = []
+    if not (timed_out or upload_failed):
+        return [(schedd_ad["Name"], last_completion, stats, sent_ids)]
+    return [(schedd_ad["Name"], None, stats, sent_ids)]
 
 def process_startd(
-    start_time, since, checkpoint_queue, startd_ad, args, metadata=None
+    start_time, since, startd_ad, args, metadata=None,
+    budget=None,
 ):
     """
     Given a startd, process its entire set of history since last checkpoint.
+
+    The startd is given up on when the run is out of time or after
+    budget seconds, if given.
+
+    Returns the checkpoint updates as a list of (name, checkpoint, stats,
+    sent_ids) like process_schedd, sent_ids being always empty.
     """
     last_completion = since["EnteredCurrentStatus"]
     since_str = f"""(GlobalJobId == "{since['GlobalJobId']}") && (EnteredCurrentStatus == {since['EnteredCurrentStatus']})"""
     my_start = time.time()
-    if utils.time_remaining(start_time) < 0:
+    budget_end = my_start + budget if budget else None
+    if daemon_time_remaining(start_time, budget_end) <= 0:
         message = (
             "No time remaining to process %s history; exiting." % startd_ad["Machine"]
         )
@@ -207,7 +330,7 @@ def process_startd(
         utils.send_email_alert(
             args.email_alerts, "spider history timeout warning", message
         )
-        return since
+        return []
 
     metadata = metadata or {}
     startd = htcondor.Startd(startd_ad)
@@ -220,17 +343,23 @@ def process_startd(
     total_upload = 0
     sent_warnings = False
     timed_out = False
-    if not args.read_only and args.es_feed_startd_history:
-        es = elastic.get_server_handle(args)
+    upload_failed = False
+    poster = None
+    if not args.read_only and (args.es_feed_startd_history or args.parquet_dir):
+        poster = elastic.make_poster(
+            args, metadata=metadata, daemon=startd_ad["Machine"], feed=args.es_feed_startd_history
+        )
     try:
         if not args.dry_run:
             history_iter = startd.history("True", [], since=since_str)
         else:
             history_iter = []
 
-        for job_ad in history_iter:
+        for job_ad in metrics.timed_iter(history_iter, startd_ad["Machine"]):
             try:
+                start = time.perf_counter()
                 dict_ad = convert.to_json(job_ad, return_dict=True)
+                metrics.observe(startd_ad["Machine"], "convert", time.perf_counter() - start)
             except Exception as e:
                 message = f"Failure when converting document on {startd_ad['Machine']} history: {e}"
                 exc = traceback.format_exc()
@@ -249,15 +378,15 @@ def process_startd(
             idx = elastic.get_index(
                 index_time(args.es_index_date_attr, job_ad),
                 template=args.es_index_name,
-                update_es=(args.es_feed_startd_history and not args.read_only),
+                update_es=(poster is not None and poster.needs_index),
             )
             ad_list = buffered_ads.setdefault(idx, [])
             ad_list.append((convert.unique_doc_id(dict_ad), dict_ad))
 
             if len(ad_list) == args.es_bunch_size:
                 st = time.time()
-                if not args.read_only and args.es_feed_startd_history:
-                    elastic.post_ads(es.handle, idx, ad_list, metadata=metadata)
+                if poster:
+                    poster.post(idx, ad_list)
                 logging.debug(
                     "...posting %d ads from %s (process_startd)",
                     len(ad_list),
@@ -276,8 +405,8 @@ def process_startd(
                     "EnteredCurrentStatus": job_ad.get("EnteredCurrentStatus"),
                 }
 
-            if utils.time_remaining(start_time) < 0:
-                message = f"History crawler on {startd_ad['Machine']} has been running for more than {utils.TIMEOUT_MINS:d} minutes; exiting."
+            if daemon_time_remaining(start_time, budget_end) <= 0:
+                message = f"History crawler on {startd_ad['Machine']} is out of time after running for {(time.time() - my_start) / 60:.1f} minutes; exiting."
                 logging.error(message)
                 utils.send_email_alert(
                     args.email_alerts, "spider history timeout warning", message
@@ -307,20 +436,36 @@ def process_startd(
             args.email_alerts, "spider startd history query error", message
         )
 
-    # Post the remaining ads
-    for idx, ad_list in list(buffered_ads.items()):
-        if ad_list:
-            logging.debug(
-                "...posting remaining %d ads from %s " "(process_startd)",
-                len(ad_list),
-                startd_ad["Machine"],
-            )
-            if not args.read_only:
-                if args.es_feed_startd_history:
-                    elastic.post_ads(es.handle, idx, ad_list, metadata=metadata)
+    # Post the remaining ads and wait for the uploads in flight
+    st = time.time()
+    try:
+        for idx, ad_list in list(buffered_ads.items()):
+            if ad_list:
+                logging.debug(
+                    "...posting remaining %d ads from %s " "(process_startd)",
+                    len(ad_list),
+                    startd_ad["Machine"],
+                )
+                if poster:
+                    poster.post(idx, ad_list)
+        if poster:
+            poster.close()
+    except Exception as exn:
+        message = f"Failure when uploading startd history of {startd_ad['Machine']}: {str(exn)}"
+        exc = traceback.format_exc()
+        message += f"\n{exc}"
+        logging.error(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider startd history upload error", message
+        )
+        upload_failed = True
+    total_upload += time.time() - st
 
+    # With pipelined uploads, total_upload only counts the time spent
+    # waiting for the uploader, the upload itself ran in the background
     total_time = (time.time() - my_start) / 60.0
-    total_upload /= 60.0
+    query_time = total_time - total_upload / 60.0
+    total_upload = (poster.upload_time if poster else total_upload) / 60.0
     last_formatted = datetime.datetime.fromtimestamp(last_completion).strftime(
         "%Y-%m-%d %H:%M:%S"
     )
@@ -329,16 +474,524 @@ def process_startd(
         startd_ad["Machine"],
         count,
         last_formatted,
-        total_time - total_upload,
+        query_time,
+        total_upload,
+    )
+
+    # If we got to this point without a timeout or a failed upload, all
+    # these jobs have been processed and uploaded, so we can update the checkpoint
+    stats = make_stats(count, total_time, query_time, total_upload, timed_out)
+    if not (timed_out or upload_failed):
+        return [(startd_ad["Machine"], since, stats, [])]
+    return [(startd_ad["Machine"], None, stats, [])]
+
+
+def query_startd(startd_ad, since, args, start_time, started=None):
+    """
+    Return the job ads in the history of a startd since last checkpoint,
+    whether the query ran out of time, and the query time (in seconds).
+    Runs in a thread of process_startd_shard, which gives up on it once
+    args.process_startd_host_timeout passed since its start in started.
+    """
+    my_start = time.time()
+    if started is not None:
+        started[startd_ad["Machine"]] = my_start
+    host_end = my_start + args.process_startd_host_timeout
+    since_str = f"""(GlobalJobId == "{since['GlobalJobId']}") && (EnteredCurrentStatus == {since['EnteredCurrentStatus']})"""
+    job_ads = []
+    if args.dry_run:
+        return job_ads, False, 0
+    startd = htcondor.Startd(startd_ad)
+    for job_ad in metrics.timed_iter(startd.history("True", [], since=since_str), startd_ad["Machine"]):
+        job_ads.append(job_ad)
+        if daemon_time_remaining(start_time, host_end) <= 0:
+            return job_ads, True, time.time() - my_start
+        if args.process_max_documents and len(job_ads) > args.process_max_documents:
+            break
+    return job_ads, False, time.time() - my_start
+
+
+def process_startd_shard(
+    start_time, sinces, startd_ads, args, metadata=None
+):
+    """
+    Given a set of startds, query their history since last checkpoint
+    from a pool of threads, and upload the ads of all startds together
+    in shared bunches.
+
+    The checkpoints of the startds are only updated once all bunches
+    are uploaded; startds that timed out keep their old checkpoint.
+    """
+    my_start = time.time()
+    metadata = metadata or {}
+    buffered_ads = {}
+    done = []
+    count = 0
+    total_upload = 0
+    sent_warnings = False
+    upload_failed = False
+    poster = None
+    if not args.read_only and (args.es_feed_startd_history or args.parquet_dir):
+        poster = elastic.make_poster(args, metadata=metadata, feed=args.es_feed_startd_history)
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.process_startd_threads
+    )
+    started = {}  # machine: start of its query
+    futures = {
+        executor.submit(
+            query_startd, startd_ad, sinces[startd_ad["Machine"]], args, start_time, started
+        ): startd_ad
+        for startd_ad in startd_ads
+    }
+
+    def _completed():
+        """
+        Yield the queries as they finish, giving up on the startds that
+        hang (before their first ad or between two) past their deadline
+        """
+        pending = set(futures)
+        while pending:
+            remaining = utils.time_remaining(start_time)
+            if remaining <= 0:
+                raise concurrent.futures.TimeoutError()
+            finished, pending = concurrent.futures.wait(
+                pending,
+                timeout=min(remaining, 1.0),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            yield from finished
+            now = time.time()
+            for future in list(pending):
+                machine = futures[future]["Machine"]
+                query_time = now - started.get(machine, now)
+                if query_time < args.process_startd_host_timeout:
+                    continue
+                pending.discard(future)
+                logging.error(
+                    f"History crawler on {machine} did not answer within {query_time:.1f} s; "
+                    "ignoring progress."
+                )
+                stats = make_stats(0, query_time / 60.0, query_time / 60.0, 0, True)
+                done.append((machine, None, stats))
+
+    try:
+        for future in _completed():
+            machine = futures[future]["Machine"]
+            since = sinces[machine]
+            try:
+                job_ads, timed_out, query_time = future.result()
+            except Exception as exn:
+                logging.error(
+                    f"Failed to query startd for job history: {machine}: {str(exn)}"
+                )
+                continue
+            if timed_out:
+                logging.error(
+                    f"History crawler on {machine} ran out of time after {query_time:.1f} s; "
+                    "ignoring progress."
+                )
+                stats = make_stats(len(job_ads), query_time / 60.0, query_time / 60.0, 0, True)
+                done.append((machine, None, stats))
+                continue
+
+            last_completion = since["EnteredCurrentStatus"]
+            for job_ad in job_ads:
+                try:
+                    start = time.perf_counter()
+                    dict_ad = convert.to_json(job_ad, return_dict=True)
+                    metrics.observe(machine, "convert", time.perf_counter() - start)
+                except Exception as e:
+                    message = f"Failure when converting document on {machine} history: {e}"
+                    exc = traceback.format_exc()
+                    message += f"\n{exc}"
+                    logging.warning(message)
+                    if not sent_warnings:
+                        utils.send_email_alert(
+                            args.email_alerts,
+                            "spider history document conversion error",
+                            message,
+                        )
+                        sent_warnings = True
+                    continue
+
+                idx = elastic.get_index(
+                    index_time(args.es_index_date_attr, job_ad),
+                    template=args.es_index_name,
+                    update_es=(poster is not None and poster.needs_index),
+                )
+                ad_list = buffered_ads.setdefault(idx, [])
+                ad_list.append((convert.unique_doc_id(dict_ad), dict_ad))
+
+                if len(ad_list) == args.es_bunch_size:
+                    st = time.time()
+                    if poster:
+                        poster.post(idx, ad_list)
+                    total_upload += time.time() - st
+                    buffered_ads[idx] = []
+
+                count += 1
+
+                job_completion = job_ad.get("EnteredCurrentStatus")
+                if job_completion > last_completion:
+                    last_completion = job_completion
+                    since = {
+                        "GlobalJobId": job_ad.get("GlobalJobId"),
+                        "EnteredCurrentStatus": job_ad.get("EnteredCurrentStatus"),
+                    }
+
+            stats = make_stats(len(job_ads), query_time / 60.0, query_time / 60.0, 0, False)
+            done.append((machine, since, stats))
+
+    except concurrent.futures.TimeoutError:
+        message = (
+            f"Startd history crawler has been running for more than {utils.TIMEOUT_MINS:d} minutes; "
+            f"{len(futures) - len(done)} startds did not finish."
+        )
+        logging.error(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider history timeout warning", message
+        )
+    finally:
+        # Do not wait for startds that did not respond in time
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    # Post the remaining ads and wait for the uploads in flight
+    st = time.time()
+    try:
+        for idx, ad_list in list(buffered_ads.items()):
+            if ad_list and poster:
+                poster.post(idx, ad_list)
+        if poster:
+            poster.close()
+    except Exception as exn:
+        message = f"Failure when uploading startd history: {str(exn)}"
+        exc = traceback.format_exc()
+        message += f"\n{exc}"
+        logging.error(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider startd history upload error", message
+        )
+        upload_failed = True
+    total_upload += time.time() - st
+
+    total_time = (time.time() - my_start) / 60.0
+    logging.warning(
+        "Startds %5d/%5d history: response count: %5d; total time %.2f min; upload time %.2f min",
+        len(done),
+        len(startd_ads),
+        count,
+        total_time,
+        (poster.upload_time if poster else total_upload) / 60.0,
+    )
+
+    return [
+        (machine, None if upload_failed else since, stats, [])
+        for machine, since, stats in done
+    ]
+
+
+def convert_chunk(
+    chunk, args, metadata=None, daemon=metrics.SHARED, queue=False, recent_since=None
+):
+    """
+    Convert a chunk of raw job ads (old ClassAd format text, separated
+    by blank lines) and return the documents serialized for the bulk API,
+    in bunches of at most args.es_bunch_size documents per index.
+
+    Jobs from a schedd queue (queue=True, see replay) are converted as
+    the queue pass does, keeping the fields of args.es_queue_profile.
+    With --parquet_dir, the documents of history jobs are also returned
+    as tables (in "tables"), for the caller to write to its Parquet files.
+    The ids of the documents of jobs that entered their status since
+    recent_since (see dedup.recent_since) are returned in "recent_ids".
+    """
+    keep_attrs = None
+    if queue:
+        from . import queues
+
+        _, keep_attrs = queues.queue_profile(args)
+    sink = None
+    if args.parquet_dir and not args.read_only and not queue:
+        from . import parquet
+
+        sink = parquet.make_sink(args)
+    buffered_ads = {}
+    bunches = []
+    tables = []
+    recent_ids = []
+    count = 0
+    n_failed = 0
+    for job_ad in classad.parseAds(chunk, classad.Parser.Old):
+        try:
+            start = time.perf_counter()
+            if queue:
+                keep = queues.job_keep_attrs(job_ad, keep_attrs, args)
+                dict_ad = convert.to_json(job_ad, return_dict=True, keep_attrs=keep)
+            else:
+                dict_ad = convert.to_json(job_ad, return_dict=True)
+            doc_id = convert.unique_doc_id(dict_ad) if dict_ad else None
+            metrics.observe(daemon, "convert", time.perf_counter() - start)
+        except Exception as e:
+            if n_failed == 0:
+                logging.warning(
+                    f"Failure when converting document from a history chunk: {e}\n"
+                    f"{traceback.format_exc()}"
+                )
+            n_failed += 1
+            continue
+        if not dict_ad:
+            continue
+
+        if queue:
+            timestamp = dict_ad.get(args.es_index_date_attr) or int(time.time())
+        else:
+            timestamp = index_time(args.es_index_date_attr, job_ad)
+        idx = elastic.get_index(timestamp, template=args.es_index_name, update_es=False)
+        ad_list = buffered_ads.setdefault(idx, [])
+        ad_list.append((doc_id, dict_ad))
+        if recent_since is not None and job_ad.get("EnteredCurrentStatus", 0) >= recent_since:
+            recent_ids.append(doc_id)
+        count += 1
+        if len(ad_list) == args.es_bunch_size:
+            if sink:
+                start = time.perf_counter()
+                tables.append((idx, sink.make_table(ad_list)))
+                metrics.observe(daemon, "parquet", time.perf_counter() - start)
+            start = time.perf_counter()
+            bunches.append((idx, len(ad_list), elastic.make_es_body(ad_list, metadata)))
+            metrics.observe(daemon, "serialize", time.perf_counter() - start)
+            buffered_ads[idx] = []
+
+    for idx, ad_list in buffered_ads.items():
+        if ad_list:
+            if sink:
+                start = time.perf_counter()
+                tables.append((idx, sink.make_table(ad_list)))
+                metrics.observe(daemon, "parquet", time.perf_counter() - start)
+            start = time.perf_counter()
+            bunches.append((idx, len(ad_list), elastic.make_es_body(ad_list, metadata)))
+            metrics.observe(daemon, "serialize", time.perf_counter() - start)
+
+    return {
+        "bunches": bunches,
+        "tables": tables,
+        "recent_ids": recent_ids,
+        "count": count,
+        "n_failed": n_failed,
+    }
+
+
+def process_schedd_fanout(
+    start_time, last_completion, schedd_ad, pool, args, metadata=None,
+    budget=None,
+):
+    """
+    Given a (large) schedd, process its entire set of history since last
+    checkpoint, reading the history here and fanning the conversion out
+    to the worker pool in chunks of raw ads.
+
+    Chunks are uploaded in the order they were read, and the checkpoint
+    is only updated once every chunk was converted and uploaded.
+    """
+    my_start = time.time()
+    budget_end = my_start + budget if budget else None
+    if daemon_time_remaining(start_time, budget_end) <= 0:
+        message = (
+            "No time remaining to process %s history; exiting." % schedd_ad["Name"]
+        )
+        logging.error(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider history timeout warning", message
+        )
+        return []
+
+    metadata = metadata or {}
+    schedd = htcondor.Schedd(schedd_ad)
+    history_query = classad.ExprTree(f"( EnteredCurrentStatus >= {int(last_completion)} )")
+    logging.info(
+        "Querying %s for history (fan-out): %s.  " "%.1f minutes of ads",
+        schedd_ad["Name"],
+        history_query,
+        (time.time() - last_completion) / 60.0,
+    )
+    poster = None
+    if not args.read_only and (args.es_feed_schedd_history or args.parquet_dir):
+        # The workers only build the Parquet tables (see convert_chunk),
+        # they are written here, in the files of this schedd
+        poster = elastic.make_poster(
+            args, daemon=schedd_ad["Name"], feed=args.es_feed_schedd_history
+        )
+    recent_since = None
+    if args.process_dedup_capacity:
+        recent_since = dedup.recent_since(start_time, utils.TIMEOUT_MINS)
+    sent_ids = []
+    checkpoint_time = last_completion
+    boundary_docs = load_boundary_docs(schedd_ad["Name"], args)
+    boundary_ids = []
+    n_skipped = 0
+    max_in_flight = max(1, args.process_fanout_max_chunks)
+    in_flight = collections.deque()
+    chunk = []
+    count = 0
+    n_read = 0
+    n_failed = 0
+    total_upload = 0
+    timed_out = False
+    failed = False
+
+    def _submit_chunk():
+        future = pool.apply_async(
+            metrics.run_instrumented,
+            (
+                schedd_ad["Name"],
+                convert_chunk,
+                "\n".join(chunk),
+                args,
+                metadata,
+                schedd_ad["Name"],
+                False,
+                recent_since,
+            ),
+        )
+        in_flight.append(future)
+
+    def _finish_chunk():
+        nonlocal count, n_failed, total_upload
+        future = in_flight.popleft()
+        result, recorded = future.get(daemon_time_remaining(start_time, budget_end) + 10)
+        metrics.merge(recorded)
+        count += result["count"]
+        n_failed += result["n_failed"]
+        sent_ids.extend(result["recent_ids"])
+        st = time.time()
+        for idx, n_docs, body in result["bunches"]:
+            if poster:
+                if poster.needs_index:
+                    elastic.ensure_index(idx, template=args.es_index_name)
+                poster.post_body(idx, body, n_docs)
+        for idx, table in result["tables"]:
+            if poster:
+                poster.post_table(idx, table)
+        total_upload += time.time() - st
+
+    try:
+        if not args.dry_run:
+            history_iter = schedd.history(history_query, [], max(10000, args.process_max_documents))
+        else:
+            history_iter = []
+
+        for job_ad in metrics.timed_iter(history_iter, schedd_ad["Name"]):
+            job_completion = job_ad.get("EnteredCurrentStatus")
+            if (
+                boundary_docs is not None
+                and job_completion == checkpoint_time
+                and dedup.ad_in(boundary_docs, job_ad)
+            ):
+                n_skipped += 1
+                continue
+
+            chunk.append(job_ad.printOld())
+            n_read += 1
+
+            if job_completion > last_completion:
+                last_completion = job_completion
+                boundary_ids = []
+            if boundary_docs is not None and job_completion == last_completion:
+                doc_id = dedup.ad_doc_id(job_ad)
+                if doc_id is not None:
+                    boundary_ids.append(doc_id)
+
+            if len(chunk) == args.process_fanout_chunk_size:
+                _submit_chunk()
+                chunk = []
+                while len(in_flight) >= max_in_flight:
+                    _finish_chunk()
+
+            if daemon_time_remaining(start_time, budget_end) <= 0:
+                message = f"History crawler on {schedd_ad['Name']} is out of time after running for {(time.time() - my_start) / 60:.1f} minutes; exiting."
+                logging.error(message)
+                utils.send_email_alert(
+                    args.email_alerts, "spider history timeout warning", message
+                )
+                timed_out = True
+                break
+
+            if args.process_max_documents and n_read > args.process_max_documents:
+                logging.warning(
+                    "Aborting after %d documents (--process_max_documents option)"
+                    % args.process_max_documents
+                )
+                break
+
+        if chunk and not timed_out:
+            _submit_chunk()
+            chunk = []
+        while in_flight and not timed_out:
+            _finish_chunk()
+        if poster:
+            st = time.time()
+            poster.close()
+            total_upload += time.time() - st
+
+    except RuntimeError:
+        message = "Failed to query schedd for job history: %s" % schedd_ad["Name"]
+        exc = traceback.format_exc()
+        message += f"\n{exc}"
+        logging.error(message)
+        failed = True
+
+    except Exception as exn:
+        message = f"Failure when processing schedd history (fan-out) on {schedd_ad['Name']}: {str(exn)}"
+        exc = traceback.format_exc()
+        message += f"\n{exc}"
+        logging.exception(message)
+        utils.send_email_alert(
+            args.email_alerts, "spider schedd history query error", message
+        )
+        failed = True
+
+    if n_failed:
+        logging.warning(
+            "Failed to convert %d documents from %s history", n_failed, schedd_ad["Name"]
+        )
+
+    total_time = (time.time() - my_start) / 60.0
+    query_time = total_time - total_upload / 60.0
+    total_upload = (poster.upload_time if poster else total_upload) / 60.0
+    last_formatted = datetime.datetime.fromtimestamp(last_completion).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    logging.warning(
+        "Schedd %-25s history: response count: %5d; skipped at checkpoint: %d; last completion %s; query time %.2f min; upload time %.2f min",
+        schedd_ad["Name"],
+        count,
+        n_skipped,
+        last_formatted,
+        query_time,
         total_upload,
     )
 
-    # If we got to this point without a timeout, all these jobs have
-    # been processed and uploaded, so we can update the checkpoint
-    if not timed_out:
-        checkpoint_queue.put((startd_ad["Machine"], since))
+    # Everything read was converted and uploaded in order,
+    # so we can update the checkpoint
+    stats = make_stats(count, total_time, query_time, total_upload, timed_out)
+    if poster and not (timed_out or failed):
+        save_boundary_docs(schedd_ad["Name"], boundary_docs, boundary_ids, args)
+    if not (timed_out or failed):
+        if not args.es_feed_schedd_history:
+            # Only written to Parquet files, the queue documents still go to ES
+            sent_ids = []
+        return [(schedd_ad["Name"], last_completion, stats, sent_ids)]
+    return [(schedd_ad["Name"], None, stats, [])]
+
+
+# Per-daemon statistics are kept in the checkpoint file under this key
+STATS_KEY = "__daemon_stats__"
 
-    return since
+# Weight of the latest run in the smoothed statistics
+STATS_WEIGHT = 0.5
 
 
 def load_checkpoint():
@@ -351,20 +1004,77 @@ def load_checkpoint():
     return checkpoint
 
 
-def update_checkpoint(name, completion_date):
+def update_checkpoint(name, completion_date, stats=None):
+    """
+    Store the new checkpoint of a daemon (unless completion_date is None)
+    and fold the statistics of its latest run into the smoothed ones
+    """
     checkpoint = load_checkpoint()
 
-    checkpoint[name] = completion_date
+    if completion_date is not None:
+        checkpoint[name] = completion_date
+
+    if stats is not None:
+        all_stats = checkpoint.setdefault(STATS_KEY, {})
+        old_stats = all_stats.get(name)
+        if old_stats:
+            for key in ("count", "total_time", "query_time", "upload_time"):
+                stats[key] = STATS_WEIGHT * stats[key] + (1 - STATS_WEIGHT) * old_stats.get(key, stats[key])
+            # A daemon that timed out would have needed at least as long as before
+            if stats["timed_out"]:
+                stats["total_time"] = max(stats["total_time"], old_stats.get("total_time", 0))
+        stats["updated"] = int(time.time())
+        all_stats[name] = stats
 
     with open("checkpoint.json", "w") as fd:
         json.dump(checkpoint, fd, indent=4)
 
 
+def expected_time(name, checkpoint):
+    """
+    Return the expected processing time of a daemon in minutes,
+    or None if it has not been processed before
+    """
+    return checkpoint.get(STATS_KEY, {}).get(name, {}).get("total_time")
+
+
+def schedule_daemons(ads, key, checkpoint):
+    """
+    Sort the daemon ads longest expected processing time first
+    (longest processing time first scheduling minimizes the makespan).
+    Daemons without statistics are started first as they may have
+    their full history to process.
+    """
+    def _expected(ad):
+        expected = expected_time(ad[key], checkpoint)
+        return float("inf") if expected is None else expected
+
+    return sorted(ads, key=_expected, reverse=True)
+
+
+def daemon_budget(name, checkpoint, args):
+    """
+    Return the time budget (in seconds) of a daemon, a multiple of
+    its expected processing time, or None to only use the global deadline
+    """
+    expected = expected_time(name, checkpoint)
+    if expected is None or not args.process_budget_factor:
+        return None
+    return max(60, args.process_budget_factor * expected * 60)
+
+
 def process_histories(schedd_ads = [], startd_ads = [],
-                          starttime = None, pool = None, args = None, metadata = None):
+                          starttime = None, pool = None, args = None, metadata = None,
+                          sent_docs = None, owns_pool = True):
     """
     Process history files for each schedd listed in a given
     multiprocessing pool
+
+    The ids of the uploaded documents that the queue query will return
+    again are added to sent_docs (a dedup.BloomFilter), if given.
+    On a timeout the pool is terminated, unless it is shared with other
+    passes (not owns_pool): the late tasks are then abandoned, they stop
+    at their own deadline.
     """
     checkpoint = load_checkpoint()
 
@@ -372,55 +1082,92 @@ def process_histories(schedd_ads = [], startd_ads = [],
     metadata = metadata or {}
     metadata["spider_source"] = "condor_history"
 
-    manager = multiprocessing.Manager()
-    checkpoint_queue = manager.Queue()
-
+    # The checkpoint updates come back with the results of the workers
+    # and are written by this process, the lock serializes the pool's
+    # result handler thread and the fan-out threads
+    checkpoint_lock = threading.Lock()
+
+    def _update_checkpoints(updates):
+        with checkpoint_lock:
+            for name, completion_date, stats, sent_ids in updates:
+                if sent_docs is not None:
+                    sent_docs.update(sent_ids)
+                try:
+                    update_checkpoint(name, completion_date, stats)
+                except Exception:
+                    logging.exception("Failed to update checkpoint of %s", name)
+
+    def _fanout(*fanout_args):
+        _update_checkpoints(process_schedd_fanout(*fanout_args))
+
+    fanout_schedds = {
+        name.strip() for name in (args.process_fanout_schedds or "").split(",") if name.strip()
+    }
+    fanout_threads = []
     if len(schedd_ads) > 0:
-        for schedd_ad in schedd_ads:
+        for schedd_ad in schedule_daemons(schedd_ads, "Name", checkpoint):
             name = schedd_ad["Name"]
 
             # Check for last completion time
             # If there was no previous completion, get full history
             last_completion = checkpoint.get(name, 0)
+            budget = daemon_budget(name, checkpoint, args)
+
+            if name in fanout_schedds:
+                # Read from this process, convert in the pool
+                thread = threading.Thread(
+                    target=_fanout,
+                    args=(starttime, last_completion, schedd_ad, pool, args, metadata, budget),
+                    daemon=True,
+                )
+                thread.start()
+                fanout_threads.append((name, thread))
+                continue
 
             future = pool.apply_async(
-                process_schedd,
-                (starttime, last_completion, checkpoint_queue, schedd_ad, args, metadata),
+                metrics.run_instrumented,
+                (name, process_schedd, starttime, last_completion, schedd_ad, args, metadata, budget),
+                callback=metrics.merging(_update_checkpoints),
             )
             futures.append((name, future))
 
-    if len(startd_ads) > 0:
-        for startd_ad in startd_ads:
+    if len(startd_ads) > 0 and args.process_startd_threads > 0:
+        # Spread the startds over a few processes, querying them from threads
+        n_shards = max(1, min(args.process_startd_processes, len(startd_ads)))
+        shards = [[] for _ in range(n_shards)]
+        for i, startd_ad in enumerate(schedule_daemons(startd_ads, "Machine", checkpoint)):
+            shards[i % n_shards].append(startd_ad)
+        for i, shard in enumerate(shards):
+            sinces = {
+                startd_ad["Machine"]: checkpoint.get(
+                    startd_ad["Machine"], {"GlobalJobId": "Unknown", "EnteredCurrentStatus": 0}
+                )
+                for startd_ad in shard
+            }
+            future = pool.apply_async(
+                metrics.run_instrumented,
+                (f"startd-shard-{i}", process_startd_shard, starttime, sinces, shard, args, metadata),
+                callback=metrics.merging(_update_checkpoints),
+            )
+            futures.append((f"startd shard {i}", future))
+
+    elif len(startd_ads) > 0:
+        for startd_ad in schedule_daemons(startd_ads, "Machine", checkpoint):
             machine = startd_ad["Machine"]
 
             # Check for last completion time ("since")
             since = checkpoint.get(machine, {"GlobalJobId": "Unknown", "EnteredCurrentStatus": 0})
+            budget = daemon_budget(machine, checkpoint, args)
 
             future = pool.apply_async(
-                process_startd,
-                (starttime, since, checkpoint_queue, startd_ad, args, metadata),
+                metrics.run_instrumented,
+                (machine, process_startd, starttime, since, startd_ad, args, metadata, budget),
+                callback=metrics.merging(_update_checkpoints),
             )
             futures.append((machine, future))
-            
-
-    def _chkp_updater():
-        while True:
-            try:
-                job = checkpoint_queue.get()
-                if job is None:  # Swallow poison pill
-                    break
-            except EOFError as error:
-                logging.warning(
-                    "EOFError - Nothing to consume left in the queue %s", error
-                )
-                break
-            update_checkpoint(*job)
-
-    chkp_updater = multiprocessing.Process(target=_chkp_updater)
-    chkp_updater.start()
 
     # Check if the entire pool and/or one of the processes has timed out
-    # Timeout is currently hardcoded to 11 minutes in utils.py
+    # Timeout is utils.TIMEOUT_MINS (--process_timeout_mins)
     timed_out = False
     for name, future in futures:
         # Allow a 30 second buffer for processes to finish
@@ -437,7 +1184,7 @@ def process_histories(schedd_ads = [], startd_ads = [],
                 utils.send_email_alert(
                     args.email_alerts, "spider history timeout warning", message
                 )
-            except elasticsearch.exceptions.TransportError:
+            except elastic.transport_errors():
                 message = (
                     "Transport error while sending history data of %s; ignoring progress."
                     % name
@@ -452,11 +1199,14 @@ def process_histories(schedd_ads = [], startd_ads = [],
             timed_out = True
             logging.error("Processing the entire queue took too long, stopping early")
             break
-    if timed_out:
-        pool.terminate()
+    for name, thread in fanout_threads:
+        thread.join(max(utils.time_remaining(starttime, positive=False) + 30, 0))
+        if thread.is_alive():
+            timed_out = True
+            logging.error("Daemon %s history (fan-out) timed out; ignoring progress.", name)
 
-    checkpoint_queue.put(None)  # Send a poison pill
-    chkp_updater.join()
+    if timed_out and owns_pool:
+        pool.terminate()
 
     logging.warning(
         "Processing time for history: %.2f mins", ((time.time() - starttime) / 60.0)
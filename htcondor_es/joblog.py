@@ -0,0 +1,176 @@
+"""
+Methods for following the job queue of a local schedd through
+its transaction log (job_queue.log) instead of querying it.
+
+Each line of the log is an operation on the ad of a job or cluster:
+
+    101 <key> <MyType> <TargetType>    NewClassAd
+    102 <key>                          DestroyClassAd
+    103 <key> <attribute> <expression> SetAttribute
+    104 <key> <attribute>              DeleteAttribute
+    105                                BeginTransaction
+    106                                EndTransaction
+    107 <sequence number> <timestamp>  LogHistoricalSequenceNumber
+
+Keys are "<cluster>.<proc>", with proc -1 for the ad of the cluster
+that all its jobs inherit from, and "0.0" for the header ad. Attribute
+names are case-insensitive, as in ClassAds.
+"""
+
+import os
+import logging
+
+import classad
+
+NEW_CLASSAD = "101"
+DESTROY_CLASSAD = "102"
+SET_ATTRIBUTE = "103"
+DELETE_ATTRIBUTE = "104"
+BEGIN_TRANSACTION = "105"
+END_TRANSACTION = "106"
+HISTORICAL_SEQUENCE_NUMBER = "107"
+
+
+def parse_key(key):
+    """Return (cluster, proc) for a job queue key, None for the header ad"""
+    try:
+        cluster, proc = key.split(".")
+        cluster, proc = int(cluster), int(proc)
+    except ValueError:
+        return None
+    if cluster <= 0:
+        return None
+    return cluster, proc
+
+
+class JobQueueLog(object):
+    """
+    In-memory table of the jobs in a job_queue.log, updated by reading
+    what was appended to the log since the previous poll.
+
+    Ads are kept as {lowercase attribute: (attribute, expression string)}
+    and only parsed when asked for. poll() returns the ids ("<cluster>.<proc>") of the jobs
+    that changed since the previous poll; a rotated (replaced or
+    truncated) log is read again from the start and reports every job.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.clusters = {}  # cluster: attributes
+        self.procs = {}  # (cluster, proc): attributes
+        self.reset()
+
+    def reset(self):
+        self.clusters.clear()
+        self.procs.clear()
+        self.inode = None
+        self.offset = 0
+        self.transaction = None
+        self.changed = set()
+        self.changed_clusters = set()
+
+    def poll(self):
+        """Read the new records of the log, return the ids of changed jobs"""
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logging.error("Cannot read job queue log %s: %s", self.path, e)
+            return set()
+
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            if self.inode is not None:
+                logging.warning("Job queue log %s rotated, resyncing", self.path)
+            self.reset()
+            self.inode = stat.st_ino
+
+        with open(self.path, "rb") as fd:
+            fd.seek(self.offset)
+            data = fd.read()
+
+        # Only consume complete lines, the schedd may be half way a write
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8", "replace").splitlines():
+            self.process_line(line)
+        self.offset += end
+
+        if self.changed_clusters:
+            # Every job of a changed cluster inherits the change
+            self.changed.update(
+                job for job in self.procs if job[0] in self.changed_clusters
+            )
+        changed = set("%d.%d" % job for job in self.changed if job in self.procs)
+        self.changed = set()
+        self.changed_clusters = set()
+        return changed
+
+    def process_line(self, line):
+        op, _, rest = line.partition(" ")
+        if op == BEGIN_TRANSACTION:
+            self.transaction = []
+        elif op == END_TRANSACTION:
+            transaction, self.transaction = self.transaction or [], None
+            for op, rest in transaction:
+                self.apply(op, rest)
+        elif op == HISTORICAL_SEQUENCE_NUMBER or not op:
+            pass
+        elif self.transaction is not None:
+            self.transaction.append((op, rest))
+        else:
+            self.apply(op, rest)
+
+    def apply(self, op, rest):
+        fields = rest.split(" ", 2)
+        key = parse_key(fields[0])
+        if key is None:
+            return
+        cluster, proc = key
+
+        if op == NEW_CLASSAD:
+            if proc < 0:
+                self.clusters[cluster] = {}
+            else:
+                self.procs[key] = {}
+                self.changed.add(key)
+            return
+        if op == DESTROY_CLASSAD:
+            if proc < 0:
+                self.clusters.pop(cluster, None)
+            else:
+                self.procs.pop(key, None)
+            return
+
+        attrs = self.clusters.get(cluster) if proc < 0 else self.procs.get(key)
+        if attrs is None or len(fields) < 2:
+            return
+        if op == SET_ATTRIBUTE and len(fields) == 3:
+            attrs[fields[1].lower()] = (fields[1], fields[2])
+        elif op == DELETE_ATTRIBUTE:
+            attrs.pop(fields[1].lower(), None)
+        else:
+            logging.debug("Unknown job queue log record: %s %s", op, rest)
+            return
+
+        if proc < 0:
+            self.changed_clusters.add(cluster)
+        else:
+            self.changed.add(key)
+
+    def jobs(self):
+        """Return the ids of all the jobs in the table"""
+        return ["%d.%d" % job for job in self.procs]
+
+    def job_ad(self, job_id, projection=None):
+        """
+        Return the ClassAd of a job, merged with the ad of its cluster,
+        with only the attributes in projection if given
+        """
+        cluster, proc = parse_key(job_id)
+        attrs = dict(self.clusters.get(cluster, {}))
+        attrs.update(self.procs[(cluster, proc)])
+        if projection:
+            attrs = {
+                key.lower(): attrs[key.lower()] for key in projection if key.lower() in attrs
+            }
+        return classad.parseOne(
+            "\n".join("%s = %s" % item for item in attrs.values()), classad.Parser.Old
+        )
@@ -0,0 +1,303 @@
+"""
+Lightweight instrumentation of the hot paths of the spider.
+
+Counters and latency histograms are kept per daemon and stage by the
+process doing the work. Pool tasks run through run_instrumented, which
+hands what the worker recorded back with the result, to be merged in
+the main process (see merging). At the end of a run the main process
+writes them as a JSON run report, optionally also sent to ES.
+
+Stages:
+    query_wait  waiting for the next ad from a daemon
+    convert     ClassAd evaluation and conversion of an ad
+    serialize   JSON serialization of a bulk body
+    bulk_post   bulk request, as seen by the spider
+    es_took     bulk request, as reported by ES ("took")
+    queue_wait  waiting to hand a bunch over to an uploader
+    parquet     writing a bunch to Parquet files (--parquet_dir)
+
+Gauges (e.g. the RSS of the workers) are not per daemon and are merged
+by keeping the highest value.
+"""
+
+import os
+import json
+import time
+import resource
+import socket
+import bisect
+import threading
+import multiprocessing
+
+from . import profiling
+
+# Daemon name of the work not done for a single daemon
+# (e.g. uploading the coalesced queue bunches)
+SHARED = "_shared"
+
+# Upper bounds (in seconds) of the histogram buckets, plus one overflow bucket
+BUCKETS = [
+    0.0001,
+    0.0003,
+    0.001,
+    0.003,
+    0.01,
+    0.03,
+    0.1,
+    0.3,
+    1,
+    3,
+    10,
+    30,
+    100,
+    300,
+]
+
+_LOCK = threading.Lock()
+# A worker forked while a thread of the main process held _LOCK would
+# inherit it locked, forked processes make their own (no os.register_at_fork
+# before Python 3.7)
+_LOCK_PID = os.getpid()
+_COUNTERS = {}  # daemon: {counter: value}
+_HISTOGRAMS = {}  # daemon: {stage: [count, sum, max, bucket counts]}
+_GAUGES = {}  # gauge: highest value
+
+
+def new_histogram():
+    return [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)]
+
+
+def add_histogram(total, hist):
+    total[0] += hist[0]
+    total[1] += hist[1]
+    total[2] = max(total[2], hist[2])
+    total[3] = [a + b for a, b in zip(total[3], hist[3])]
+
+
+def observe(daemon, stage, seconds):
+    """Record one latency of a stage"""
+    with _LOCK:
+        hist = _HISTOGRAMS.setdefault(daemon, {}).get(stage)
+        if hist is None:
+            hist = _HISTOGRAMS[daemon][stage] = new_histogram()
+        hist[0] += 1
+        hist[1] += seconds
+        hist[2] = max(hist[2], seconds)
+        hist[3][bisect.bisect_left(BUCKETS, seconds)] += 1
+    if profiling.MODE == "tracemalloc":
+        profiling.stage_done(stage)
+
+
+def incr(daemon, counter, value=1):
+    with _LOCK:
+        counters = _COUNTERS.setdefault(daemon, {})
+        counters[counter] = counters.get(counter, 0) + value
+
+
+def gauge_max(gauge, value):
+    with _LOCK:
+        _GAUGES[gauge] = max(_GAUGES.get(gauge, value), value)
+
+
+def rss_bytes():
+    """Return the resident set size of this process"""
+    try:
+        with open("/proc/self/statm", "r") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak instead of current RSS, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def timed_iter(iterable, daemon, stage="query_wait"):
+    """Yield from iterable, recording how long each item took to come"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(daemon, stage, time.perf_counter() - start)
+        yield item
+
+
+def reset():
+    """Forget what was recorded, also the pool initializer of the workers"""
+    global _LOCK, _LOCK_PID
+    if _LOCK_PID != os.getpid():
+        _LOCK = threading.Lock()
+        _LOCK_PID = os.getpid()
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+        _GAUGES.clear()
+
+
+def snapshot(clear=False):
+    """Return what was recorded, as plain (picklable) data, and forget it with clear"""
+    with _LOCK:
+        recorded = {
+            "counters": {daemon: dict(c) for daemon, c in _COUNTERS.items()},
+            "histograms": {
+                daemon: {
+                    stage: [h[0], h[1], h[2], list(h[3])] for stage, h in hists.items()
+                }
+                for daemon, hists in _HISTOGRAMS.items()
+            },
+            "gauges": dict(_GAUGES),
+        }
+        if clear:
+            _COUNTERS.clear()
+            _HISTOGRAMS.clear()
+            _GAUGES.clear()
+        return recorded
+
+
+def combine(counters, histograms, gauges, recorded):
+    """Add a snapshot() to the given counters, histograms and gauges"""
+    for daemon, daemon_counters in recorded["counters"].items():
+        mine = counters.setdefault(daemon, {})
+        for counter, value in daemon_counters.items():
+            mine[counter] = mine.get(counter, 0) + value
+    for daemon, hists in recorded["histograms"].items():
+        for stage, hist in hists.items():
+            add_histogram(
+                histograms.setdefault(daemon, {}).setdefault(stage, new_histogram()),
+                hist,
+            )
+    for gauge, value in recorded.get("gauges", {}).items():
+        gauges[gauge] = max(gauges.get(gauge, value), value)
+
+
+def merge(recorded):
+    """Add a snapshot() of another process to what was recorded here"""
+    if not recorded:
+        return
+    with _LOCK:
+        combine(_COUNTERS, _HISTOGRAMS, _GAUGES, recorded)
+
+
+def run_instrumented(tag, func, *args):
+    """
+    Run func(*args) in a pool worker and return (result, snapshot of
+    what it recorded), profiled under tag with --profile.
+    In the main process (thread pools) the metrics are recorded
+    directly, the snapshot is then empty.
+    """
+    if multiprocessing.current_process().name == "MainProcess":
+        return func(*args), {}
+    reset()
+    if profiling.MODE:
+        result = profiling.run_profiled(tag, func, *args)
+    else:
+        result = func(*args)
+    gauge_max("worker_rss_bytes", rss_bytes())
+    return result, snapshot()
+
+
+def merging(callback):
+    """Wrap the callback of a run_instrumented task to merge its metrics"""
+
+    def _callback(result):
+        result, recorded = result
+        merge(recorded)
+        return callback(result)
+
+    return _callback
+
+
+def _percentile(hist, fraction):
+    """Upper bound of the bucket holding the given fraction of the values"""
+    count, _, maximum, buckets = hist
+    target = fraction * count
+    seen = 0
+    for bound, n in zip(BUCKETS, buckets):
+        seen += n
+        if seen >= target:
+            return min(bound, maximum)
+    return maximum
+
+
+def summarize(hist):
+    count, total, maximum, buckets = hist
+    return {
+        "count": count,
+        "sum": round(total, 6),
+        "mean": round(total / count, 6) if count else 0,
+        "max": round(maximum, 6),
+        "p50": _percentile(hist, 0.5),
+        "p90": _percentile(hist, 0.9),
+        "p99": _percentile(hist, 0.99),
+        "buckets": buckets,
+    }
+
+
+def make_report(starttime, passes, recorded=None):
+    """
+    Return the run report of what was recorded since starttime,
+    per daemon and summed over all daemons
+    """
+    recorded = recorded or snapshot()
+    totals = {"counters": {}, "histograms": {}}
+    daemons = {}
+    for daemon in sorted(set(recorded["counters"]) | set(recorded["histograms"])):
+        counters = recorded["counters"].get(daemon, {})
+        hists = recorded["histograms"].get(daemon, {})
+        daemons[daemon] = {
+            "counters": counters,
+            "stages": {stage: summarize(hist) for stage, hist in hists.items()},
+        }
+        for counter, value in counters.items():
+            totals["counters"][counter] = totals["counters"].get(counter, 0) + value
+        for stage, hist in hists.items():
+            add_histogram(totals["histograms"].setdefault(stage, new_histogram()), hist)
+    return {
+        "spider_hostname": socket.gethostname(),
+        "passes": passes,
+        "start": int(starttime),
+        "end": int(time.time()),
+        "duration": round(time.time() - starttime, 3),
+        "bucket_bounds": BUCKETS,
+        "gauges": recorded.get("gauges", {}),
+        "total": {
+            "counters": totals["counters"],
+            "stages": {
+                stage: summarize(hist) for stage, hist in totals["histograms"].items()
+            },
+        },
+        "daemons": daemons,
+    }
+
+
+def write_report(report, filename):
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+    os.replace(tmpname, filename)
+
+
+def report_docs(report):
+    """
+    Return the ES documents of a run report as (id, doc) pairs:
+    one per daemon and one ("_total") for the whole run
+    """
+    run_id = "%s#%d" % (report["spider_hostname"], report["start"])
+    common = {
+        key: report[key]
+        for key in ("spider_hostname", "passes", "start", "end", "duration")
+    }
+    docs = []
+    for daemon, values in [("_total", report["total"])] + sorted(
+        report["daemons"].items()
+    ):
+        doc = dict(common, daemon=daemon, counters=values["counters"])
+        if daemon == "_total":
+            doc["gauges"] = report["gauges"]
+        # Buckets are left out of ES, they are in the JSON report
+        doc["stages"] = {
+            stage: {key: value for key, value in summary.items() if key != "buckets"}
+            for stage, summary in values["stages"].items()
+        }
+        docs.append(("%s#%s" % (run_id, daemon), doc))
+    return docs
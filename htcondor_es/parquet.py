@@ -0,0 +1,327 @@
+"""
+Export of the job history to Parquet files (--parquet_dir), for offline
+analytics that would otherwise scroll through the ES indices.
+
+Documents are written alongside the ES feed (or instead of it) by the
+history passes and backfills, partitioned by the date of their index:
+
+    <parquet_dir>/date=YYYY-MM-DD/<host>-<pid>-<n>.parquet
+
+Each writer (the pass of a daemon or of a shard of startds; the pool
+workers of a fan-out only build the tables, the main process writes them
+once per schedd) rolls to a new file once the current one holds
+parquet_max_rows rows or parquet_max_mb megabytes. Files are written as
+hidden .tmp files and renamed when complete, so that the
+readers of the directory (pyarrow.dataset, Spark, DuckDB...) only see
+complete files.
+
+The schema does not depend on the jobs seen, it is derived from the
+type sets of convert (plus the fields computed by convert.to_json), and
+other attributes are left out. Values that do not fit the type of their
+column are written as nulls. Keyword columns are dictionary encoded.
+Documents sent again (e.g. after a failed run) are written again, the
+_id column (the ES document id) tells the copies apart.
+"""
+
+import os
+import math
+import time
+import socket
+import logging
+
+from . import convert, elastic, metrics
+
+# Fields of the documents in none of the type sets of convert
+KEYWORD_FIELDS = {
+    "AccountingGroup",
+    "CPUModel",
+    "GlobalJobId",
+    "LastRemoteHost",
+    "Owner",
+    "RemoteHost",
+    "ScheddName",
+    "Site",
+    "StartdName",
+    "StartdSlot",
+    "Status",
+    "Universe",
+    "User",
+    "VO",
+}
+FLOAT_FIELDS = {
+    "BenchmarkJobDB12",
+    "BenchmarkJobHS06",
+    "CommittedGpuCoreHr",
+    "CommittedWallClockHr",
+    "CpuEff",
+    "DB12CoreHr",
+    "GpuCoreHr",
+    "HS06CoreHr",
+}
+INT_FIELDS = {
+    "CommittedTime",
+    "CondorExitCode",
+    "DataCollection",
+    "ExitCode",
+    "JobFailed",
+    "JobPrio",
+    "JobStatus",
+    "JobUniverse",
+    "NumJobStarts",
+    "ProcId",
+    "RemoteWallClockTime",
+    "RequestCpus",
+    "RequestDisk",
+    "RequestGpus",
+    "RequestMemory",
+}
+
+# Keyword columns that are (nearly) unique per row, not worth a dictionary
+UNIQUE_FIELDS = {"_id", "GlobalJobId"}
+
+ROW_GROUP_ROWS = 50000
+
+
+def column_types():
+    """Return {field: type name}, attributes in several type sets get the type of convert.to_json"""
+    types = {}
+    # Later sets win, in the reverse order of the checks of to_json
+    for names, kind in [
+        (KEYWORD_FIELDS, "string"),
+        (FLOAT_FIELDS, "float"),
+        (INT_FIELDS, "int"),
+        (convert.DATE_ATTRS, "date"),
+        (convert.BOOL_ATTRS, "bool"),
+        (convert.INT_ATTRS, "int"),
+        (convert.FLOAT_ATTRS, "float"),
+        (convert.NOINDEX_KEYWORD_ATTRS, "string"),
+        (convert.INDEXED_KEYWORD_ATTRS, "string"),
+        (convert.TEXT_ATTRS, "string"),
+    ]:
+        for name in names:
+            types[name] = kind
+    types["_id"] = "string"
+    return types
+
+
+def make_schema():
+    import pyarrow as pa
+
+    arrow_types = {
+        "string": pa.string(),
+        "float": pa.float64(),
+        "int": pa.int64(),
+        "date": pa.timestamp("s", tz="UTC"),
+        "bool": pa.bool_(),
+    }
+    types = column_types()
+    return pa.schema([(name, arrow_types[types[name]]) for name in sorted(types)])
+
+
+def _string(value):
+    return None if value is None else str(value)
+
+
+# The coercions below are only used for the columns pyarrow fails to
+# convert as a whole, and are as lenient (bools are numbers, floats are
+# truncated to ints)
+
+
+def _float(value):
+    if not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _int(value):
+    if isinstance(value, float):
+        value = int(value) if math.isfinite(value) else None
+    if not isinstance(value, int) or not -(2**63) <= value < 2**63:
+        return None
+    return int(value)
+
+
+def _bool(value):
+    return value if isinstance(value, bool) else None
+
+
+COERCE = {"string": _string, "float": _float, "int": _int, "date": _int, "bool": _bool}
+
+
+class ParquetSink(object):
+    """Writes documents to the date partitions of a directory"""
+
+    def __init__(self, directory, max_rows=1000000, max_mb=256, compression="zstd"):
+        import pyarrow.parquet
+
+        self.pq = pyarrow.parquet
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_bytes = max_mb * 1024 * 1024
+        self.compression = compression
+        self.schema = make_schema()
+        types = column_types()
+        self.coerce = {name: COERCE[types[name]] for name in self.schema.names}
+        self.dictionary = [
+            name
+            for name in self.schema.names
+            if types[name] == "string" and name not in UNIQUE_FIELDS
+        ]
+        self.prefix = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.sequence = 0
+        self.buffers = {}  # date: [tables]
+        self.files = {}  # date: (writer, filename, rows)
+
+    def make_table(self, ads):
+        """Return the (id, doc) pairs as a table of the schema"""
+        import pyarrow as pa
+
+        # One pass over the fields of the documents, most columns stay empty
+        n_rows = len(ads)
+        values = {name: [None] * n_rows for name in self.schema.names}
+        ids = values["_id"]
+        for row, (id_, doc) in enumerate(ads):
+            ids[row] = id_
+            for key, value in doc.items():
+                column = values.get(key)
+                if column is not None:
+                    column[row] = value
+
+        arrays = []
+        for field in self.schema:
+            column = values[field.name]
+            try:
+                arrays.append(pa.array(column, type=field.type))
+            except (pa.ArrowException, TypeError, ValueError, OverflowError):
+                # Some values do not fit the type of the column
+                coerce = self.coerce[field.name]
+                arrays.append(
+                    pa.array([coerce(value) for value in column], type=field.type)
+                )
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, idx, ads, daemon=metrics.SHARED):
+        """Add the (id, doc) pairs of a bunch posted to idx"""
+        start = time.perf_counter()
+        self._add(idx, self.make_table(ads))
+        metrics.observe(daemon, "parquet", time.perf_counter() - start)
+        metrics.incr(daemon, "docs_parquet", len(ads))
+
+    def write_table(self, idx, table, daemon=metrics.SHARED):
+        """Add a table made by make_table (e.g. in a pool worker)"""
+        start = time.perf_counter()
+        self._add(idx, table)
+        metrics.observe(daemon, "parquet", time.perf_counter() - start)
+        metrics.incr(daemon, "docs_parquet", table.num_rows)
+
+    def _add(self, idx, table):
+        # Indices are named <template>-YYYY-MM-DD (see elastic.get_index)
+        date = idx[-10:]
+        buffer = self.buffers.setdefault(date, [])
+        buffer.append(table)
+        if sum(table.num_rows for table in buffer) >= min(
+            ROW_GROUP_ROWS, self.max_rows
+        ):
+            self._flush(date)
+
+    def _open(self, date):
+        partition = os.path.join(self.directory, "date=" + date)
+        os.makedirs(partition, exist_ok=True)
+        self.sequence += 1
+        filename = os.path.join(
+            partition, "%s-%d.parquet" % (self.prefix, self.sequence)
+        )
+        writer = self.pq.ParquetWriter(
+            os.path.join(partition, "." + os.path.basename(filename) + ".tmp"),
+            self.schema,
+            compression=self.compression,
+            use_dictionary=self.dictionary,
+        )
+        return writer, filename, 0
+
+    def _close(self, date):
+        writer, filename, rows = self.files.pop(date)
+        writer.close()
+        os.rename(writer.where, filename)
+        logging.debug("Wrote %d rows to %s", rows, filename)
+
+    def _flush(self, date):
+        import pyarrow as pa
+
+        table = pa.concat_tables(self.buffers.pop(date)).combine_chunks()
+        offset = 0
+        while offset < table.num_rows:
+            if date not in self.files:
+                self.files[date] = self._open(date)
+            writer, filename, rows = self.files[date]
+            n = min(table.num_rows - offset, self.max_rows - rows)
+            writer.write_table(table.slice(offset, n))
+            offset += n
+            self.files[date] = (writer, filename, rows + n)
+            if (
+                rows + n >= self.max_rows
+                or os.path.getsize(writer.where) >= self.max_bytes
+            ):
+                self._close(date)
+
+    def close(self):
+        """Write what is buffered and complete the files"""
+        for date in list(self.buffers):
+            self._flush(date)
+        for date in list(self.files):
+            self._close(date)
+
+
+def make_sink(args):
+    return ParquetSink(
+        args.parquet_dir,
+        max_rows=args.parquet_max_rows,
+        max_mb=args.parquet_max_mb,
+        compression=args.parquet_compression,
+    )
+
+
+class ParquetPoster(elastic.BulkPoster):
+    """
+    BulkPoster writing the ads to Parquet files before handing them
+    over to poster, if any. Bodies already serialized (post_body) are
+    only handed over, their documents come as tables (post_table).
+    """
+
+    def __init__(self, sink, poster=None, daemon=metrics.SHARED):
+        super(ParquetPoster, self).__init__(None, daemon=daemon)
+        self.sink = sink
+        self.poster = poster
+        self.needs_index = poster is not None and poster.needs_index
+
+    def _post(self, idx, ads):
+        start = time.perf_counter()
+        self.sink.write(idx, ads, self.daemon)
+        self.upload_time += time.perf_counter() - start
+        self.n_posted += len(ads)
+        if self.poster is not None:
+            self.poster.post(idx, ads)
+
+    def post_body(self, idx, body, n_docs):
+        if self.poster is not None:
+            self.poster.post_body(idx, body, n_docs)
+
+    def post_table(self, idx, table):
+        """Write a table made by ParquetSink.make_table"""
+        start = time.perf_counter()
+        self.sink.write_table(idx, table, self.daemon)
+        self.upload_time += time.perf_counter() - start
+        self.n_posted += table.num_rows
+
+    def close(self):
+        start = time.perf_counter()
+        try:
+            self.sink.close()
+        finally:
+            self.upload_time += time.perf_counter() - start
+            if self.poster is not None:
+                try:
+                    self.poster.close()
+                finally:
+                    self.upload_time += self.poster.upload_time
+        super(ParquetPoster, self).close()
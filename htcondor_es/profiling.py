@@ -0,0 +1,268 @@
+"""
+Profiling of the spider (--profile), the driver and every pool task
+separately, each writing its own file tagged with the daemon it was
+processing to a directory per run:
+
+    cprofile     cProfile of the main thread, <tag>.<pid>.<n>.pstats
+    sample       all threads sampled every SAMPLE_INTERVAL seconds
+                 (wall clock, waiting threads are counted too),
+                 <tag>.<pid>.<n>.stacks in the collapsed stack format
+                 of flame graph tools ("frame;frame;frame count")
+    tracemalloc  peak memory allocated during each stage (see metrics)
+                 and during the whole task, sampled every SAMPLE_INTERVAL
+                 seconds and at the end of each stage, <tag>.<pid>.<n>.json
+
+Pool tasks are profiled by metrics.run_instrumented. Tasks run on
+threads of the main process are only seen in the profile of the driver
+(for cprofile, not at all, as only the main thread is profiled).
+At the end, summarize() merges the files of the run into a top N.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+
+MODES = ["cprofile", "sample", "tracemalloc"]
+
+SAMPLE_INTERVAL = 0.005
+
+MODE = None  # set by configure, inherited by the forked pool workers
+DIRECTORY = None
+
+_DRIVER_PROFILER = None
+_SEQUENCE = [0]
+_STAGE_LOCK = threading.Lock()
+_STAGE_PEAKS = {}  # stage: highest peak above the memory at its start
+_STAGE_START = [0]  # traced memory at the end of the previous stage
+_STAGE_HIGH = [0]  # highest traced memory sampled since then
+
+
+def configure(mode, directory):
+    """Enable profiling, its files go to a new directory under directory"""
+    global MODE, DIRECTORY
+    MODE = mode
+    DIRECTORY = os.path.join(
+        directory, time.strftime("%Y%m%d-%H%M%S") + "-%d" % os.getpid()
+    )
+    os.makedirs(DIRECTORY, exist_ok=True)
+    if mode == "tracemalloc":
+        import tracemalloc
+
+        # Started before the pool, so that the workers trace too
+        tracemalloc.start()
+    logging.warning("Writing %s profiles to %s", mode, DIRECTORY)
+
+
+def _filename(tag, extension):
+    _SEQUENCE[0] += 1
+    tag = "".join(c if c.isalnum() or c in "-_.@" else "_" for c in str(tag))
+    return os.path.join(
+        DIRECTORY, "%s.%d.%d.%s" % (tag, os.getpid(), _SEQUENCE[0], extension)
+    )
+
+
+class Sampler(object):
+    """Thread counting the stacks of the other threads of this process"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "%s (%s:%d)"
+                        % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    )
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, filename):
+        with open(filename, "w") as fd:
+            for stack, count in self.stacks.most_common():
+                fd.write("%s %d\n" % (stack, count))
+
+
+def _sample_memory():
+    """Return the traced memory, keeping the highest of the current stage"""
+    import tracemalloc
+
+    current = tracemalloc.get_traced_memory()[0]
+    with _STAGE_LOCK:
+        _STAGE_HIGH[0] = max(_STAGE_HIGH[0], current)
+    return current
+
+
+def stage_done(stage):
+    """
+    Record the peak memory allocated during a stage that just ended
+    (the memory is process wide, so stages on other threads blur it).
+    The tracemalloc peak cannot be reset before Python 3.9, the peak
+    is the highest of the samples taken during the stage instead.
+    """
+    current = _sample_memory()
+    with _STAGE_LOCK:
+        peak = _STAGE_HIGH[0] - _STAGE_START[0]
+        _STAGE_PEAKS[stage] = max(_STAGE_PEAKS.get(stage, 0), peak)
+        _STAGE_START[0] = _STAGE_HIGH[0] = current
+
+
+def run_profiled(tag, func, *args):
+    """Run func(*args) and write its profile, tagged with tag"""
+    global _DRIVER_PROFILER
+    if MODE == "cprofile":
+        import cProfile
+
+        if _DRIVER_PROFILER is not None and tag != "driver":
+            # Inherited from the driver by a forked worker
+            _DRIVER_PROFILER.disable()
+            _DRIVER_PROFILER = None
+        profiler = cProfile.Profile()
+        if tag == "driver":
+            _DRIVER_PROFILER = profiler
+        profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(_filename(tag, "pstats"))
+
+    if MODE == "sample":
+        sampler = Sampler()
+        sampler.start()
+        try:
+            return func(*args)
+        finally:
+            sampler.stop()
+            sampler.dump(_filename(tag, "stacks"))
+
+    if MODE == "tracemalloc":
+        import tracemalloc
+
+        start = tracemalloc.get_traced_memory()[0]
+        with _STAGE_LOCK:
+            _STAGE_PEAKS.clear()
+            _STAGE_START[0] = _STAGE_HIGH[0] = start
+        peak = [0]
+
+        def _watch(stopped):
+            while not stopped.wait(SAMPLE_INTERVAL):
+                peak[0] = max(peak[0], _sample_memory() - start)
+
+        stopped = threading.Event()
+        watcher = threading.Thread(target=_watch, args=(stopped,), daemon=True)
+        watcher.start()
+        try:
+            return func(*args)
+        finally:
+            stopped.set()
+            watcher.join()
+            peak[0] = max(peak[0], _sample_memory() - start)
+            with _STAGE_LOCK:
+                stages = dict(_STAGE_PEAKS)
+            with open(_filename(tag, "json"), "w") as fd:
+                json.dump({"tag": tag, "peak": peak[0], "stages": stages}, fd)
+
+    return func(*args)
+
+
+def _tag(filename):
+    return os.path.basename(filename).rsplit(".", 3)[0]
+
+
+def _summarize_cprofile(filenames, top):
+    import io
+    import pstats
+
+    out = io.StringIO()
+    stats = pstats.Stats(*filenames, stream=out)
+    stats.sort_stats("cumulative").print_stats(top)
+    stats.sort_stats("tottime").print_stats(top)
+    return out.getvalue()
+
+
+def _summarize_sample(filenames, top):
+    inclusive = collections.Counter()
+    own = collections.Counter()
+    total = 0
+    for filename in filenames:
+        with open(filename, "r") as fd:
+            for line in fd:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                frames = stack.split(";")
+                count = int(count)
+                total += count
+                own[frames[-1]] += count
+                for frame in set(frames):
+                    inclusive[frame] += count
+    lines = ["%d samples, every %.1f ms" % (total, SAMPLE_INTERVAL * 1000)]
+    for title, counter in (("Inclusive", inclusive), ("Own", own)):
+        lines.append("")
+        lines.append("%s samples:" % title)
+        for frame, count in counter.most_common(top):
+            lines.append("  %6.2f%%  %8d  %s" % (100.0 * count / max(total, 1), count, frame))
+    return "\n".join(lines) + "\n"
+
+
+def _summarize_tracemalloc(filenames, top):
+    stages = {}
+    tasks = []
+    for filename in filenames:
+        with open(filename, "r") as fd:
+            profile = json.load(fd)
+        tasks.append((profile["peak"], profile["tag"]))
+        for stage, peak in profile["stages"].items():
+            stages[stage] = max(stages.get(stage, 0), peak)
+    lines = ["Peak allocations per stage:"]
+    for stage, peak in sorted(stages.items(), key=lambda item: -item[1]):
+        lines.append("  %10.1f MB  %s" % (peak / 1e6, stage))
+    lines.append("")
+    lines.append("Peak allocations per task:")
+    for peak, tag in sorted(tasks, reverse=True)[:top]:
+        lines.append("  %10.1f MB  %s" % (peak / 1e6, tag))
+    return "\n".join(lines) + "\n"
+
+
+def summarize(top=25):
+    """Return the top N of all the profiles written during this run"""
+    extension = {"cprofile": "pstats", "sample": "stacks", "tracemalloc": "json"}[MODE]
+    filenames = sorted(
+        os.path.join(DIRECTORY, name)
+        for name in os.listdir(DIRECTORY)
+        if name.endswith("." + extension)
+    )
+    if not filenames:
+        return "No profiles in %s\n" % DIRECTORY
+    summary = {
+        "cprofile": _summarize_cprofile,
+        "sample": _summarize_sample,
+        "tracemalloc": _summarize_tracemalloc,
+    }[MODE](filenames, top)
+    tags = collections.Counter(_tag(filename) for filename in filenames)
+    return "%s profiles of %d tasks (%d tags) in %s\n\n%s" % (
+        MODE,
+        len(filenames),
+        len(tags),
+        DIRECTORY,
+        summary,
+    )
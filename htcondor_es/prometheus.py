@@ -0,0 +1,291 @@
+"""
+Export of the spider metrics in the Prometheus text format.
+
+For cron runs the metrics are written at the end of each run to a file
+read by the textfile collector of the node exporter. In daemon mode
+they are also served over HTTP, and the counters and histograms add up
+over all the passes since the daemon started.
+
+The metrics of the pool workers are merged in the main process (see
+metrics.run_instrumented) before they get here, so the exported values
+cover all the processes of the spider. The documents of the coalesced
+queue uploads are counted under the daemon "_shared".
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+import http.server
+
+from . import metrics
+
+PREFIX = "htcondor_spider"
+
+_LOCK = threading.Lock()
+_COUNTERS = {}  # daemon: {counter: value}, since the start of the process
+_HISTOGRAMS = {}  # daemon: {stage: histogram}, since the start of the process
+_GAUGES = {}  # gauge: value, of the latest run
+_RATES = {}  # daemon: (docs/s, bytes/s) over the latest run that included it
+_PASSES = {}  # pass: (end, duration) of its latest run
+
+# Counters of the metrics module and the name they are exported as
+COUNTERS = [
+    ("docs_sent", "documents_total", "Documents indexed by Elasticsearch"),
+    ("bytes_sent", "bytes_total", "Bytes of bulk requests sent to Elasticsearch"),
+    ("bulk_requests", "bulk_requests_total", "Bulk requests sent to Elasticsearch"),
+    (
+        "docs_failed",
+        "documents_failed_total",
+        "Documents Elasticsearch failed to index",
+    ),
+    (
+        "docs_rejected",
+        "documents_rejected_total",
+        "Documents rejected by a full write queue (429)",
+    ),
+    ("docs_spooled", "documents_spooled_total", "Documents written to the spool"),
+    ("docs_parquet", "documents_parquet_total", "Documents written to Parquet files"),
+]
+
+
+def update(report, recorded):
+    """Add the metrics of a run (see metrics.make_report) to the exported ones"""
+    with _LOCK:
+        metrics.combine(_COUNTERS, _HISTOGRAMS, {}, recorded)
+        _GAUGES.clear()
+        _GAUGES.update(report["gauges"])
+        duration = max(report["duration"], 1e-3)
+        for daemon, values in report["daemons"].items():
+            counters = values["counters"]
+            if "docs_sent" in counters or "bytes_sent" in counters:
+                _RATES[daemon] = (
+                    counters.get("docs_sent", 0) / duration,
+                    counters.get("bytes_sent", 0) / duration,
+                )
+        for name in report["passes"]:
+            _PASSES[name] = (report["end"], report["duration"])
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join('%s="%s"' % item for item in escaped) + "}"
+
+
+def _metric(lines, name, kind, description, samples):
+    """Append the lines of a metric, samples are (suffix, labels, value)"""
+    if not samples:
+        return
+    lines.append("# HELP %s_%s %s" % (PREFIX, name, description))
+    lines.append("# TYPE %s_%s %s" % (PREFIX, name, kind))
+    for suffix, labels, value in samples:
+        lines.append(
+            "%s_%s%s%s %s"
+            % (PREFIX, name, suffix, _labels(**labels), repr(float(value)))
+        )
+
+
+def checkpoint_lags(now=None):
+    """Return {daemon: seconds since its last completion} from checkpoint.json"""
+    now = now or time.time()
+    try:
+        with open("checkpoint.json", "r") as fd:
+            checkpoint = json.load(fd)
+    except (IOError, ValueError):
+        return {}
+    lags = {}
+    for name, value in checkpoint.items():
+        # Startds keep the last job seen instead of a completion date
+        if isinstance(value, dict):
+            value = value.get("EnteredCurrentStatus")
+        if isinstance(value, (int, float)) and not name.startswith("__"):
+            lags[name] = now - value
+    return lags
+
+
+def render():
+    """Return the exported metrics in the Prometheus text format"""
+    with _LOCK:
+        lines = []
+        for counter, name, description in COUNTERS:
+            _metric(
+                lines,
+                name,
+                "counter",
+                description,
+                [
+                    ("", {"daemon": daemon}, counters[counter])
+                    for daemon, counters in sorted(_COUNTERS.items())
+                    if counter in counters
+                ],
+            )
+
+        _metric(
+            lines,
+            "documents_per_second",
+            "gauge",
+            "Documents indexed per second",
+            [
+                ("", {"daemon": daemon}, rates[0])
+                for daemon, rates in sorted(_RATES.items())
+            ],
+        )
+        _metric(
+            lines,
+            "bytes_per_second",
+            "gauge",
+            "Bytes sent to Elasticsearch per second",
+            [
+                ("", {"daemon": daemon}, rates[1])
+                for daemon, rates in sorted(_RATES.items())
+            ],
+        )
+
+        bulk = [
+            (daemon, hists["bulk_post"])
+            for daemon, hists in sorted(_HISTOGRAMS.items())
+            if "bulk_post" in hists
+        ]
+        _metric(
+            lines,
+            "bulk_seconds",
+            "summary",
+            "Latency of the bulk requests",
+            [
+                sample
+                for daemon, hist in bulk
+                for sample in (
+                    ("_sum", {"daemon": daemon}, hist[1]),
+                    ("_count", {"daemon": daemon}, hist[0]),
+                )
+            ],
+        )
+
+        # Per stage over all daemons, per daemon buckets would be too many series
+        stages = {}
+        for hists in _HISTOGRAMS.values():
+            for stage, hist in hists.items():
+                metrics.add_histogram(
+                    stages.setdefault(stage, metrics.new_histogram()), hist
+                )
+        samples = []
+        for stage, (count, total, _, buckets) in sorted(stages.items()):
+            cumulative = 0
+            for bound, n in zip(metrics.BUCKETS + ["+Inf"], buckets):
+                cumulative += n
+                samples.append(("_bucket", {"stage": stage, "le": bound}, cumulative))
+            samples.append(("_sum", {"stage": stage}, total))
+            samples.append(("_count", {"stage": stage}, count))
+        _metric(
+            lines,
+            "stage_seconds",
+            "histogram",
+            "Latency of the processing stages",
+            samples,
+        )
+
+        gauges = dict(_GAUGES)
+        passes = dict(_PASSES)
+
+    _metric(
+        lines,
+        "checkpoint_lag_seconds",
+        "gauge",
+        "Time since the last completion sent",
+        [
+            ("", {"daemon": daemon}, lag)
+            for daemon, lag in sorted(checkpoint_lags().items())
+        ],
+    )
+    _metric(
+        lines,
+        "worker_rss_bytes",
+        "gauge",
+        "Highest resident set size of the pool workers",
+        [("", {}, gauges["worker_rss_bytes"])] if "worker_rss_bytes" in gauges else [],
+    )
+    _metric(
+        lines,
+        "spool_pending_bytes",
+        "gauge",
+        "Size of the spool not yet sent to Elasticsearch",
+        (
+            [("", {}, gauges["spool_pending_bytes"])]
+            if "spool_pending_bytes" in gauges
+            else []
+        ),
+    )
+    _metric(
+        lines,
+        "main_rss_bytes",
+        "gauge",
+        "Resident set size of the main process",
+        [("", {}, metrics.rss_bytes())],
+    )
+    _metric(
+        lines,
+        "last_run_timestamp_seconds",
+        "gauge",
+        "End of the latest run of each pass",
+        [("", {"pass": name}, end) for name, (end, _) in sorted(passes.items())],
+    )
+    _metric(
+        lines,
+        "last_run_duration_seconds",
+        "gauge",
+        "Duration of the latest run of each pass",
+        [
+            ("", {"pass": name}, duration)
+            for name, (_, duration) in sorted(passes.items())
+        ],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(filename):
+    """Write the metrics for the node exporter, which wants atomic updates"""
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as fd:
+        fd.write(render())
+    os.replace(tmpname, filename)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(
+            "Metrics request from %s: " + format, self.address_string(), *args
+        )
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
+
+
+def start_http_server(port, address=""):
+    """Serve the metrics on http://address:port/metrics from a background thread"""
+    server = _Server((address, port), MetricsHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    )
+    thread.start()
+    logging.warning("Serving metrics on port %d", server.server_address[1])
+    return server
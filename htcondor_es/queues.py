@@ -3,115 +3,289 @@ Process the jobs in queue for given set of schedds.
 """
 
 import time
+import socket
+import collections
 import logging
 import resource
 import traceback
-import queue
 import multiprocessing
+import multiprocessing.pool
+import concurrent.futures
+from multiprocessing.connection import wait
 
 import htcondor
 
-from . import utils, convert
+from . import dedup, elastic, joblog, metrics, utils, convert
 
 
-class ListenAndBunch(multiprocessing.Process):
+class ListenAndBunch(object):
     """
-    Listens to incoming items on a queue and puts bunches of items
-    to an outgoing queue
-
-    n_expected is the expected number of agents writing to the
-    queue. Necessary for knowing when to shut down.
+    Listens to the pipes of the queue workers and yields the bunches
+    of documents they send, already serialized as bulk bodies.
+
+    Each message is a header line "<kind> <number of docs> <index>[,<index>...]"
+    followed by the body, where kind is "jobs" or "summary". An empty
+    message means the sender is done. A sender whose worker finished
+    without saying so (e.g. it crashed) is dropped once its pipe is drained.
+
+    Messages smaller than bunch_size docs (the last ones of each sender)
+    are held and joined with the next ones of the same kind. Nothing is
+    read while the consumer of bunches() is busy, the pipes then fill up
+    and block the workers on their next send.
     """
 
-    def __init__(
-        self,
-        input_queue,
-        output_queue,
-        n_expected,
-        start_time,
-        bunch_size=5000,
-        report_every=50000,
-    ):
-        super(ListenAndBunch, self).__init__()
-        self.input_queue = input_queue
-        self.output_queue = output_queue
+    def __init__(self, start_time, bunch_size=5000, report_every=50000):
+        self.start_time = start_time
         self.bunch_size = bunch_size
         self.report_every = report_every
-        self.num_expected = n_expected
-        self.start_time = start_time
-
-        self.buffer = []
-        self.tracker = []
-        self.n_processed = 0
-        self.count_in = 0  # number of added docs
-
-        self.start()
-
-    def run(self):
+        self.senders = {}
+        self.held = {}  # kind: deque of (indices, body, n_docs)
+
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.count_in = 0  # number of received job docs
+        self.count_summary = 0  # number of received summary docs
+        self.held_bytes = 0
+        self.max_held_bytes = 0
+        self.wait_time = 0  # waiting for the workers
+        self.blocked_time = 0  # waiting for the consumer
+
+    def add_sender(self, name, reader, future):
+        self.senders[reader] = (name, future)
+
+    def _drop(self, reader):
+        self.senders.pop(reader)
+        reader.close()
+
+    def _hold(self, kind, indices, body, n_docs):
+        """Hold a message, return its kind if there is a full bunch to take"""
+        chunks = self.held.setdefault(kind, collections.deque())
+        chunks.append((indices, body, n_docs))
+        self.held_bytes += len(body)
+        self.max_held_bytes = max(self.max_held_bytes, self.held_bytes)
+        if sum(chunk[2] for chunk in chunks) >= self.bunch_size:
+            return kind
+        return None
+
+    def _take(self, kind):
+        """Join the held messages of a kind into one bunch"""
+        chunks = self.held.pop(kind)
+        indices = set()
+        for chunk in chunks:
+            indices.update(chunk[0])
+        body = b"".join(chunk[1] for chunk in chunks)
+        self.held_bytes -= len(body)
+        return kind, sorted(indices), body, sum(chunk[2] for chunk in chunks)
+
+    def _yield(self, bunch):
+        yielded = time.time()
+        yield bunch
+        self.blocked_time += time.time() - yielded
+
+    def bunches(self):
+        """Yield (kind, indices, body, n_docs) until all senders are done"""
         since_last_report = 0
-        while True:
-            try:
-                next_batch = self.input_queue.get(
-                    timeout=utils.time_remaining(self.start_time - 5)
-                )
-            except queue.Empty:
+        while self.senders:
+            timeout = utils.time_remaining(self.start_time - 5)
+            if timeout <= 0:
                 logging.warning("Closing listener before all schedds were processed")
-                self.close()
-                return
+                break
 
-            if isinstance(next_batch, str):
-                schedd_name = str(next_batch)
+            waited = time.time()
+            ready = wait(list(self.senders), timeout=min(timeout, 5))
+            self.wait_time += time.time() - waited
+            for reader in ready:
                 try:
-                    # We were already processing this sender,
-                    # this is the signal that it's done sending.
-                    self.tracker.remove(schedd_name)
-                    self.n_processed += 1
-                except ValueError:
-                    # This is a new sender
-                    self.tracker.append(schedd_name)
-
-                if self.n_processed == self.num_expected:
-                    # We finished processing all expected senders.
-                    assert len(self.tracker) == 0
-                    self.close()
-                    return
+                    message = reader.recv_bytes()
+                except EOFError:
+                    message = b""
+                if not message:
+                    self._drop(reader)
+                    continue
+
+                header, _, body = message.partition(b"\n")
+                kind, n_docs, indices = header.decode().split()
+                n_docs = int(n_docs)
+                self.n_messages += 1
+                self.n_bytes += len(message)
+                if kind == "summary":
+                    self.count_summary += n_docs
+                else:
+                    self.count_in += n_docs
+                since_last_report += n_docs
+                if since_last_report > self.report_every:
+                    logging.debug(
+                        "Processed %d docs, holding %d bytes",
+                        self.count_in,
+                        self.held_bytes,
+                    )
+                    since_last_report = 0
+
+                if self._hold(kind, indices.split(","), body, n_docs):
+                    yield from self._yield(self._take(kind))
+
+            for reader, (name, future) in list(self.senders.items()):
+                if future.ready() and not reader.poll():
+                    logging.warning("Queue worker for %s exited without closing", name)
+                    self._drop(reader)
+
+        for reader in list(self.senders):
+            self._drop(reader)
+        for kind in list(self.held):
+            yield from self._yield(self._take(kind))
+
+        logging.warning(
+            "Closing listener, received %d job and %d summary documents total "
+            "in %d messages (%.1f MB); held at most %.1f MB; "
+            "waited %.2f min for the workers and %.2f min for the uploads",
+            self.count_in,
+            self.count_summary,
+            self.n_messages,
+            self.n_bytes / 1024.0 / 1024.0,
+            self.max_held_bytes / 1024.0 / 1024.0,
+            self.wait_time / 60.0,
+            self.blocked_time / 60.0,
+        )
 
-                continue
 
-            self.count_in += len(next_batch)
-            since_last_report += len(next_batch)
-            self.buffer.extend(next_batch)
+def send_bunch(conn, ad_list, metadata=None, kind="jobs", daemon=metrics.SHARED):
+    """
+    Serialize a bunch of (idx, id, ad) tuples and send it over conn,
+    returns the time spent waiting for the listener to read it
+    """
+    indices = ",".join(sorted(set(idx for idx, _, _ in ad_list)))
+    start = time.perf_counter()
+    body = elastic.make_routed_es_body(ad_list, metadata).encode()
+    metrics.observe(daemon, "serialize", time.perf_counter() - start)
+    header = "%s %d %s\n" % (kind, len(ad_list), indices)
+    sent = time.time()
+    conn.send_bytes(header.encode() + body)
+    waited = time.time() - sent
+    metrics.observe(daemon, "queue_wait", waited)
+    return waited
+
+
+SUMMARY_KEYS = ["Owner", "AccountingGroup", "Status"]
+SUMMARY_SUMS = ["RequestCpus", "RequestMemory", "RequestGpus", "CoreHr"]
+# Attributes of a job needed to compute its summary fields
+SUMMARY_INPUT_ATTRS = {
+    "CompletionDate",
+    "CpusProvisioned",
+    "EnteredCurrentStatus",
+    "GlobalJobId",
+    "JobStatus",
+    "QDate",
+    "RemoteWallClockTime",
+    "TaskType",
+}
+
+
+def queue_feeds(args):
+    """Return whether job documents and summary documents are made"""
+    if args.es_queue_profile == "summary-only":
+        return False, True
+    return bool(args.es_feed_schedd_queue), bool(args.es_feed_schedd_queue_summary)
+
+
+def queue_profile(args):
+    """
+    Return the projection of the queue query and the fields kept
+    of each converted job, None meaning all of them
+    """
+    summary_attrs = set(SUMMARY_KEYS + SUMMARY_SUMS) if queue_feeds(args)[1] else set()
+    if args.es_queue_profile == "summary-only":
+        return sorted(summary_attrs | SUMMARY_INPUT_ATTRS), summary_attrs
+    if args.es_queue_profile == "running-slim":
+        keep_attrs = convert.RUNNING_FIELDS | summary_attrs
+        return sorted(keep_attrs | convert.RUNNING_INPUT_ATTRS), keep_attrs
+    return None, None
+
+
+def job_keep_attrs(job_ad, keep_attrs, args):
+    """Return the fields kept of a job, running-slim only slims running, idle and held jobs"""
+    if args.es_queue_profile == "running-slim" and job_ad.get("JobStatus") not in (
+        1,
+        2,
+        5,
+    ):
+        return None
+    return keep_attrs
+
+
+def add_to_summary(summary, dict_ad):
+    """Add a converted job ad to the totals of its owner, group and status"""
+    key = tuple(dict_ad.get(attr) for attr in SUMMARY_KEYS)
+    totals = summary.get(key)
+    if totals is None:
+        totals = summary[key] = dict.fromkeys(["Jobs"] + SUMMARY_SUMS, 0)
+    totals["Jobs"] += 1
+    for attr in SUMMARY_SUMS:
+        value = dict_ad.get(attr)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            totals[attr] += value
+
+
+def make_summary_docs(summary, schedd_name, snapshot_time, idx):
+    """Return the (idx, id, doc) tuples of the summary of a schedd queue"""
+    docs = []
+    for key, totals in summary.items():
+        doc = dict(zip(SUMMARY_KEYS, key))
+        doc.update(totals)
+        doc["ScheddName"] = schedd_name
+        doc["SnapshotDate"] = snapshot_time
+        id_ = "#".join(
+            [schedd_name] + [str(value) for value in key] + [str(snapshot_time)]
+        )
+        docs.append((idx, id_, doc))
+    return docs
 
-            if since_last_report > self.report_every:
-                logging.debug("Processed %d docs", self.count_in)
-                since_last_report = 0
 
-            # If buffer is full, send the docs and clear the buffer
-            if len(self.buffer) >= self.bunch_size:
-                self.output_queue.put(
-                    self.buffer[: self.bunch_size],
-                    timeout=utils.time_remaining(self.start_time),
-                )
-                self.buffer = self.buffer[self.bunch_size :]
+# Kept between runs of a long running spider, so that each run only
+# reads what the schedd appended to the log since the previous one
+_JOBLOG = None
+
+
+def uses_joblog(schedd_ad, args):
+    """Tell whether the queue of this schedd is read from its job_queue.log"""
+    if not args.process_joblog_path:
+        return False
+    if args.process_joblog_schedd:
+        return schedd_ad["Name"] == args.process_joblog_schedd
+    return schedd_ad.get("Machine") == socket.getfqdn()
+
 
-    def close(self):
-        """Clear the buffer, send a poison pill and the total number of docs"""
-        if self.buffer:
-            self.output_queue.put(
-                self.buffer, timeout=utils.time_remaining(self.start_time)
+def joblog_ads(args, completed_since, with_unchanged=False, projection=None):
+    """
+    Yield (job_ad, changed) for the jobs that changed in the job_queue.log
+    since the previous call, or for all jobs if with_unchanged is set
+    """
+    global _JOBLOG
+    if _JOBLOG is None or _JOBLOG.path != args.process_joblog_path:
+        _JOBLOG = joblog.JobQueueLog(args.process_joblog_path)
+    changed = _JOBLOG.poll()
+
+    for job_id in _JOBLOG.jobs() if with_unchanged else changed:
+        try:
+            job_ad = _JOBLOG.job_ad(job_id, projection)
+        except Exception as e:
+            logging.warning(
+                "Failure when parsing job %s from the job queue log: %s", job_id, e
             )
-            self.buffer = []
-
-        logging.warning("Closing listener, received %d documents total", self.count_in)
-        # send back a poison pill
-        self.output_queue.put(None, timeout=utils.time_remaining(self.start_time))
-        # send the number of total docs
-        self.output_queue.put(
-            self.count_in, timeout=utils.time_remaining(self.start_time)
-        )
+            continue
+        # Same selection as the query of query_schedd_queue
+        if job_ad.get("JobStatus") in (3, 4):
+            if job_ad.get("EnteredCurrentStatus", 0) < completed_since:
+                continue
+        yield job_ad, job_id in changed
 
 
-def query_schedd_queue(starttime, schedd_ad, queue, args):
+def query_schedd_queue(starttime, schedd_ad, conn, args, metadata=None, sent_docs=None):
+    """
+    Query the queue of a schedd and send the documents of its jobs over
+    conn (see ListenAndBunch). Completed jobs whose documents are in
+    sent_docs (a dedup.BloomFilter) were just sent by the history pass
+    and are skipped.
+    """
     my_start = time.time()
     logging.info("Querying %s queue for jobs.", schedd_ad["Name"])
     if utils.time_remaining(starttime) < 10:
@@ -123,26 +297,60 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         utils.send_email_alert(
             args.email_alerts, "spider queue timeout warning", message
         )
+        conn.send_bytes(b"")
+        conn.close()
         return
 
     count_since_last_report = 0
     count = 0
+    n_skipped = 0
+    send_wait = 0
     cpu_usage = resource.getrusage(resource.RUSAGE_SELF).ru_utime
-    queue.put(schedd_ad["Name"], timeout=utils.time_remaining(starttime))
 
-    schedd = htcondor.Schedd(schedd_ad)
     sent_warnings = False
-    batch = []
+    ad_list = []
+    feed_jobs, feed_summary = queue_feeds(args)
+    summary = {} if feed_summary else None
+    projection, keep_attrs = queue_profile(args)
     # Query for a snapshot of the jobs running/idle/held,
     # but only the completed that had changed in the last period of time.
-    _completed_since = starttime - (utils.TIMEOUT_MINS + 1) * 60
+    _completed_since = dedup.recent_since(starttime, utils.TIMEOUT_MINS)
     query = f"(JobStatus < 3 || JobStatus > 4 || EnteredCurrentStatus >= {_completed_since:d})"
     try:
-        query_iter = schedd.xquery(requirements=query) if not args.dry_run else []
-        for job_ad in query_iter:
+        if args.dry_run:
+            query_iter = []
+        elif uses_joblog(schedd_ad, args):
+            # Only the changed jobs are sent, the summary needs them all
+            query_iter = joblog_ads(
+                args, _completed_since, summary is not None, projection
+            )
+        else:
+            schedd = htcondor.Schedd(schedd_ad)
+            query_iter = (
+                (job_ad, True)
+                for job_ad in schedd.xquery(
+                    requirements=query, projection=projection or []
+                )
+            )
+        for job_ad, changed in metrics.timed_iter(query_iter, schedd_ad["Name"]):
+            if sent_docs and changed and job_ad.get("JobStatus") in (3, 4):
+                if dedup.ad_in(sent_docs, job_ad):
+                    n_skipped += 1
+                    if summary is None:
+                        continue
+                    changed = False  # only needed for the summary
+
             dict_ad = None
             try:
-                dict_ad = convert.to_json(job_ad, return_dict=True)
+                start = time.perf_counter()
+                dict_ad = convert.to_json(
+                    job_ad,
+                    return_dict=True,
+                    keep_attrs=job_keep_attrs(job_ad, keep_attrs, args),
+                )
+                metrics.observe(
+                    schedd_ad["Name"], "convert", time.perf_counter() - start
+                )
             except Exception as e:
                 message = f"Failure when converting document on {schedd_ad['Name']} queue: {e}"
                 logging.warning(message)
@@ -157,11 +365,22 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
             if not dict_ad:
                 continue
 
-            batch.append((convert.unique_doc_id(dict_ad), dict_ad))
+            if summary is not None:
+                add_to_summary(summary, dict_ad)
+            if not changed:
+                continue
+
+            if feed_jobs:
+                idx = elastic.get_index(
+                    dict_ad.get(args.es_index_date_attr) or int(time.time()),
+                    template=args.es_index_name,
+                    update_es=False,
+                )
+                ad_list.append((idx, convert.unique_doc_id(dict_ad), dict_ad))
             count += 1
             count_since_last_report += 1
 
-            if not args.dry_run and len(batch) == args.es_bunch_size:
+            if not args.dry_run and count % args.es_bunch_size == 0:
                 if utils.time_remaining(starttime) < 10:
                     message = (
                         "Queue crawler on %s has been running for "
@@ -173,8 +392,11 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
                         args.email_alerts, "spider queue timeout warning", message
                     )
                     break
-                queue.put(batch, timeout=utils.time_remaining(starttime))
-                batch = []
+                if ad_list:
+                    send_wait += send_bunch(
+                        conn, ad_list, metadata, daemon=schedd_ad["Name"]
+                    )
+                    ad_list = []
                 if count_since_last_report >= 1000:
                     cpu_usage_now = resource.getrusage(resource.RUSAGE_SELF).ru_utime
                     cpu_usage = cpu_usage_now - cpu_usage
@@ -200,6 +422,8 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         logging.error(
             "Failed to query schedd %s for jobs: %s", schedd_ad["Name"], str(e)
         )
+    except BrokenPipeError:
+        pass  # the listener closed at its deadline, reported below
     except Exception as e:
         message = (
             f"Failure when processing schedd queue query on {schedd_ad['Name']}: {e}"
@@ -210,25 +434,48 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         )
         traceback.print_exc()
 
-    if batch:  # send remaining docs
-        queue.put(batch, timeout=utils.time_remaining(starttime))
-        batch = []
-
-    queue.put(schedd_ad["Name"], timeout=utils.time_remaining(starttime))
+    try:
+        if ad_list:  # send remaining docs
+            send_wait += send_bunch(conn, ad_list, metadata, daemon=schedd_ad["Name"])
+        if summary:
+            summary_idx = elastic.get_index(
+                starttime, template=args.es_summary_index_name, update_es=False
+            )
+            summary_docs = make_summary_docs(
+                summary, schedd_ad["Name"], int(starttime), summary_idx
+            )
+            send_wait += send_bunch(
+                conn, summary_docs, metadata, kind="summary", daemon=schedd_ad["Name"]
+            )
+        conn.send_bytes(b"")  # tell the listener we are done
+    except BrokenPipeError:
+        # See ListenAndBunch.bunches
+        logging.error(
+            "Listener closed before the queue of %s was sent", schedd_ad["Name"]
+        )
+    finally:
+        conn.close()
     total_time = (time.time() - my_start) / 60.0
     logging.warning(
-        "Schedd %-25s queue: response count: %5d; " "query time %.2f min; ",
+        "Schedd %-25s queue: response count: %5d; skipped %d sent by history; "
+        "query time %.2f min; send wait %.2f min",
         schedd_ad["Name"],
         count,
+        n_skipped,
         total_time,
+        send_wait / 60.0,
     )
 
     return count
 
 
-def process_queues(schedd_ads, starttime, pool, args, metadata=None):
+def process_queues(
+    schedd_ads, starttime, pool, args, metadata=None, sent_docs=None, owns_pool=True
+):
     """
-    Process all the jobs in all the schedds given.
+    Process all the jobs in all the schedds given, skipping the documents
+    in sent_docs (see query_schedd_queue). The pool is terminated on a
+    timeout unless it is shared with other passes (see process_histories).
     """
     my_start = time.time()
     if utils.time_remaining(starttime) < 10:
@@ -238,75 +485,131 @@ def process_queues(schedd_ads, starttime, pool, args, metadata=None):
     metadata = metadata or {}
     metadata["spider_source"] = "condor_queue"
 
-    mp_manager = multiprocessing.Manager()
-    input_queue = mp_manager.Queue()
-    output_queue = mp_manager.Queue()
-    listener = ListenAndBunch(
-        input_queue=input_queue,
-        output_queue=output_queue,
-        n_expected=len(schedd_ads),
-        start_time=starttime,
-    )
+    # Each worker writes its serialized bunches to its own pipe,
+    # read by the listener in this process
+    listener = ListenAndBunch(start_time=starttime, bunch_size=args.es_bunch_size)
     futures = []
-
-    upload_pool = multiprocessing.Pool(processes=args.process_parallel_queries)
+    writers = []
+    # The job queue log is followed from a thread of this process,
+    # where its job table lives between runs
+    joblog_pool = None
 
     for schedd_ad in schedd_ads:
-        future = pool.apply_async(
-            query_schedd_queue, args=(starttime, schedd_ad, input_queue, args)
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        runner = pool
+        if uses_joblog(schedd_ad, args):
+            joblog_pool = joblog_pool or multiprocessing.pool.ThreadPool(1)
+            runner = joblog_pool
+        future = runner.apply_async(
+            metrics.run_instrumented,
+            args=(
+                schedd_ad["Name"],
+                query_schedd_queue,
+                starttime,
+                schedd_ad,
+                writer,
+                args,
+                metadata,
+                sent_docs,
+            ),
         )
+        listener.add_sender(schedd_ad["Name"], reader, future)
+        writers.append(writer)
         futures.append((schedd_ad["Name"], future))
 
-    total_processed = 0
-    while True:
-        if args.dry_run or len(schedd_ads) == 0:
-            break
-
-        if utils.time_remaining(starttime) < 5:
-            logging.warning("Listener did not shut down properly; terminating.")
-            listener.terminate()
-            break
+    # The bodies are uploaded from threads of this process, with at most
+    # es_upload_buffer_mb of them in flight so that a slow ES pauses
+    # the reading of the pipes (and thus the workers)
+    update_es = any(queue_feeds(args)) and not args.read_only
+    uploads = {}  # future: (kind, number of docs, size)
+    upload_stats = {"sent": 0, "sent_summary": 0, "failed": 0, "upload_time": 0}
+    max_in_flight = args.es_upload_buffer_mb * 1024 * 1024
+    in_flight = {"bytes": 0, "max_bytes": 0}
+
+    def _collect(done):
+        for upload in done:
+            kind, n_docs, size = uploads.pop(upload)
+            in_flight["bytes"] -= size
+            try:
+                n_sent, upload_time = upload.result()
+            except Exception as e:
+                upload_stats["failed"] += n_docs
+                message = f"Failure when uploading {n_docs} queue documents: {e}"
+                logging.error(message)
+                if upload_stats["failed"] == n_docs:
+                    utils.send_email_alert(
+                        args.email_alerts, "spider queue upload error", message
+                    )
+                continue
+            upload_stats["sent_summary" if kind == "summary" else "sent"] += n_sent
+            upload_stats["failed"] += n_docs - n_sent
+            upload_stats["upload_time"] += upload_time
+
+    executor = None
+    if update_es:
+        es = elastic.get_server_handle(args).handle
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.es_upload_workers
+        )
 
-        bunch = output_queue.get(timeout=utils.time_remaining(starttime))
-        if bunch is None:  # swallow the poison pill
-            total_processed = int(
-                output_queue.get(timeout=utils.time_remaining(starttime))
+    out_of_time = False
+    for kind, indices, body, n_docs in listener.bunches():
+        if not update_es:
+            continue
+        if out_of_time:
+            # Past its deadline the listener reads no more messages,
+            # the bunches it still holds are not sent
+            upload_stats["failed"] += n_docs
+            continue
+
+        for idx in indices:
+            if kind == "summary":
+                elastic.ensure_index(
+                    idx, template=args.es_summary_index_name, kind=kind
+                )
+            else:
+                elastic.ensure_index(idx, template=args.es_index_name)
+        while uploads and in_flight["bytes"] + len(body) > max_in_flight:
+            done, _ = concurrent.futures.wait(
+                uploads,
+                timeout=utils.time_remaining(starttime),
+                return_when=concurrent.futures.FIRST_COMPLETED,
             )
-            break
-
-        if args.es_feed_schedd_queue and not args.read_only:
-            ## Note that these bunches are sized according to --amq_bunch_size
-            ## FIXME: Why are we determining the index from one ad?
-            idx = htcondor_es.es.get_index(
-                bunch[0][1].get(args.es_index_date_attr, int(time.time())),
-                template=args.es_index_name,
-                update_es=(args.es_feed_schedd_queue and not args.read_only),
+            if not done:
+                break
+            _collect(done)
+        if uploads and in_flight["bytes"] + len(body) > max_in_flight:
+            message = (
+                f"Out of time with {in_flight['bytes'] / 1024.0 / 1024.0:.1f} MB "
+                "of queue uploads in flight; not sending the remaining documents."
             )
-
-            future = upload_pool.apply_async(
-                htcondor_es.es.post_ads_nohandle, args=(idx, bunch, args, metadata)
+            logging.error(message)
+            utils.send_email_alert(
+                args.email_alerts, "spider queue upload timeout warning", message
             )
-            futures.append(("UPLOADER_ES", future))
-
-        logging.info("Starting new uploader, %d items in queue" % output_queue.qsize())
-
-    listener.join()
+            out_of_time = True
+            upload_stats["failed"] += n_docs
+            continue
+        upload = executor.submit(elastic.post_routed_body, es, body, n_docs)
+        uploads[upload] = (kind, n_docs, len(body))
+        in_flight["bytes"] += len(body)
+        in_flight["max_bytes"] = max(in_flight["max_bytes"], in_flight["bytes"])
+
+    for writer in writers:
+        writer.close()
+    total_processed = listener.count_in
 
     timed_out = False
-    total_sent = 0
-    total_upload_time = 0
     total_queried = 0
     for name, future in futures:
         if utils.time_remaining(starttime, positive=False) > -20:
             try:
-                count = future.get(utils.time_remaining(starttime) + 10)
-                if name == "UPLOADER_ES":
-                    total_sent += count
-                else:
-                    try:
-                        total_queried += count
-                    except TypeError:
-                        pass
+                count, recorded = future.get(utils.time_remaining(starttime) + 10)
+                metrics.merge(recorded)
+                try:
+                    total_queried += count
+                except TypeError:
+                    pass
             except multiprocessing.TimeoutError:
                 message = "Schedd %s queue timed out; ignoring progress." % name
                 logging.error(message)
@@ -318,21 +621,44 @@ def process_queues(schedd_ads, starttime, pool, args, metadata=None):
             break
 
     if timed_out:
-        logging.error("Timed out when retrieving uploaders. Upload count incomplete.")
-        pool.terminate()
-        upload_pool.terminate()
+        logging.error("Timed out when retrieving queue crawlers.")
+        if owns_pool:
+            pool.terminate()
+    if joblog_pool:
+        joblog_pool.close()
+
+    # Uploads get their own deadline, on top of the one of the queries
+    if executor:
+        done, _ = concurrent.futures.wait(
+            uploads, timeout=utils.time_remaining(starttime) + 10
+        )
+        _collect(done)
+        if uploads:
+            n_pending = sum(n_docs for _, n_docs, _ in uploads.values())
+            message = (
+                f"Timed out with {len(uploads)} queue uploads ({n_pending} docs) "
+                "in flight. Upload count incomplete."
+            )
+            logging.error(message)
+            utils.send_email_alert(
+                args.email_alerts, "spider queue upload timeout warning", message
+            )
+            for upload in uploads:
+                upload.cancel()
+        executor.shutdown(wait=False)
 
-    if not total_queried == total_processed:
+    if queue_feeds(args)[0] and not total_queried == total_processed:
         logging.warning("Number of queried docs not equal to number of processed docs.")
 
     logging.warning(
-        "Processing time for queues: %.2f mins, %d/%d docs sent in %.2f min "
-        "of total upload time",
+        "Processing time for queues: %.2f mins, %d/%d docs and %d summary docs "
+        "sent in %.2f min of total upload time, %d docs failed, "
+        "at most %.1f MB in flight",
         (time.time() - my_start) / 60.0,
-        total_sent,
+        upload_stats["sent"],
         total_queried,
-        total_upload_time / 60.0,
+        upload_stats["sent_summary"],
+        upload_stats["upload_time"] / 60.0,
+        upload_stats["failed"],
+        in_flight["max_bytes"] / 1024.0 / 1024.0,
     )
-
-    upload_pool.close()
-    upload_pool.join()
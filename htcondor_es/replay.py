@@ -0,0 +1,269 @@
+"""
+Recording of the raw job ads of the pool, and replay of the recordings
+through the conversion and upload pipeline of the spider.
+
+A recording is a directory of gzip compressed chunks of job ads in the
+old ClassAd format (separated by blank lines), one file per chunk:
+
+    <output>/<kind>/<daemon>.<n>.ads.gz
+
+with kind one of schedd_history, schedd_queue and startd_history, and a
+manifest.json listing the chunks. Unlike pickles, the files do not
+depend on the version of the bindings and can be read with condor_q -file.
+
+Replaying converts the chunks in the worker pool and uploads them from
+the main process as fast as Elasticsearch takes them, which gives
+production shaped workloads for benchmarks, or re-converts the jobs
+after a change of the converter without querying the daemons again.
+"""
+
+import os
+import gzip
+import json
+import time
+import logging
+import traceback
+import collections
+import concurrent.futures
+
+import classad
+import htcondor
+
+from . import elastic, metrics, utils
+from .history import convert_chunk
+
+KINDS = ["schedd_history", "schedd_queue", "startd_history"]
+
+MANIFEST = "manifest.json"
+
+
+def chunk_filename(output, kind, daemon, n):
+    daemon = "".join(c if c.isalnum() or c in "-_.@" else "_" for c in daemon)
+    return os.path.join(output, kind, "%s.%d.ads.gz" % (daemon, n))
+
+
+def daemon_name(kind, daemon_ad):
+    return daemon_ad["Machine"] if kind == "startd_history" else daemon_ad["Name"]
+
+
+def query_daemon(kind, daemon_ad, since, args):
+    """Return the job ads of a daemon that entered their status since"""
+    if args.dry_run:
+        return []
+    if kind == "schedd_queue":
+        query = f"(JobStatus < 3 || JobStatus > 4 || EnteredCurrentStatus >= {since:d})"
+        return htcondor.Schedd(daemon_ad).xquery(requirements=query, projection=[])
+    query = classad.ExprTree(f"( EnteredCurrentStatus >= {since:d} )")
+    if kind == "schedd_history":
+        return htcondor.Schedd(daemon_ad).history(
+            query, [], args.process_max_documents or -1
+        )
+    return htcondor.Startd(daemon_ad).history(query, [])
+
+
+def record_daemon(kind, daemon_ad, since, args):
+    """
+    Write the job ads of a daemon to chunks of args.record_chunk_size
+    ads and return their manifest entries
+    """
+    daemon = daemon_name(kind, daemon_ad)
+    entries = []
+    chunk = []
+    count = 0
+
+    def _write_chunk():
+        filename = chunk_filename(args.record_output, kind, daemon, len(entries))
+        with gzip.open(filename, "wt") as fd:
+            fd.write("\n".join(chunk))
+        entries.append(
+            {
+                "file": os.path.relpath(filename, args.record_output),
+                "kind": kind,
+                "daemon": daemon,
+                "count": len(chunk),
+            }
+        )
+
+    try:
+        for job_ad in metrics.timed_iter(
+            query_daemon(kind, daemon_ad, since, args), daemon
+        ):
+            chunk.append(job_ad.printOld())
+            count += 1
+            if len(chunk) == args.record_chunk_size:
+                _write_chunk()
+                chunk = []
+            if args.process_max_documents and count >= args.process_max_documents:
+                break
+    except RuntimeError:
+        logging.error(
+            "Failed to query %s for the %s:\n%s",
+            daemon,
+            kind.replace("_", " "),
+            traceback.format_exc(),
+        )
+    if chunk:
+        _write_chunk()
+    logging.warning(
+        "Recorded %d ads of the %s of %s", count, kind.replace("_", " "), daemon
+    )
+    return entries
+
+
+def record(daemons, pool, args):
+    """
+    Record the job ads of the given [(kind, daemon ads)] in the pool
+    and write the manifest, return the number of ads recorded
+    """
+    starttime = time.time()
+    since = int(starttime - args.record_since_hours * 3600)
+    for kind, _ in daemons:
+        os.makedirs(os.path.join(args.record_output, kind), exist_ok=True)
+
+    futures = []
+    for kind, ads in daemons:
+        for ad in ads:
+            daemon = daemon_name(kind, ad)
+            future = pool.apply_async(
+                metrics.run_instrumented, (daemon, record_daemon, kind, ad, since, args)
+            )
+            futures.append((kind, daemon, future))
+    files = []
+    for kind, daemon, future in futures:
+        try:
+            entries, recorded = future.get()
+        except Exception:
+            logging.exception(
+                "Failed to record the %s of %s", kind.replace("_", " "), daemon
+            )
+            continue
+        metrics.merge(recorded)
+        files.extend(entries)
+
+    manifest = {
+        "recorded": int(starttime),
+        "since": since,
+        "spider_hostname": utils.collect_metadata()["spider_hostname"],
+        "files": files,
+    }
+    with open(os.path.join(args.record_output, MANIFEST), "w") as fd:
+        json.dump(manifest, fd, indent=4)
+    count = sum(entry["count"] for entry in files)
+    logging.warning(
+        "Recorded %d ads in %d chunks to %s in %.2f mins",
+        count,
+        len(files),
+        args.record_output,
+        (time.time() - starttime) / 60.0,
+    )
+    return count
+
+
+def replay_chunk(filename, kind, args, metadata, daemon):
+    """Read and convert a recorded chunk, runs in a pool worker"""
+    start = time.perf_counter()
+    with gzip.open(filename, "rt") as fd:
+        chunk = fd.read()
+    metrics.observe(daemon, "query_wait", time.perf_counter() - start)
+    return convert_chunk(chunk, args, metadata, daemon, queue=kind == "schedd_queue")
+
+
+def replay(pool, args, metadata=None):
+    """
+    Convert the recorded chunks in the pool (args.replay_repeat times)
+    and upload them, return the number of documents converted
+    """
+    starttime = time.time()
+    with open(os.path.join(args.replay_input, MANIFEST), "r") as fd:
+        manifest = json.load(fd)
+    entries = manifest["files"] * max(1, args.replay_repeat)
+    logging.warning(
+        "Replaying %d chunks of %d ads recorded on %s",
+        len(entries),
+        sum(entry["count"] for entry in entries),
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest["recorded"])),
+    )
+
+    sources = {}
+    for kind in KINDS:
+        sources[kind] = dict(metadata or {})
+        sources[kind]["spider_source"] = (
+            "condor_queue" if kind == "schedd_queue" else "condor_history"
+        )
+
+    update_es = not args.read_only
+    if update_es:
+        es = elastic.get_server_handle(args).handle
+    sink = None
+    if args.parquet_dir and update_es:
+        from . import parquet
+
+        sink = parquet.make_sink(args)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, args.es_upload_workers)
+    )
+    uploads = set()
+    in_flight = collections.deque()
+    max_in_flight = max(1, args.process_fanout_max_chunks)
+    progress = {"count": 0, "n_failed": 0, "n_rejected": 0}
+
+    def _finish_uploads(n_pending):
+        nonlocal uploads
+        while len(uploads) > n_pending:
+            done, uploads = concurrent.futures.wait(
+                uploads, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                progress["n_rejected"] += future.result() or 0
+
+    def _finish_chunk():
+        daemon, future = in_flight.popleft()
+        try:
+            result, recorded = future.get()
+        except Exception:
+            logging.exception("Failed to convert a chunk of %s", daemon)
+            return
+        metrics.merge(recorded)
+        progress["count"] += result["count"]
+        progress["n_failed"] += result["n_failed"]
+        for idx, _, body in result["bunches"]:
+            if update_es:
+                elastic.ensure_index(idx, template=args.es_index_name)
+                uploads.add(
+                    executor.submit(elastic.post_body, es, idx, body, daemon=daemon)
+                )
+        for idx, table in result["tables"]:
+            if sink:
+                sink.write_table(idx, table, daemon)
+        # Keep the converted bodies from piling up in memory
+        _finish_uploads(2 * max(1, args.es_upload_workers))
+
+    try:
+        for entry in entries:
+            filename = os.path.join(args.replay_input, entry["file"])
+            kind, daemon = entry["kind"], entry["daemon"]
+            future = pool.apply_async(
+                metrics.run_instrumented,
+                (daemon, replay_chunk, filename, kind, args, sources[kind], daemon),
+            )
+            in_flight.append((daemon, future))
+            while len(in_flight) >= max_in_flight:
+                _finish_chunk()
+        while in_flight:
+            _finish_chunk()
+        _finish_uploads(0)
+    finally:
+        executor.shutdown()
+        if sink:
+            sink.close()
+
+    elapsed = max(time.time() - starttime, 1e-3)
+    logging.warning(
+        "Replayed %d documents in %.1f s (%.0f docs/s), %d failed to convert, %d not indexed",
+        progress["count"],
+        elapsed,
+        progress["count"] / elapsed,
+        progress["n_failed"],
+        progress["n_rejected"],
+    )
+    return progress["count"]
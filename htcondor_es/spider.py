@@ -7,9 +7,49 @@ import time
 import signal
 import logging
 import argparse
+import importlib.util
+import threading
 import multiprocessing
 
-from . import history, queues, utils
+from . import metrics, profiling, utils
+
+
+def report_run(starttime, passes, args):
+    """
+    Write the report of the metrics recorded since starttime and,
+    with --es_feed_run_report, send it to the run report indices.
+    Also hand the metrics over to the Prometheus exporter if enabled.
+    """
+    if args.es_spool_dir:
+        from . import spool
+
+        metrics.gauge_max("spool_pending_bytes", spool.pending_bytes(args.es_spool_dir))
+    recorded = metrics.snapshot()
+    report = metrics.make_report(starttime, passes, recorded)
+    if args.process_metrics_textfile or args.daemon_metrics_port:
+        from . import prometheus
+
+        prometheus.update(report, recorded)
+        if args.process_metrics_textfile:
+            try:
+                prometheus.write_textfile(args.process_metrics_textfile)
+            except OSError as e:
+                logging.warning("Failed to write the Prometheus metrics: %s", e)
+    if args.process_run_report:
+        try:
+            metrics.write_report(report, args.process_run_report)
+        except OSError as e:
+            logging.warning("Failed to write the run report: %s", e)
+    if args.es_feed_run_report and not args.read_only:
+        from . import elastic
+
+        try:
+            idx = elastic.get_index(starttime, template=args.es_run_report_index_name, update_es=False)
+            docs = [(idx, id_, doc) for id_, doc in metrics.report_docs(report)]
+            es = elastic.get_server_handle(args).handle
+            elastic.post_routed_body(es, elastic.make_routed_es_body(docs), len(docs))
+        except Exception as e:
+            logging.warning("Failed to send the run report to Elasticsearch: %s", e)
 
 
 def main_driver(args):
@@ -18,8 +58,16 @@ def main_driver(args):
     """
     starttime = time.time()
 
+    utils.set_timeout_mins(args.process_timeout_mins)
     signal.alarm(utils.TIMEOUT_MINS * 60 + 60)
 
+    # Only load the modules of the enabled passes, before the pool is started
+    if args.process_schedd_history or args.process_startd_history:
+        from . import history
+    if args.process_schedd_queue:
+        from . import queues
+    from . import dedup
+
     # Get all the schedd ads
     if args.process_schedd_history or args.process_schedd_queue:
         schedd_ads = []
@@ -32,7 +80,17 @@ def main_driver(args):
         startd_ads = utils.get_startds(args)
         logging.warning("&&& There are %d startds to query.", len(startd_ads))
 
-    with multiprocessing.Pool(processes=args.process_parallel_queries, maxtasksperchild=1) as pool:
+    # Ids of the recently completed jobs sent by the history pass,
+    # which the queue pass would send again
+    sent_docs = None
+    if args.process_schedd_history and args.process_schedd_queue and args.process_dedup_capacity:
+        sent_docs = dedup.BloomFilter(args.process_dedup_capacity)
+
+    # Before the pool, which must not fork while a forwarder thread holds a lock
+    forwarder = start_forwarder(args)
+    with multiprocessing.Pool(
+        processes=args.process_parallel_queries, maxtasksperchild=1, initializer=metrics.reset
+    ) as pool:
         metadata = utils.collect_metadata()
 
         if args.process_schedd_history:
@@ -42,6 +100,7 @@ def main_driver(args):
                 pool=pool,
                 args=args,
                 metadata=metadata,
+                sent_docs=sent_docs,
             )
 
         # Now that we have the fresh history, process the queues themselves.
@@ -52,6 +111,7 @@ def main_driver(args):
                 pool=pool,
                 args=args,
                 metadata=metadata,
+                sent_docs=sent_docs,
             )
 
         if args.process_startd_history:
@@ -63,10 +123,327 @@ def main_driver(args):
                 metadata=metadata,
             )
 
+    if forwarder is not None:
+        forwarder.stop(drain=True, timeout=utils.time_remaining(starttime))
+
+    report_run(
+        starttime,
+        [
+            name
+            for name, enabled in [
+                ("schedd history", args.process_schedd_history),
+                ("schedd queue", args.process_schedd_queue),
+                ("startd history", args.process_startd_history),
+            ]
+            if enabled
+        ],
+        args,
+    )
+    logging.warning(
+        "@@@ Total processing time: %.2f mins", ((time.time() - starttime) / 60.0)
+    )
+
+    return 0
+
+
+def reset_worker_signals():
+    """
+    Give the workers of the daemon pool back the default handlers,
+    so that Pool.terminate() still stops them, and their own metrics
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    metrics.reset()
+
+
+def daemon_driver(args):
+    """
+    Driver method for the daemon mode of the spider script.
+
+    The Schedd history, Schedd queue and Startd history passes run on
+    their own intervals in one long-lived process, sharing the worker
+    pool, the ES connection and index cache and the located daemons,
+    until SIGTERM or SIGINT.
+    """
+    stop = threading.Event()
+
+    # Only load the modules of the enabled passes, before the pool is started
+    if args.process_schedd_history or args.process_startd_history:
+        from . import history
+    if args.process_schedd_queue:
+        from . import queues
+    from . import dedup
+
+    def _stop(signum, frame):
+        logging.warning("Received signal %d, stopping after the current pass", signum)
+        stop.set()
+
+    utils.set_timeout_mins(args.process_timeout_mins)
+
+    located = {}
+
+    def _located(kind, get_ads):
+        # Locate the daemons again once the collector results are too old
+        found_at, ads = located.get(kind, (0, []))
+        if time.time() - found_at > args.daemon_collector_refresh_mins * 60 or not ads:
+            try:
+                ads = get_ads(args)
+                found_at = time.time()
+                logging.warning("&&& There are %d %ss to query.", len(ads), kind)
+            except Exception as exn:
+                logging.error("Failed to locate the %ss, using the previous list: %s", kind, exn)
+            located[kind] = (found_at, ads)
+        return ads
+
+    # Ids of the recently completed jobs sent by the history passes,
+    # which the queue passes would send again
+    sent_docs = None
+    if args.process_schedd_history and args.process_schedd_queue and args.process_dedup_capacity:
+        sent_docs = dedup.RotatingBloomFilter(args.process_dedup_capacity)
+
+    def _schedd_history(starttime, pool, metadata):
+        history.process_histories(
+            schedd_ads=_located("schedd", utils.get_schedds),
+            starttime=starttime,
+            pool=pool,
+            args=args,
+            metadata=metadata,
+            sent_docs=sent_docs,
+            owns_pool=False,
+        )
+
+    def _schedd_queue(starttime, pool, metadata):
+        queues.process_queues(
+            schedd_ads=_located("schedd", utils.get_schedds),
+            starttime=starttime,
+            pool=pool,
+            args=args,
+            metadata=metadata,
+            sent_docs=sent_docs,
+            owns_pool=False,
+        )
+
+    def _startd_history(starttime, pool, metadata):
+        history.process_histories(
+            startd_ads=_located("startd", utils.get_startds),
+            starttime=starttime,
+            pool=pool,
+            args=args,
+            metadata=metadata,
+            owns_pool=False,
+        )
+
+    passes = {}
+    if args.process_schedd_history:
+        passes["schedd history"] = (args.daemon_history_interval_mins, _schedd_history)
+    if args.process_schedd_queue:
+        passes["schedd queue"] = (args.daemon_queue_interval_mins, _schedd_queue)
+    if args.process_startd_history:
+        passes["startd history"] = (args.daemon_startd_interval_mins, _startd_history)
+    if not passes:
+        logging.error("Nothing to do, enable at least one of the history or queue passes")
+        return 1
+
+    # Before the pool, which must not fork while a forwarder thread holds a lock
+    forwarder = start_forwarder(args)
+    with multiprocessing.Pool(
+        processes=args.process_parallel_queries,
+        maxtasksperchild=args.daemon_worker_tasks or None,
+        initializer=reset_worker_signals,
+    ) as pool:
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+
+        server = None
+        if args.daemon_metrics_port:
+            from . import prometheus
+
+            server = prometheus.start_http_server(args.daemon_metrics_port)
+
+        # Passes run one at a time, those that are due at the same time in
+        # the order above, so that the queue pass skips what the history
+        # pass just sent. A long pass delays the others.
+        next_run = {name: time.time() for name in passes}
+        idle_start = time.time()
+        while not stop.is_set():
+            name = min(next_run, key=next_run.get)
+            if stop.wait(max(0, next_run[name] - time.time())):
+                break
+            interval, run_pass = passes[name]
+            if forwarder is not None:
+                # What the forwarder sent since the previous pass
+                forwarder.collect()
+                report_run(idle_start, ["forward"], args)
+            starttime = time.time()
+            metrics.reset()
+            try:
+                run_pass(starttime, pool, utils.collect_metadata())
+            except Exception as exn:
+                message = f"Failure in the {name} pass: {str(exn)}"
+                logging.exception(message)
+                utils.send_email_alert(args.email_alerts, "spider daemon pass error", message)
+            report_run(starttime, [name], args)
+            next_run[name] = starttime + interval * 60
+            logging.warning(
+                "@@@ Processing time for %s pass: %.2f mins, next one in %.1f mins",
+                name,
+                (time.time() - starttime) / 60.0,
+                max(0, next_run[name] - time.time()) / 60.0,
+            )
+            idle_start = time.time()
+            metrics.reset()
+        if server is not None:
+            server.shutdown()
+        if forwarder is not None:
+            # What is left is sent once the daemon is started again
+            forwarder.stop()
+
+    logging.warning("@@@ Spider daemon stopped")
+    return 0
+
+
+def backfill_driver(args):
+    """
+    Driver method for the backfill mode of the spider script.
+
+    There is no global timeout, an interrupted backfill is
+    resumed from the manifest on the next invocation.
+    """
+    from . import backfill
+
+    starttime = time.time()
+
+    start = backfill.parse_date(args.backfill_from)
+    end = backfill.parse_date(args.backfill_to) if args.backfill_to else int(starttime)
+    if end <= start:
+        logging.error("Nothing to backfill, --to must be later than --from")
+        return 1
+
+    schedd_ads = utils.get_schedds(args)
+    logging.warning("&&& There are %d schedds to backfill.", len(schedd_ads))
+
+    with multiprocessing.Pool(
+        processes=args.process_parallel_queries, maxtasksperchild=1, initializer=metrics.reset
+    ) as pool:
+        metadata = utils.collect_metadata()
+        success = backfill.process_backfill(
+            schedd_ads=schedd_ads,
+            start=start,
+            end=end,
+            pool=pool,
+            args=args,
+            metadata=metadata,
+        )
+
     logging.warning(
         "@@@ Total processing time: %.2f mins", ((time.time() - starttime) / 60.0)
     )
 
+    return 0 if success else 1
+
+
+def start_forwarder(args):
+    """Return the started spool forwarder process, None without a spool"""
+    if not args.es_spool_dir or args.read_only:
+        return None
+    from . import spool
+
+    forwarder = spool.ForwarderProcess(args)
+    forwarder.start()
+    return forwarder
+
+
+def forward_driver(args):
+    """
+    Driver method for the forward mode of the spider script,
+    sending the spool to ES for the spiders writing to it.
+    """
+    if not args.es_spool_dir:
+        logging.error("Nothing to forward, set the spool directory with --es_spool_dir")
+        return 1
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        logging.warning("Received signal %d, stopping the forwarder", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    if args.read_only:
+        return 0
+    from . import spool
+
+    # Nothing else runs here, the forwarder is a thread of this process
+    forwarder = spool.Forwarder(args)
+    forwarder.start()
+    starttime = time.time()
+    if args.forward_once:
+        forwarder.draining.set()
+    while forwarder.thread.is_alive() and not stop.wait(1):
+        pass
+    emptied = forwarder.stop()
+    report_run(starttime, ["forward"], args)
+    logging.warning(
+        "@@@ Forwarded %d docs in %.2f mins", forwarder.n_docs, (time.time() - starttime) / 60.0
+    )
+    return 0 if emptied or not args.forward_once else 1
+
+
+def record_driver(args):
+    """
+    Driver method for the record mode of the spider script,
+    saving the raw job ads of the enabled passes to args.record_output.
+    """
+    from . import replay
+
+    starttime = time.time()
+
+    daemons = []
+    if args.process_schedd_history or args.process_schedd_queue:
+        schedd_ads = utils.get_schedds(args)
+        logging.warning("&&& There are %d schedds to record.", len(schedd_ads))
+        if args.process_schedd_history:
+            daemons.append(("schedd_history", schedd_ads))
+        if args.process_schedd_queue:
+            daemons.append(("schedd_queue", schedd_ads))
+    if args.process_startd_history:
+        startd_ads = utils.get_startds(args)
+        logging.warning("&&& There are %d startds to record.", len(startd_ads))
+        daemons.append(("startd_history", startd_ads))
+    if not daemons:
+        logging.error("Nothing to record, enable at least one pass with --process_*")
+        return 1
+
+    with multiprocessing.Pool(
+        processes=args.process_parallel_queries, maxtasksperchild=1, initializer=metrics.reset
+    ) as pool:
+        replay.record(daemons, pool, args)
+
+    logging.warning(
+        "@@@ Total processing time: %.2f mins", ((time.time() - starttime) / 60.0)
+    )
+    return 0
+
+
+def replay_driver(args):
+    """
+    Driver method for the replay mode of the spider script,
+    converting and uploading the job ads saved by the record mode.
+    """
+    from . import replay
+
+    starttime = time.time()
+
+    with multiprocessing.Pool(
+        processes=args.process_parallel_queries, initializer=metrics.reset
+    ) as pool:
+        replay.replay(pool, args, metadata=utils.collect_metadata())
+
+    report_run(starttime, ["replay"], args)
+    logging.warning(
+        "@@@ Total processing time: %.2f mins", ((time.time() - starttime) / 60.0)
+    )
     return 0
 
 
@@ -107,10 +484,47 @@ def main():
             "[default is to process all Startds located by Collectors]"
         ),
     )
+    parser.add_argument(
+        "--process_collector_cache",
+        dest="process_collector_cache",
+        help=(
+            "File caching the Schedds and Startds located by each Collector "
+            f"[default: {defaults['process_collector_cache']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_collector_cache_ttl_mins",
+        type=int,
+        dest="process_collector_cache_ttl_mins",
+        help=(
+            "Minutes after which the cached answer of a Collector is refreshed, "
+            "0 to query the Collectors every time "
+            f"[default: {defaults['process_collector_cache_ttl_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_run_report",
+        dest="process_run_report",
+        help=(
+            "File the JSON report of the counters and latencies of each run "
+            "is written to, empty to not write it "
+            f"[default: {defaults['process_run_report']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_metrics_textfile",
+        dest="process_metrics_textfile",
+        help=(
+            "Write the Prometheus metrics to this file at the end of each run, "
+            "for the node exporter textfile collector (e.g. "
+            "/var/lib/node_exporter/textfile/htcondor_spider.prom) "
+            f"[default: {defaults['process_metrics_textfile']}]"
+        ),
+    )
     parser.add_argument(
         "--process_schedd_history",
         action="store_const",
-        const=False,
+        const=True,
         dest="process_schedd_history",
         help="Process Schedd history"
     )
@@ -128,6 +542,70 @@ def main():
         dest="process_startd_history",
         help="Process Startd history"
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_const",
+        const=True,
+        dest="daemon",
+        help=(
+            "Keep running and repeat the enabled passes on the intervals "
+            "of the [DAEMON] section, until SIGTERM or SIGINT"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_history_interval_mins",
+        type=int,
+        dest="daemon_history_interval_mins",
+        help=(
+            "Minutes between the starts of the Schedd history passes in daemon mode "
+            f"[default: {defaults['daemon_history_interval_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_queue_interval_mins",
+        type=int,
+        dest="daemon_queue_interval_mins",
+        help=(
+            "Minutes between the starts of the Schedd queue passes in daemon mode "
+            f"[default: {defaults['daemon_queue_interval_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_startd_interval_mins",
+        type=int,
+        dest="daemon_startd_interval_mins",
+        help=(
+            "Minutes between the starts of the Startd history passes in daemon mode "
+            f"[default: {defaults['daemon_startd_interval_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_collector_refresh_mins",
+        type=int,
+        dest="daemon_collector_refresh_mins",
+        help=(
+            "Minutes after which the Schedds and Startds are located again in daemon mode "
+            f"[default: {defaults['daemon_collector_refresh_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_worker_tasks",
+        type=int,
+        dest="daemon_worker_tasks",
+        help=(
+            "Replace the workers of the pool after this many tasks in daemon mode, "
+            f"0 to keep them [default: {defaults['daemon_worker_tasks']}]"
+        ),
+    )
+    parser.add_argument(
+        "--daemon_metrics_port",
+        type=int,
+        dest="daemon_metrics_port",
+        help=(
+            "Serve Prometheus metrics on this port (/metrics) in daemon mode, "
+            f"0 to not serve them [default: {defaults['daemon_metrics_port']}]"
+        ),
+    )
     parser.add_argument(
         "--process_max_documents",
         type=int,
@@ -146,6 +624,125 @@ def main():
             f"[default: {defaults['process_parallel_queries']}]"
         ),
     )
+    parser.add_argument(
+        "--process_timeout_mins",
+        type=int,
+        dest="process_timeout_mins",
+        help=(
+            "Global deadline of a run in minutes "
+            f"[default: {defaults['process_timeout_mins']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_budget_factor",
+        type=float,
+        dest="process_budget_factor",
+        help=(
+            "Give up on a daemon after this many times its usual processing time, "
+            "0 to only use the global deadline "
+            f"[default: {defaults['process_budget_factor']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_startd_threads",
+        type=int,
+        dest="process_startd_threads",
+        help=(
+            "Query Startd history from this many threads per process instead of "
+            "one process per Startd, 0 to use one process per Startd "
+            f"[default: {defaults['process_startd_threads']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_startd_processes",
+        type=int,
+        dest="process_startd_processes",
+        help=(
+            "Number of processes sharing the Startds when querying from threads "
+            f"[default: {defaults['process_startd_processes']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_startd_host_timeout",
+        type=int,
+        dest="process_startd_host_timeout",
+        help=(
+            "Seconds after which the history query of a single Startd is abandoned "
+            "when querying from threads "
+            f"[default: {defaults['process_startd_host_timeout']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_fanout_schedds",
+        dest="process_fanout_schedds",
+        help=(
+            "Comma-separated list of (large) Schedds whose history is read by "
+            "the main process and converted by the whole worker pool"
+        ),
+    )
+    parser.add_argument(
+        "--process_fanout_chunk_size",
+        type=int,
+        dest="process_fanout_chunk_size",
+        help=(
+            "Number of raw ads per conversion task for fan-out Schedds "
+            f"[default: {defaults['process_fanout_chunk_size']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_fanout_max_chunks",
+        type=int,
+        dest="process_fanout_max_chunks",
+        help=(
+            "Maximum number of chunks being converted at once per fan-out Schedd "
+            f"[default: {defaults['process_fanout_max_chunks']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_dedup_capacity",
+        type=int,
+        dest="process_dedup_capacity",
+        help=(
+            "Number of recently completed jobs sent by the Schedd history pass "
+            "that the queue pass can recognize and skip, 0 to disable "
+            f"[default: {defaults['process_dedup_capacity']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_boundary_cache_size",
+        type=int,
+        dest="process_boundary_cache_size",
+        help=(
+            "Number of documents at the checkpoint of each Schedd remembered "
+            "from run to run so they are not sent again, 0 to disable "
+            f"[default: {defaults['process_boundary_cache_size']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_boundary_cache_dir",
+        dest="process_boundary_cache_dir",
+        help=(
+            "Directory where the documents at the checkpoint of each Schedd are kept "
+            f"[default: {defaults['process_boundary_cache_dir']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_joblog_path",
+        dest="process_joblog_path",
+        help=(
+            "Follow the queue of the local Schedd by reading this job_queue.log "
+            "instead of querying it "
+            f"[default: {defaults['process_joblog_path']}]"
+        ),
+    )
+    parser.add_argument(
+        "--process_joblog_schedd",
+        dest="process_joblog_schedd",
+        help=(
+            "Name of the Schedd writing --process_joblog_path "
+            "[default: the Schedd running on this host]"
+        ),
+    )
     parser.add_argument(
         "--es_host",
         dest="es_host",
@@ -172,6 +769,98 @@ def main():
             f"[default: {defaults['es_bunch_size']}]"
         )
     )
+    parser.add_argument(
+        "--es_pipelined_upload",
+        action="store_const",
+        const=True,
+        dest="es_pipelined_upload",
+        help=(
+            "Upload bunches from a background thread while querying and converting "
+            f"[default: {defaults['es_pipelined_upload']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_upload_queue_depth",
+        type=int,
+        dest="es_upload_queue_depth",
+        help=(
+            "Number of bunches waiting for upload before querying is paused "
+            "when uploading in the background "
+            f"[default: {defaults['es_upload_queue_depth']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_upload_workers",
+        type=int,
+        dest="es_upload_workers",
+        help=(
+            "Number of concurrent bulk requests when uploading the schedd queues "
+            f"[default: {defaults['es_upload_workers']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_upload_buffer_mb",
+        type=int,
+        dest="es_upload_buffer_mb",
+        help=(
+            "Size of the queue documents being uploaded at once, past which "
+            "the Schedd queue workers are paused "
+            f"[default: {defaults['es_upload_buffer_mb']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_spool_dir",
+        dest="es_spool_dir",
+        help=(
+            "Write the converted history to a spool in this directory, "
+            "sent to ES in the background (see 'forward') "
+            f"[default: {defaults['es_spool_dir']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_spool_segment_mb",
+        type=int,
+        dest="es_spool_segment_mb",
+        help=(
+            "Size of the spool segments, synced to disk when full "
+            f"[default: {defaults['es_spool_segment_mb']}]"
+        )
+    )
+    parser.add_argument(
+        "--parquet_dir",
+        dest="parquet_dir",
+        help=(
+            "Also write the converted history to date partitioned Parquet "
+            "files in this directory, even without the ES history feeds "
+            f"[default: {defaults['parquet_dir']}]"
+        )
+    )
+    parser.add_argument(
+        "--parquet_max_rows",
+        type=int,
+        dest="parquet_max_rows",
+        help=(
+            "Start a new Parquet file after this many rows "
+            f"[default: {defaults['parquet_max_rows']}]"
+        )
+    )
+    parser.add_argument(
+        "--parquet_max_mb",
+        type=int,
+        dest="parquet_max_mb",
+        help=(
+            "Start a new Parquet file once it reaches this size "
+            f"[default: {defaults['parquet_max_mb']}]"
+        )
+    )
+    parser.add_argument(
+        "--parquet_compression",
+        dest="parquet_compression",
+        help=(
+            "Compression codec of the Parquet files (zstd, snappy, gzip, none...) "
+            f"[default: {defaults['parquet_compression']}]"
+        )
+    )
     parser.add_argument(
         "--es_feed_schedd_history",
         action="store_const",
@@ -192,6 +881,28 @@ def main():
             f"[default: {defaults['es_feed_schedd_queue']}]"
         )
     )
+    parser.add_argument(
+        "--es_feed_schedd_queue_summary",
+        action="store_const",
+        const=True,
+        dest="es_feed_schedd_queue_summary",
+        help=(
+            "Feed per owner, accounting group and status totals of the Schedd "
+            "queue to Elasticsearch "
+            f"[default: {defaults['es_feed_schedd_queue_summary']}]"
+        )
+    )
+    parser.add_argument(
+        "--es_queue_profile",
+        dest="es_queue_profile",
+        choices=utils.QUEUE_PROFILES,
+        help=(
+            "What is sent of the jobs in the Schedd queues: all their attributes, "
+            "only the ones of convert.RUNNING_FIELDS for running, idle and held "
+            "jobs, or only the queue summaries "
+            f"[default: {defaults['es_queue_profile']}]"
+        ),
+    )
     parser.add_argument(
         "--es_feed_startd_history",
         action="store_const",
@@ -210,6 +921,35 @@ def main():
             f"[default: {defaults['es_index_name']}]"
         ),
     )
+    parser.add_argument(
+        "--es_mapping_profile",
+        dest="es_mapping_profile",
+        choices=utils.MAPPING_PROFILES,
+        help=(
+            "Mappings and settings of the indices created: field types only, or "
+            "also no doc values for the keywords not indexed, scaled floats for "
+            "the hours and MB, best_compression and sorting by RecordTime "
+            f"[default: {defaults['es_mapping_profile']}]"
+        ),
+    )
+    parser.add_argument(
+        "--es_index_shards",
+        type=int,
+        dest="es_index_shards",
+        help=(
+            "Number of primary shards of the indices created "
+            "[default: 1 with the optimized profile, else the ES default]"
+        ),
+    )
+    parser.add_argument(
+        "--es_index_replicas",
+        type=int,
+        dest="es_index_replicas",
+        help=(
+            "Number of replicas of the indices created "
+            "[default: 1 with the optimized profile, else the ES default]"
+        ),
+    )
     parser.add_argument(
         "--es_index_date_attr",
         dest="es_index_date_attr",
@@ -218,6 +958,32 @@ def main():
             "[default: {defaults['es_index_date_attr']}]"
         ),
     )
+    parser.add_argument(
+        "--es_summary_index_name",
+        dest="es_summary_index_name",
+        help=(
+            "Trunk of Elasticsearch index name for the queue summaries "
+            f"[default: {defaults['es_summary_index_name']}]"
+        ),
+    )
+    parser.add_argument(
+        "--es_feed_run_report",
+        action="store_const",
+        const=True,
+        dest="es_feed_run_report",
+        help=(
+            "Also send the run report to Elasticsearch, one document per daemon "
+            f"[default: {defaults['es_feed_run_report']}]"
+        ),
+    )
+    parser.add_argument(
+        "--es_run_report_index_name",
+        dest="es_run_report_index_name",
+        help=(
+            "Trunk of Elasticsearch index name for the run reports "
+            f"[default: {defaults['es_run_report_index_name']}]"
+        ),
+    )
 
     parser.add_argument(
         "--log_dir",
@@ -249,6 +1015,37 @@ def main():
             "[default: none]"
         ),
     )
+    parser.add_argument(
+        "--profile",
+        choices=profiling.MODES,
+        dest="profile",
+        help=(
+            "Profile the driver and each pool task separately, writing one file "
+            "per task to --profile_dir and printing a merged summary at the end: "
+            "cProfile, sampled stacks of all threads, or the peak memory "
+            "allocated per stage [default: no profiling]"
+        ),
+    )
+    parser.add_argument(
+        "--profile_dir",
+        default="profiles/",
+        type=str,
+        dest="profile_dir",
+        help=(
+            "Directory in which each profiled run gets its own directory "
+            "[default: %(default)s]"
+        ),
+    )
+    parser.add_argument(
+        "--profile_top",
+        default=25,
+        type=int,
+        dest="profile_top",
+        help=(
+            "Number of entries in the summary of the profiles "
+            "[default: %(default)s]"
+        ),
+    )
     parser.add_argument(
         "--read_only",
         action="store_true",
@@ -265,6 +1062,142 @@ def main():
         ),
     )
 
+    subparsers = parser.add_subparsers(dest="command")
+    backfill_parser = subparsers.add_parser(
+        "backfill",
+        help=(
+            "Re-ingest the Schedd history between two dates, "
+            "options before 'backfill' apply as usual"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--from",
+        required=True,
+        dest="backfill_from",
+        help="Start of the backfill (UTC), as YYYY-MM-DD[THH:MM[:SS]] or epoch seconds",
+    )
+    backfill_parser.add_argument(
+        "--to",
+        dest="backfill_to",
+        help=(
+            "End of the backfill (UTC, exclusive), as YYYY-MM-DD[THH:MM[:SS]] "
+            "or epoch seconds [default: now]"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--window_hours",
+        type=int,
+        dest="backfill_window_hours",
+        help=(
+            "Length of the time windows queried in parallel "
+            f"[default: {defaults['backfill_window_hours']}]"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--bunch_size",
+        type=int,
+        dest="backfill_bunch_size",
+        help=(
+            "Send docs to ES in bunches of this number during the backfill "
+            f"[default: {defaults['backfill_bunch_size']}]"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--request_timeout",
+        type=int,
+        dest="backfill_request_timeout",
+        help=(
+            "Timeout in seconds for each bulk request during the backfill "
+            f"[default: {defaults['backfill_request_timeout']}]"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--scan_slack_hours",
+        type=int,
+        dest="backfill_scan_slack_hours",
+        help=(
+            "Stop scanning the history files of a Schedd this many hours before "
+            "the start of each window, negative values scan all history files "
+            f"[default: {defaults['backfill_scan_slack_hours']}]"
+        ),
+    )
+    backfill_parser.add_argument(
+        "--manifest",
+        dest="backfill_manifest",
+        help=(
+            "File recording the finished windows, used to resume the backfill "
+            f"[default: {defaults['backfill_manifest']}]"
+        ),
+    )
+
+    forward_parser = subparsers.add_parser(
+        "forward",
+        help=(
+            "Send the spool (--es_spool_dir) to Elasticsearch until SIGTERM or SIGINT, "
+            "options before 'forward' apply as usual"
+        ),
+    )
+    forward_parser.add_argument(
+        "--once",
+        action="store_true",
+        dest="forward_once",
+        help="Exit once the spool is empty",
+    )
+
+    record_parser = subparsers.add_parser(
+        "record",
+        help=(
+            "Save the raw job ads of the enabled passes for 'replay', "
+            "options before 'record' apply as usual"
+        ),
+    )
+    record_parser.add_argument(
+        "--output",
+        required=True,
+        dest="record_output",
+        help="Directory the job ads are saved to",
+    )
+    record_parser.add_argument(
+        "--since_hours",
+        type=int,
+        dest="record_since_hours",
+        help=(
+            "Save the jobs that entered their current status in the last hours, "
+            "plus the idle, running and held jobs of the queues "
+            f"[default: {defaults['record_since_hours']}]"
+        ),
+    )
+    record_parser.add_argument(
+        "--chunk_size",
+        type=int,
+        dest="record_chunk_size",
+        help=(
+            "Number of job ads per saved file, converted as one pool task on replay "
+            f"[default: {defaults['record_chunk_size']}]"
+        ),
+    )
+
+    replay_parser = subparsers.add_parser(
+        "replay",
+        help=(
+            "Convert and upload the job ads saved by 'record', "
+            "options before 'replay' apply as usual"
+        ),
+    )
+    replay_parser.add_argument(
+        "--input",
+        required=True,
+        dest="replay_input",
+        help="Directory the job ads were saved to by 'record'",
+    )
+    replay_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        dest="replay_repeat",
+        help="Replay the saved job ads this many times [default: 1]",
+    )
+
     args = parser.parse_args()
     args = utils.load_config(args)
     utils.set_up_logging(args)
@@ -272,7 +1205,30 @@ def main():
     # --dry_run implies read_only
     args.read_only = args.read_only or args.dry_run
 
-    main_driver(args)
+    if args.parquet_dir and importlib.util.find_spec("pyarrow") is None:
+        logging.error('"pyarrow" library not found, cannot write Parquet files (--parquet_dir)')
+        return 1
+
+    if args.command == "backfill":
+        driver = backfill_driver
+    elif args.command == "forward":
+        driver = forward_driver
+    elif args.command == "record":
+        driver = record_driver
+    elif args.command == "replay":
+        driver = replay_driver
+    elif args.daemon:
+        driver = daemon_driver
+    else:
+        driver = main_driver
+    if not args.profile:
+        return driver(args)
+
+    profiling.configure(args.profile, args.profile_dir)
+    try:
+        return profiling.run_profiled("driver", driver, args)
+    finally:
+        print(profiling.summarize(args.profile_top))
 
 
 if __name__ == "__main__":
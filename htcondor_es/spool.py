@@ -0,0 +1,501 @@
+"""
+Durable spool between the conversion and Elasticsearch (--es_spool_dir).
+
+With a spool, the history passes append their serialized bulk bodies to
+segment files instead of posting them, and the checkpoint of a daemon
+advances as soon as its documents are on disk. A forwarder thread (in
+the spider itself, or "spider forward" as a service of its own) sends
+the segments to ES, oldest first, and deletes each once all its bulk
+requests went through. A slow or unavailable ES then no longer holds
+up the queries of the daemons. The spider runs its forwarder in a
+process of its own (ForwarderProcess), started before the worker pool,
+so that the pool never forks while a forwarder thread holds a lock.
+
+Each writer (a pool task) appends to its own segment, named
+<us since epoch>-<pid>-<n>.open and locked (flock) by the writer while
+open, and syncs it to disk once, when it is sealed: at the end of the
+task or once it grows to es_spool_segment_mb. Sealing renames it to
+.seg, so the forwarder only sees complete segments. A segment is a
+sequence of records:
+
+    header  4 bytes metadata length, 4 bytes body length, 4 bytes CRC32
+    metadata  JSON {"index", "template", "n_docs", "daemon"}
+    body      bulk body, as made by elastic.make_es_body
+
+A crash of the forwarder replays the segment it was sending, which only
+overwrites documents (their ids are fixed). Documents rejected by a
+full ES write queue (429) or failing on the side of ES (5xx) are sent
+again, and the segment is kept until they are indexed. Documents ES
+refuses (e.g. mapping errors) are written to <segment>.failed, in the
+same format: rename it to .seg to send it again. Open segments that
+are no longer locked, left by a writer that died, were not checkpointed
+and are removed.
+"""
+
+import os
+import json
+import time
+import zlib
+import queue
+import fcntl
+import signal
+import struct
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+
+from . import elastic, metrics
+
+HEADER = struct.Struct(">III")
+
+SEALED = ".seg"
+OPEN = ".open"
+
+FAILED = ".failed"
+
+POLL_INTERVAL = 1.0
+MAX_BACKOFF = 60
+
+# Seconds a stopped forwarder is given to finish its bulk requests in flight
+STOP_TIMEOUT = 10
+
+# Attempts at the documents rejected by ES in a record, and the first delay
+RETRIES = 5
+RETRY_BACKOFF = 0.5
+
+# Open segments this recent are left alone, their writer may not hold its
+# lock yet
+ORPHAN_AGE = 60
+
+_SEQUENCE = [0]
+
+
+def new_segment(directory):
+    _SEQUENCE[0] += 1
+    name = "%d-%d-%d" % (int(time.time() * 1e6), os.getpid(), _SEQUENCE[0])
+    return os.path.join(directory, name + OPEN)
+
+
+def pack_record(meta, body):
+    meta = json.dumps(meta).encode()
+    body = body.encode()
+    crc = zlib.crc32(body, zlib.crc32(meta))
+    return HEADER.pack(len(meta), len(body), crc) + meta + body
+
+
+def sync_directory(directory):
+    """Make the renames in directory durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolWriter(object):
+    """Appends bulk bodies to segments of this process"""
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.filename = None
+        self.fd = None
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, idx, template, n_docs, body, daemon=metrics.SHARED):
+        if self.fd is None:
+            self.filename = new_segment(self.directory)
+            self.fd = open(self.filename, "wb")
+            # Tells remove_orphans that this segment is still being written
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.size = 0
+        record = pack_record(
+            {"index": idx, "template": template, "n_docs": n_docs, "daemon": daemon},
+            body,
+        )
+        self.fd.write(record)
+        self.size += len(record)
+        if self.size >= self.segment_bytes:
+            self.seal()
+
+    def seal(self):
+        """Sync the current segment to disk and hand it over to the forwarder"""
+        if self.fd is None:
+            return
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        # Renamed before unlocking, an unlocked .open segment is an orphan
+        os.rename(self.filename, self.filename[: -len(OPEN)] + SEALED)
+        self.fd.close()
+        self.fd = None
+        sync_directory(self.directory)
+
+
+class SpoolPoster(elastic.BulkPoster):
+    """
+    BulkPoster appending to the spool, everything posted is on disk
+    once close() returns. The indices are created by the forwarder.
+    """
+
+    needs_index = False
+
+    def __init__(
+        self,
+        directory,
+        metadata=None,
+        template="htcondor",
+        segment_mb=64,
+        daemon=metrics.SHARED,
+    ):
+        super(SpoolPoster, self).__init__(None, metadata=metadata, daemon=daemon)
+        self.writer = SpoolWriter(directory, segment_mb * 1024 * 1024)
+        self.template = template
+
+    def _post_body(self, idx, body, n_docs):
+        st = time.time()
+        self.writer.append(idx, self.template, n_docs, body, self.daemon)
+        self.upload_time += time.time() - st
+        self.n_posted += n_docs
+        metrics.incr(self.daemon, "docs_spooled", n_docs)
+
+    def close(self):
+        st = time.time()
+        try:
+            self.writer.seal()
+        finally:
+            self.upload_time += time.time() - st
+        super(SpoolPoster, self).close()
+
+
+def read_segment(filename):
+    """Yield the (metadata, body) records of a sealed segment"""
+    with open(filename, "rb") as fd:
+        while True:
+            header = fd.read(HEADER.size)
+            if not header:
+                return
+            if len(header) < HEADER.size:
+                raise ValueError(f"Truncated record header in {filename}")
+            meta_len, body_len, crc = HEADER.unpack(header)
+            meta = fd.read(meta_len)
+            body = fd.read(body_len)
+            if (
+                len(meta) + len(body) < meta_len + body_len
+                or zlib.crc32(body, zlib.crc32(meta)) != crc
+            ):
+                raise ValueError(f"Corrupted record in {filename}")
+            yield json.loads(meta), body.decode()
+
+
+def pending_segments(directory):
+    """Return the sealed segments, oldest first"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = [name for name in names if name.endswith(SEALED)]
+    segments.sort(
+        key=lambda name: [int(part) for part in name[: -len(SEALED)].split("-")]
+    )
+    return [os.path.join(directory, name) for name in segments]
+
+
+def pending_bytes(directory):
+    return sum(os.path.getsize(filename) for filename in pending_segments(directory))
+
+
+def remove_orphans(directory):
+    """Remove the open segments no writer holds the lock of"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith(OPEN):
+            continue
+        filename = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(filename) < ORPHAN_AGE:
+                continue
+            with open(filename, "rb") as fd:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logging.warning(
+                    "Removing the spool segment %s of a writer that died", name
+                )
+                os.remove(filename)
+        except (BlockingIOError, FileNotFoundError):
+            # Still being written, or sealed meanwhile
+            continue
+
+
+def send_record(es, meta, body, request_timeout=60, stopped=None):
+    """
+    Post a record, sending again the documents rejected by ES (429) or
+    failing on its side (5xx), and return the lines of the ones it refused.
+    Raises once stopped (an Event) is set instead of retrying.
+    """
+    stopped = stopped or threading.Event()
+    refused = []
+    backoff = RETRY_BACKOFF
+    for attempt in range(RETRIES + 1):
+        res, n_failed = elastic.bulk_body(
+            es,
+            meta["index"],
+            body,
+            request_timeout=request_timeout,
+            daemon=meta["daemon"],
+        )
+        if not n_failed:
+            return refused
+        retry = []
+        for status, lines in elastic.failed_items(body, res):
+            if status == 429 or (status or 500) >= 500:
+                retry.append(lines)
+            else:
+                refused.append(lines)
+        if not retry:
+            return refused
+        if attempt < RETRIES:
+            logging.warning(
+                "Sending %d documents rejected by ES again in %.1f s",
+                len(retry),
+                backoff,
+            )
+            if stopped.wait(backoff):
+                raise RuntimeError(
+                    f"Stopped with {len(retry)} documents rejected by ES"
+                )
+            backoff *= 2
+        body = "".join(retry)
+    raise RuntimeError(
+        f"{len(retry)} documents still rejected by ES after {RETRIES} retries"
+    )
+
+
+def forward_segment(
+    filename, es, executor, max_pending, request_timeout=60, stopped=None
+):
+    """
+    Send the records of a segment to ES, max_pending bulk requests at a
+    time, and delete it. Raises if a bulk request failed or once stopped
+    (an Event) is set, keeping the segment. Documents ES refused are kept
+    in filename.failed.
+    """
+    stopped = stopped or threading.Event()
+    pending = set()
+    n_docs = 0
+    refused = []
+
+    def _wait(n_pending):
+        nonlocal pending
+        while len(pending) > n_pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                meta, lines = future.result()
+                if lines:
+                    refused.append((meta, lines))
+
+    def _send(meta, body):
+        return meta, send_record(es, meta, body, request_timeout, stopped)
+
+    try:
+        for meta, body in read_segment(filename):
+            if stopped.is_set():
+                raise RuntimeError(f"Stopped while forwarding {filename}")
+            elastic.ensure_index(meta["index"], template=meta["template"])
+            pending.add(executor.submit(_send, meta, body))
+            n_docs += meta["n_docs"]
+            _wait(max_pending)
+        _wait(0)
+    except ValueError as exn:
+        # Not worth retrying, keep it aside for inspection
+        logging.error("%s, moving it out of the spool", exn)
+        _wait(0)
+        if refused:
+            write_refused(filename + FAILED, refused)
+        os.rename(filename, filename + ".bad")
+        return n_docs
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    if refused:
+        write_refused(filename + FAILED, refused)
+    os.remove(filename)
+    return n_docs
+
+
+def write_refused(filename, refused):
+    """Keep the documents ES refused, as records of a segment"""
+    with open(filename, "ab") as fd:
+        for meta, lines in refused:
+            fd.write(pack_record(dict(meta, n_docs=len(lines)), "".join(lines)))
+        fd.flush()
+        os.fsync(fd.fileno())
+    sync_directory(os.path.dirname(filename) or ".")
+    logging.error(
+        "Elasticsearch refused %d documents, kept in %s",
+        sum(len(lines) for _, lines in refused),
+        filename,
+    )
+
+
+class Forwarder(object):
+    """
+    Thread sending the spool to ES, polling for new segments and
+    backing off while ES is unavailable. The events stopping it and the
+    queue its progress is put on are given by ForwarderProcess.
+    """
+
+    def __init__(self, args, stopped=None, draining=None, progress=None):
+        self.directory = args.es_spool_dir
+        self.workers = max(1, args.es_upload_workers)
+        self.args = args
+        self.stopped = stopped or threading.Event()
+        self.draining = draining or threading.Event()
+        self.progress = progress
+        self.thread = threading.Thread(
+            target=self.run, name="spool-forwarder", daemon=True
+        )
+        self.n_docs = 0
+
+    def forward_pending(self, es, executor):
+        """Send the segments sealed so far, return how many"""
+        segments = pending_segments(self.directory)
+        for filename in segments:
+            if self.stopped.is_set():
+                break
+            n_docs = forward_segment(
+                filename, es, executor, 2 * self.workers, stopped=self.stopped
+            )
+            self.n_docs += n_docs
+            if self.progress is not None:
+                self.progress.put((n_docs, metrics.snapshot(clear=True)))
+        return len(segments)
+
+    def run(self):
+        es = elastic.get_server_handle(self.args).handle
+        backoff = POLL_INTERVAL
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            while not self.stopped.is_set():
+                remove_orphans(self.directory)
+                try:
+                    n_segments = self.forward_pending(es, executor)
+                    backoff = POLL_INTERVAL
+                except Exception as exn:
+                    if self.stopped.is_set():
+                        break
+                    logging.error(
+                        "Failed to forward the spool to Elasticsearch, retrying in %d s: %s",
+                        backoff,
+                        exn,
+                    )
+                    self.stopped.wait(backoff)
+                    backoff = min(MAX_BACKOFF, 2 * backoff)
+                    continue
+                if n_segments == 0:
+                    if self.draining.is_set():
+                        break
+                    self.stopped.wait(POLL_INTERVAL)
+
+    def start(self):
+        logging.warning("Forwarding the spool in %s to Elasticsearch", self.directory)
+        self.thread.start()
+
+    def stop(self, drain=False, timeout=None):
+        """
+        Stop the forwarder, with drain once the spool is empty or after
+        timeout seconds. Returns whether the spool was emptied.
+        """
+        if drain:
+            self.draining.set()
+            self.thread.join(timeout)
+        self.stopped.set()
+        self.thread.join(STOP_TIMEOUT)
+        if self.thread.is_alive():
+            logging.warning(
+                "The spool forwarder did not stop within %d s", STOP_TIMEOUT
+            )
+        return report_left(self.directory)
+
+
+def report_left(directory):
+    """Log the segments left in the spool, return whether it is empty"""
+    left = len(pending_segments(directory))
+    if left:
+        logging.warning("%d segments left in the spool %s", left, directory)
+    return left == 0
+
+
+def _run_forwarder(args, stopped, draining, progress):
+    # Stopped by the spider, which handles SIGINT and SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    metrics.reset()
+    Forwarder(args, stopped, draining, progress).run()
+
+
+class ForwarderProcess(object):
+    """
+    Forwarder running in a process of its own, to be started before the
+    worker pool. What it forwarded (documents and metrics) is merged in
+    by collect().
+    """
+
+    def __init__(self, args):
+        self.directory = args.es_spool_dir
+        self.stopped = multiprocessing.Event()
+        self.draining = multiprocessing.Event()
+        self.progress = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_run_forwarder,
+            args=(args, self.stopped, self.draining, self.progress),
+            name="spool-forwarder",
+            daemon=True,
+        )
+        self.n_docs = 0
+
+    def start(self):
+        logging.warning("Forwarding the spool in %s to Elasticsearch", self.directory)
+        self.process.start()
+
+    def collect(self):
+        """Merge the metrics of what was forwarded since the previous call"""
+        while True:
+            try:
+                n_docs, recorded = self.progress.get_nowait()
+            except queue.Empty:
+                return
+            self.n_docs += n_docs
+            metrics.merge(recorded)
+
+    def _join(self, timeout):
+        # The progress is read meanwhile, a process does not exit before
+        # what it put on a queue was read
+        deadline = time.time() + max(0, timeout)
+        while self.process.is_alive() and time.time() < deadline:
+            self.collect()
+            self.process.join(min(POLL_INTERVAL, max(0, deadline - time.time())))
+        self.collect()
+
+    def stop(self, drain=False, timeout=None):
+        """Same as Forwarder.stop"""
+        if drain:
+            self.draining.set()
+            self._join(timeout if timeout is not None else float("inf"))
+        self.stopped.set()
+        self._join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            # Its segment is sent again by the next forwarder
+            logging.warning(
+                "The spool forwarder did not stop within %d s", STOP_TIMEOUT
+            )
+            self.process.terminate()
+            self.process.join()
+        return report_left(self.directory)
@@ -7,22 +7,31 @@ import pwd
 import sys
 import time
 import errno
-import shlex
 import socket
 import random
-import smtplib
-import subprocess
-import email.mime.text
 import json
 import logging
 import logging.handlers
+import threading
 import configparser
+import multiprocessing
+import concurrent.futures
 from argparse import Namespace
 
-import htcondor
-
 TIMEOUT_MINS = 11
 
+# What the queue feed sends of each job:
+#   full: every attribute of every job
+#   running-slim: running, idle and held jobs reduced to convert.RUNNING_FIELDS
+#   summary-only: no job documents, only the queue summaries
+QUEUE_PROFILES = ["full", "running-slim", "summary-only"]
+
+# Mappings and settings of the indices created by the spider:
+#   default: field types only, ES defaults otherwise
+#   optimized: for write-once daily indices, less disk and merge I/O
+#     (see elastic.make_mappings and make_settings)
+MAPPING_PROFILES = ["default", "optimized"]
+
 
 def default_config():
     defaults = {
@@ -31,43 +40,95 @@ def default_config():
         'process_startd_history'   : False,
         'process_max_documents'    : 0,
         'process_parallel_queries' : 8,
+        'process_timeout_mins'     : TIMEOUT_MINS,
+        'process_budget_factor'    : 3.0,
+        'process_startd_threads'   : 0,
+        'process_startd_processes' : 2,
+        'process_startd_host_timeout': 60,
+        'process_fanout_schedds'   : None,
+        'process_fanout_chunk_size': 5000,
+        'process_fanout_max_chunks': 16,
+        'process_joblog_path'      : None,
+        'process_joblog_schedd'    : None,
+        'process_dedup_capacity'   : 200000,
+        'process_boundary_cache_size': 10000,
+        'process_boundary_cache_dir': 'recent_docs',
+        'process_collector_cache'  : 'collector_cache.json',
+        'process_collector_cache_ttl_mins': 15,
+        'process_run_report'       : 'run_report.json',
+        'process_metrics_textfile' : None,
         'es_host'                  : 'localhost',
         'es_port'                  : 9200,
+        'es_username'              : None,
+        'es_password'              : None,
+        'es_use_https'             : False,
         'es_bunch_size'            : 250,
+        'es_pipelined_upload'      : False,
+        'es_upload_queue_depth'    : 4,
+        'es_upload_workers'        : 4,
+        'es_upload_buffer_mb'      : 256,
+        'es_spool_dir'             : None,
+        'es_spool_segment_mb'      : 64,
         'es_feed_schedd_history'   : False,
         'es_feed_schedd_queue'     : False,
+        'es_feed_schedd_queue_summary': False,
+        'es_queue_profile'         : 'full',
         'es_feed_startd_history'   : False,
         'es_index_name'            : 'htcondor_jobs',
+        'es_mapping_profile'       : 'default',
+        'es_index_shards'          : None,
+        'es_index_replicas'        : None,
         'es_index_date_attr'       : 'CompletionDate',
+        'es_summary_index_name'    : 'htcondor_queue_summary',
+        'es_feed_run_report'       : False,
+        'es_run_report_index_name' : 'htcondor_spider_runs',
+        'backfill_window_hours'    : 24,
+        'backfill_bunch_size'      : 2000,
+        'backfill_request_timeout' : 300,
+        'backfill_scan_slack_hours': 24,
+        'backfill_manifest'        : 'backfill_manifest.json',
+        'parquet_dir'              : None,
+        'parquet_max_rows'         : 1000000,
+        'parquet_max_mb'           : 256,
+        'parquet_compression'      : 'zstd',
+        'record_since_hours'       : 24,
+        'record_chunk_size'        : 5000,
+        'daemon_history_interval_mins': 10,
+        'daemon_queue_interval_mins': 5,
+        'daemon_startd_interval_mins': 15,
+        'daemon_collector_refresh_mins': 30,
+        'daemon_worker_tasks'      : 100,
+        'daemon_metrics_port'      : 0,
     }
     return defaults
 
 
 def load_config(args):
     defaults = default_config()
-    if (args is None) or (args.config_file is None):
+    if args is None:
         return args
 
     config = configparser.ConfigParser(
         allow_no_value=True,
         empty_lines_in_values=False)
-    try:
-        config_files = config.read(args.config_file)
-        if len(config_files) == 0:
-            # Something went wrong with reading the config file,
-            # hopefully open() generates an informative exception.
-            try:
-                open(args.config_file, 'rb').close()
-            except Exception:
-                raise
-            else:
-                # open() didn't error, so something else happened *shrug*
-                raise RuntimeError("Could not read config file. "
-                    "Please check that it exists, is readable, and is free of "
-                    "syntax errors.")
-    except Exception:
-        logging.exception("Fatal error while reading config file")
-        sys.exit(1)
+    if args.config_file is not None:
+        try:
+            config_files = config.read(args.config_file)
+            if len(config_files) == 0:
+                # Something went wrong with reading the config file,
+                # hopefully open() generates an informative exception.
+                try:
+                    open(args.config_file, 'rb').close()
+                except Exception:
+                    raise
+                else:
+                    # open() didn't error, so something else happened *shrug*
+                    raise RuntimeError("Could not read config file. "
+                        "Please check that it exists, is readable, and is free of "
+                        "syntax errors.")
+        except Exception:
+            logging.exception("Fatal error while reading config file")
+            sys.exit(1)
 
     # convert args from a namespace object to a dict
     args = vars(args)
@@ -77,6 +138,8 @@ def load_config(args):
         args['schedds']    = ','.join(list(config['SCHEDDS']))
     if (args.get('startds') is None)    and ('STARTDS' in config)    and (len(list(config['STARTDS'])) > 0):
         args['startds']    = ','.join(list(config['STARTDS']))
+    if (args.get('process_fanout_schedds') is None) and ('FANOUT_SCHEDDS' in config) and (len(list(config['FANOUT_SCHEDDS'])) > 0):
+        args['process_fanout_schedds'] = ','.join(list(config['FANOUT_SCHEDDS']))
     if 'PROCESS' in config:
         process = config['PROCESS']
         if args.get('process_schedd_history') is None:
@@ -94,6 +157,54 @@ def load_config(args):
         if args.get('process_parallel_queries') is None:
             args['process_parallel_queries'] = process.getint(
                 'parallel_queries', fallback=defaults['process_parallel_queries'])
+        if args.get('process_timeout_mins') is None:
+            args['process_timeout_mins'] = process.getint(
+                'timeout_mins', fallback=defaults['process_timeout_mins'])
+        if args.get('process_budget_factor') is None:
+            args['process_budget_factor'] = process.getfloat(
+                'budget_factor', fallback=defaults['process_budget_factor'])
+        if args.get('process_startd_threads') is None:
+            args['process_startd_threads'] = process.getint(
+                'startd_threads', fallback=defaults['process_startd_threads'])
+        if args.get('process_startd_processes') is None:
+            args['process_startd_processes'] = process.getint(
+                'startd_processes', fallback=defaults['process_startd_processes'])
+        if args.get('process_startd_host_timeout') is None:
+            args['process_startd_host_timeout'] = process.getint(
+                'startd_host_timeout', fallback=defaults['process_startd_host_timeout'])
+        if args.get('process_fanout_chunk_size') is None:
+            args['process_fanout_chunk_size'] = process.getint(
+                'fanout_chunk_size', fallback=defaults['process_fanout_chunk_size'])
+        if args.get('process_fanout_max_chunks') is None:
+            args['process_fanout_max_chunks'] = process.getint(
+                'fanout_max_chunks', fallback=defaults['process_fanout_max_chunks'])
+        if args.get('process_joblog_path') is None:
+            args['process_joblog_path'] = process.get(
+                'joblog_path', fallback=defaults['process_joblog_path'])
+        if args.get('process_joblog_schedd') is None:
+            args['process_joblog_schedd'] = process.get(
+                'joblog_schedd', fallback=defaults['process_joblog_schedd'])
+        if args.get('process_dedup_capacity') is None:
+            args['process_dedup_capacity'] = process.getint(
+                'dedup_capacity', fallback=defaults['process_dedup_capacity'])
+        if args.get('process_boundary_cache_size') is None:
+            args['process_boundary_cache_size'] = process.getint(
+                'boundary_cache_size', fallback=defaults['process_boundary_cache_size'])
+        if args.get('process_boundary_cache_dir') is None:
+            args['process_boundary_cache_dir'] = process.get(
+                'boundary_cache_dir', fallback=defaults['process_boundary_cache_dir'])
+        if args.get('process_collector_cache') is None:
+            args['process_collector_cache'] = process.get(
+                'collector_cache', fallback=defaults['process_collector_cache'])
+        if args.get('process_collector_cache_ttl_mins') is None:
+            args['process_collector_cache_ttl_mins'] = process.getint(
+                'collector_cache_ttl_mins', fallback=defaults['process_collector_cache_ttl_mins'])
+        if args.get('process_run_report') is None:
+            args['process_run_report'] = process.get(
+                'run_report', fallback=defaults['process_run_report'])
+        if args.get('process_metrics_textfile') is None:
+            args['process_metrics_textfile'] = process.get(
+                'metrics_textfile', fallback=defaults['process_metrics_textfile'])
     if 'ELASTICSEARCH' in config:
         es = config['ELASTICSEARCH']
         if args.get('es_host') is None:
@@ -109,52 +220,279 @@ def load_config(args):
         if args.get('es_bunch_size') is None:
             args['es_bunch_size'] = es.getint(
                 'bunch_size', fallback=defaults['es_bunch_size'])
+        if args.get('es_pipelined_upload') is None:
+            args['es_pipelined_upload'] = es.getboolean(
+                'pipelined_upload', fallback=defaults['es_pipelined_upload'])
+        if args.get('es_upload_queue_depth') is None:
+            args['es_upload_queue_depth'] = es.getint(
+                'upload_queue_depth', fallback=defaults['es_upload_queue_depth'])
+        if args.get('es_upload_workers') is None:
+            args['es_upload_workers'] = es.getint(
+                'upload_workers', fallback=defaults['es_upload_workers'])
+        if args.get('es_upload_buffer_mb') is None:
+            args['es_upload_buffer_mb'] = es.getint(
+                'upload_buffer_mb', fallback=defaults['es_upload_buffer_mb'])
+        if args.get('es_spool_dir') is None:
+            args['es_spool_dir'] = es.get(
+                'spool_dir', fallback=defaults['es_spool_dir'])
+        if args.get('es_spool_segment_mb') is None:
+            args['es_spool_segment_mb'] = es.getint(
+                'spool_segment_mb', fallback=defaults['es_spool_segment_mb'])
         if args.get('es_feed_schedd_history') is None:
             args['es_feed_schedd_history'] = es.getboolean(
                 'feed_schedd_history', fallback=defaults['es_feed_schedd_history'])
         if args.get('es_feed_schedd_queue') is None:
             args['es_feed_schedd_queue'] = es.getboolean(
                 'feed_schedd_queue', fallback=defaults['es_feed_schedd_queue'])
+        if args.get('es_feed_schedd_queue_summary') is None:
+            args['es_feed_schedd_queue_summary'] = es.getboolean(
+                'feed_schedd_queue_summary',
+                fallback=defaults['es_feed_schedd_queue_summary'])
+        if args.get('es_queue_profile') is None:
+            args['es_queue_profile'] = es.get(
+                'queue_profile', fallback=defaults['es_queue_profile'])
         if args.get('es_feed_startd_history') is None:
             args['es_feed_startd_history'] = es.getboolean(
                 'feed_startd_history', fallback=defaults['es_feed_startd_history'])
         if args.get('es_index_name') is None:
             args['es_index_name'] = es.get(
                 'index_name', fallback=defaults['es_index_name'])
+        if args.get('es_mapping_profile') is None:
+            args['es_mapping_profile'] = es.get(
+                'mapping_profile', fallback=defaults['es_mapping_profile'])
+        if args.get('es_index_shards') is None:
+            args['es_index_shards'] = es.getint(
+                'index_shards', fallback=defaults['es_index_shards'])
+        if args.get('es_index_replicas') is None:
+            args['es_index_replicas'] = es.getint(
+                'index_replicas', fallback=defaults['es_index_replicas'])
         if args.get('es_index_date_attr') is None:
             args['es_index_date_attr'] = es.get(
                 'index_date_attr', fallback=defaults['es_index_date_attr'])
+        if args.get('es_summary_index_name') is None:
+            args['es_summary_index_name'] = es.get(
+                'summary_index_name', fallback=defaults['es_summary_index_name'])
+        if args.get('es_feed_run_report') is None:
+            args['es_feed_run_report'] = es.getboolean(
+                'feed_run_report', fallback=defaults['es_feed_run_report'])
+        if args.get('es_run_report_index_name') is None:
+            args['es_run_report_index_name'] = es.get(
+                'run_report_index_name', fallback=defaults['es_run_report_index_name'])
+    if 'BACKFILL' in config:
+        backfill = config['BACKFILL']
+        if args.get('backfill_window_hours') is None:
+            args['backfill_window_hours'] = backfill.getint(
+                'window_hours', fallback=defaults['backfill_window_hours'])
+        if args.get('backfill_bunch_size') is None:
+            args['backfill_bunch_size'] = backfill.getint(
+                'bunch_size', fallback=defaults['backfill_bunch_size'])
+        if args.get('backfill_request_timeout') is None:
+            args['backfill_request_timeout'] = backfill.getint(
+                'request_timeout', fallback=defaults['backfill_request_timeout'])
+        if args.get('backfill_scan_slack_hours') is None:
+            args['backfill_scan_slack_hours'] = backfill.getint(
+                'scan_slack_hours', fallback=defaults['backfill_scan_slack_hours'])
+        if args.get('backfill_manifest') is None:
+            args['backfill_manifest'] = backfill.get(
+                'manifest', fallback=defaults['backfill_manifest'])
+    if 'PARQUET' in config:
+        parquet = config['PARQUET']
+        if args.get('parquet_dir') is None:
+            args['parquet_dir'] = parquet.get(
+                'dir', fallback=defaults['parquet_dir'])
+        if args.get('parquet_max_rows') is None:
+            args['parquet_max_rows'] = parquet.getint(
+                'max_rows', fallback=defaults['parquet_max_rows'])
+        if args.get('parquet_max_mb') is None:
+            args['parquet_max_mb'] = parquet.getint(
+                'max_mb', fallback=defaults['parquet_max_mb'])
+        if args.get('parquet_compression') is None:
+            args['parquet_compression'] = parquet.get(
+                'compression', fallback=defaults['parquet_compression'])
+    if 'RECORD' in config:
+        record = config['RECORD']
+        if args.get('record_since_hours') is None:
+            args['record_since_hours'] = record.getint(
+                'since_hours', fallback=defaults['record_since_hours'])
+        if args.get('record_chunk_size') is None:
+            args['record_chunk_size'] = record.getint(
+                'chunk_size', fallback=defaults['record_chunk_size'])
+    if 'DAEMON' in config:
+        daemon = config['DAEMON']
+        if args.get('daemon_history_interval_mins') is None:
+            args['daemon_history_interval_mins'] = daemon.getint(
+                'history_interval_mins', fallback=defaults['daemon_history_interval_mins'])
+        if args.get('daemon_queue_interval_mins') is None:
+            args['daemon_queue_interval_mins'] = daemon.getint(
+                'queue_interval_mins', fallback=defaults['daemon_queue_interval_mins'])
+        if args.get('daemon_startd_interval_mins') is None:
+            args['daemon_startd_interval_mins'] = daemon.getint(
+                'startd_interval_mins', fallback=defaults['daemon_startd_interval_mins'])
+        if args.get('daemon_collector_refresh_mins') is None:
+            args['daemon_collector_refresh_mins'] = daemon.getint(
+                'collector_refresh_mins', fallback=defaults['daemon_collector_refresh_mins'])
+        if args.get('daemon_worker_tasks') is None:
+            args['daemon_worker_tasks'] = daemon.getint(
+                'worker_tasks', fallback=defaults['daemon_worker_tasks'])
+        if args.get('daemon_metrics_port') is None:
+            args['daemon_metrics_port'] = daemon.getint(
+                'metrics_port', fallback=defaults['daemon_metrics_port'])
+
+    # anything not set on the command line or in the config file gets the default
+    for key, value in defaults.items():
+        if args.get(key) is None:
+            args[key] = value
 
     # convert args back to a namespace object
     args = Namespace(**args)
     return args
 
 
-def get_schedds(args=None):
+def load_collector_cache(filename):
+    try:
+        with open(filename, "r") as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+_COLLECTOR_CACHE_LOCK = threading.Lock()
+
+
+def save_collector_cache(filename, kind, host, ads):
     """
-    Return a list of schedd ads representing all the schedds in the pool.
+    Record the ads of the daemons of a kind located by a collector
     """
-    collectors = args.collectors
-    if collectors:
-        collectors = collectors.split(',')
-    else:
-        collectors = []
+    with _COLLECTOR_CACHE_LOCK:
+        cache = load_collector_cache(filename)
+        cache.setdefault(kind, {})[host] = {
+            "time": int(time.time()),
+            "ads": [ad.printOld() for ad in ads],
+        }
+        tmpname = filename + ".tmp"
+        with open(tmpname, "w") as fd:
+            json.dump(cache, fd)
+        os.replace(tmpname, filename)
+
+
+def _locate_and_cache(args, kind, locate, host):
+    try:
+        ads = locate(host)
+    except IOError as e:
+        logging.warning("Failed to locate the %ss of %s: %s", kind, host, e)
+        return None
+    if args.process_collector_cache_ttl_mins:
+        save_collector_cache(args.process_collector_cache, kind, host, ads)
+    return ads
 
-    schedd_ads = {}
-    for host in collectors:
-        coll = htcondor.Collector(host)
-        try:
-            schedds = coll.locateAll(htcondor.DaemonTypes.Schedd)
-        except IOError as e:
-            logging.warning(str(e))
+
+def _refresh_collector_cache(args, kind, locate, hosts):
+    """Locate the daemons of a kind again, only for the collector cache"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        for host in hosts:
+            executor.submit(_locate_and_cache, args, kind, locate, host)
+
+
+def locate_daemons(args, kind, locate):
+    """
+    Return {collector: ads} of the daemons of a kind located by each
+    collector of args.collectors, locate(host) querying one of them.
+
+    Collectors are queried in parallel and their answers are cached in
+    args.process_collector_cache. Cached answers are used as they are,
+    the ones older than args.process_collector_cache_ttl_mins are
+    refreshed by a background process for the next call, and kept if
+    the collector cannot be reached.
+    """
+    import classad
+
+    hosts = args.collectors.split(",") if args.collectors else []
+    ttl = args.process_collector_cache_ttl_mins * 60
+    cached = {}
+    if ttl:
+        cached = load_collector_cache(args.process_collector_cache).get(kind, {})
+
+    def _locate(host):
+        return _locate_and_cache(args, kind, locate, host)
+
+    found = {}
+    missing = []
+    stale = []
+    for host in hosts:
+        entry = cached.get(host)
+        if entry is None:
+            missing.append(host)
             continue
+        found[host] = [classad.parseOne(ad, classad.Parser.Old) for ad in entry["ads"]]
+        if time.time() - entry["time"] > ttl:
+            stale.append(host)
+
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            for host, ads in zip(missing, executor.map(_locate, missing)):
+                if ads is not None:
+                    found[host] = ads
+
+    if stale:
+        logging.info("Refreshing the %ss of %s in the background", kind, ", ".join(stale))
+        # Not on threads of this process, the worker pools forked
+        # while they run would inherit the locks they hold
+        multiprocessing.Process(
+            target=_refresh_collector_cache,
+            args=(args, kind, locate, stale),
+            name="collector-refresh",
+        ).start()
+
+    return {host: found[host] for host in hosts if host in found}
+
+
+def locate_schedds(host):
+    import htcondor
+
+    coll = htcondor.Collector(host)
+    schedds = coll.locateAll(htcondor.DaemonTypes.Schedd)
+    for schedd in schedds:
+        schedd["MyPool"] = host
+    return [schedd for schedd in schedds if "Name" in schedd]
+
+
+# Startds whose history can be queried (HTCondor >= 8.9.7), one ad per
+# machine, selected by the collector instead of checking each slot here
+STARTD_CONSTRAINT = (
+    '((SlotType == "Static") || (SlotType == "Partitionable")) '
+    '&& (substr(Name, 0, 6) == "slot1@") '
+    r'&& versionGE(regexps("^\\$CondorVersion: ([0-9.]+) .*$", CondorVersion, "\\1"), "8.9.7")'
+)
+
+# Attributes htcondor.Startd needs to contact a startd, and the ones we use
+STARTD_LOCATION_ATTRS = [
+    "MyAddress", "AddressV1", "Machine", "Name", "CondorVersion", "CondorPlatform",
+    "MyType",
+]
+
+
+def locate_startds(host):
+    import htcondor
+
+    coll = htcondor.Collector(host)
+    startds = coll.query(
+        htcondor.AdTypes.Startd,
+        constraint=STARTD_CONSTRAINT,
+        projection=STARTD_LOCATION_ATTRS,
+    )
+    for startd in startds:
+        startd["MyPool"] = host
+    return [startd for startd in startds if "Machine" in startd]
 
+
+def get_schedds(args=None):
+    """
+    Return a list of schedd ads representing all the schedds in the pool.
+    """
+    schedd_ads = {}
+    for host, schedds in locate_daemons(args, "schedd", locate_schedds).items():
         for schedd in schedds:
-            schedd["MyPool"] = host
-            try:
-                schedd_ads[schedd["Name"]] = schedd
-            except KeyError:
-                pass
+            schedd_ads[schedd["Name"]] = schedd
 
     schedd_ads = list(schedd_ads.values())
     random.shuffle(schedd_ads)
@@ -169,40 +507,10 @@ def get_startds(args=None):
     """
     Return a list of startd ads representing all the startds in the pool.
     """
-    collectors = args.collectors
-    if collectors:
-        collectors = collectors.split(',')
-    else:
-        collectors = []
-
     startd_ads = {}
-    for host in collectors:
-        coll = htcondor.Collector(host)
-        try:
-            # get one ad per machine
-            name_ads = coll.query(htcondor.AdTypes.Startd,
-                                      constraint = '(SlotType == "Static") || (SlotType == "Partitionable")',
-                                      projection = ["Name", "CondorVersion"])
-            for ad in name_ads:
-                try:
-                    version = [int(x) for x in ad["CondorVersion"].split()[1].split('.')]
-                    if ad["Name"][0:6] == "slot1@":
-                        if not (
-                            (version[0] == 8 and version[1] == 9 and version[2] >= 7) or
-                            (version[0] == 8 and version[1] > 9) or
-                            (version[0] > 8)
-                        ):
-                            logger.warning(f"The Startd on {ad['Name'].split('@')[-1]} is running HTCondor < 8.9.7 and will be skipped")
-                            continue
-                        startd = coll.locate(htcondor.DaemonTypes.Startd, ad["Name"])
-                        startd["MyPool"] = host
-                        startd_ads[startd["Machine"]] = startd
-                except Exception:
-                    continue
-
-        except IOError as e:
-            logging.warning(str(e))
-            continue
+    for host, startds in locate_daemons(args, "startd", locate_startds).items():
+        for startd in startds:
+            startd_ads[startd["Machine"]] = startd
 
     startd_ads = list(startd_ads.values())
     random.shuffle(startd_ads)
@@ -219,6 +527,9 @@ def send_email_alert(recipients, subject, message):
     """
     if not recipients:
         return
+    import smtplib
+    import email.mime.text
+
     msg = email.mime.text.MIMEText(message)
     msg[
         "Subject"
@@ -240,11 +551,22 @@ def send_email_alert(recipients, subject, message):
         logging.warning("Email notification failed: %s", str(exn))
 
 
-def time_remaining(starttime, timeout=TIMEOUT_MINS * 60, positive=True):
+def set_timeout_mins(minutes):
+    """
+    Set the global timeout of a run, must be called before the pool is started
+    """
+    global TIMEOUT_MINS
+    TIMEOUT_MINS = int(minutes)
+
+
+def time_remaining(starttime, timeout=None, positive=True):
     """
     Return the remaining time (in seconds) until starttime + timeout
+    (by default TIMEOUT_MINS)
     Returns 0 if there is no time remaining
     """
+    if timeout is None:
+        timeout = TIMEOUT_MINS * 60
     elapsed = time.time() - starttime
     if positive:
         return max(0, timeout - elapsed)
@@ -12,4 +12,5 @@ setup(
     packages=["htcondor_es"],
     entry_points={"console_scripts": ["spider = htcondor_es.spider:main"]},
     install_requires=Path("requirements.txt").read_text().splitlines(),
+    extras_require={"parquet": ["pyarrow"]},
 )
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Script for measuring the startup time of the spider, from the start
+of the interpreter to its first collector query
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+# Run in a fresh interpreter: start the spider as the console script
+# would, and stop it as soon as it is about to query a collector
+CHILD = """
+import os, sys, time
+t0 = time.perf_counter()
+from htcondor_es import spider, utils
+
+def _first_query(host):
+    import htcondor
+    print("%.6f" % (time.perf_counter() - t0), flush=True)
+    os._exit(0)
+
+utils.locate_schedds = utils.locate_startds = _first_query
+sys.argv = ["spider"] + sys.argv[1:]
+spider.main()
+"""
+
+
+def package_env():
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    return env
+
+
+def run_once(spider_args, env):
+    """Return (process time, time in the interpreter) in seconds"""
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD] + spider_args,
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    total = time.perf_counter() - start
+    return total, float(output.decode().split()[-1])
+
+
+def print_importtime(spider_args, env, top):
+    """Print the imports that took the longest (cumulative) time"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD] + spider_args,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr
+    imports = []
+    for line in output.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.strip()))
+    print("Slowest imports (cumulative):")
+    for cumulative, name in sorted(imports, reverse=True)[:top]:
+        print("  %8.1f ms  %s" % (cumulative / 1000.0, name))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--runs",
+        default=10,
+        type=int,
+        help="Number of times the spider is started [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--passes",
+        default="--process_schedd_history --process_schedd_queue",
+        help="Spider options enabling the passes to start [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--importtime",
+        default=0,
+        type=int,
+        metavar="N",
+        help="Also print the N slowest imports (python -X importtime)",
+    )
+    args = parser.parse_args()
+
+    env = package_env()
+    with tempfile.TemporaryDirectory() as log_dir:
+        spider_args = args.passes.split() + [
+            "--collectors", "collector.invalid",
+            "--process_collector_cache_ttl_mins", "0",
+            "--dry_run",
+            "--log_dir", log_dir,
+        ]
+        results = [run_once(spider_args, env) for _ in range(args.runs)]
+        totals = [total for total, _ in results]
+        in_python = [inside for _, inside in results]
+        print("Startup to first collector query over %d runs (%s):" % (args.runs, args.passes))
+        for label, values in (("process", totals), ("after interpreter start", in_python)):
+            print(
+                "  %-24s median %7.1f ms  min %7.1f ms  max %7.1f ms"
+                % (
+                    label,
+                    statistics.median(values) * 1000,
+                    min(values) * 1000,
+                    max(values) * 1000,
+                )
+            )
+        if args.importtime:
+            print_importtime(spider_args, env, args.importtime)
+
+
+if __name__ == "__main__":
+    main()
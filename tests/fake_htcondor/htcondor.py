@@ -0,0 +1,301 @@
+"""
+Stand-in for the htcondor module, serving synthetic job ads for the
+load harness (tests/loadHarness.py) instead of talking to a pool.
+
+Put this directory first in PYTHONPATH and describe the pool as JSON
+in the FAKE_HTCONDOR environment variable, e.g.
+
+    {"schedds": 4, "history_jobs": 5000, "queue_jobs": 2000,
+     "startds": 0, "startd_jobs": 200,
+     "query_latency": 0.05, "ad_latency": 0.0, "seed": 1}
+
+Latencies are in seconds: query_latency before the first ad of each
+query, ad_latency between ads. The history of each schedd covers the
+last history_span seconds, newest first; its queue holds queue_jobs
+idle, running and held jobs, plus the jobs of its history.
+Constraints are evaluated with the real classad module.
+"""
+
+import os
+import json
+import time
+import random
+import itertools
+
+import classad
+
+CONFIG = {
+    "schedds": 4,
+    "history_jobs": 5000,
+    "queue_jobs": 2000,
+    "startds": 0,
+    "startd_jobs": 200,
+    "history_span": 6 * 3600,
+    "query_latency": 0.05,
+    "ad_latency": 0.0,
+    "seed": 1,
+}
+CONFIG.update(json.loads(os.environ.get("FAKE_HTCONDOR", "{}")))
+
+# History and queues are relative to the start of the process, so that
+# every run of the harness sees the same pool
+NOW = int(os.environ.get("FAKE_HTCONDOR_NOW", time.time()))
+
+VERSION = "$CondorVersion: 9.0.17 Oct 04 2022 BuildID: 599404 PackageID: 9.0.17-1 $"
+PLATFORM = "$CondorPlatform: x86_64_CentOS7 $"
+
+
+class DaemonTypes(object):
+    Schedd = "Schedd"
+    Startd = "Startd"
+    Collector = "Collector"
+
+
+class AdTypes(object):
+    Schedd = "Schedd"
+    Startd = "Startd"
+    Collector = "Collector"
+
+
+def schedd_name(i):
+    return "schedd%03d.fake.pool" % i
+
+
+def startd_machine(i):
+    return "node%05d.fake.pool" % i
+
+
+def _paced(ads):
+    """Yield ads with the configured latencies"""
+    if CONFIG["query_latency"]:
+        time.sleep(CONFIG["query_latency"])
+    debt = 0.0
+    for ad in ads:
+        debt += CONFIG["ad_latency"]
+        # Sleeping for each ad would cost more than the latency itself
+        if debt >= 0.001:
+            time.sleep(debt)
+            debt = 0.0
+        yield ad
+
+
+def _constraint(expr):
+    if expr is None or expr == "" or expr is True:
+        return None
+    return expr if isinstance(expr, classad.ExprTree) else classad.ExprTree(str(expr))
+
+
+def _matches(constraint, ad):
+    return constraint is None or constraint.eval(ad) is True
+
+
+def _project(ad, projection):
+    if not projection:
+        return ad
+    return classad.ClassAd({key: ad.eval(key) for key in projection if key in ad})
+
+
+def job_ad(schedd, cluster, proc, status, entered, rng):
+    """Return the ad of a job, with the usual attributes of a grid job"""
+    owner = "user%02d" % rng.randrange(40)
+    qdate = entered - rng.randrange(600, 48 * 3600)
+    start = qdate + rng.randrange(60, 3600)
+    cpus = rng.choice([1, 1, 1, 4, 8])
+    wall = max(0, entered - start) if status in (3, 4) else max(0, NOW - start) if status == 2 else 0
+    site = "T2_FAKE_%s" % rng.choice(["A", "B", "C", "D"])
+    ad = {
+        "MyType": "Job",
+        "TargetType": "Machine",
+        "GlobalJobId": "%s#%d.%d#%d" % (schedd, cluster, proc, qdate),
+        "ClusterId": cluster,
+        "ProcId": proc,
+        "Owner": owner,
+        "User": "%s@fake.pool" % owner,
+        "AccountingGroup": "group_%s.%s" % (rng.choice(["prod", "analysis"]), owner),
+        "JobStatus": status,
+        "LastJobStatus": 2 if status in (3, 4) else 1,
+        "JobUniverse": 5,
+        "EnteredCurrentStatus": entered,
+        "QDate": qdate,
+        "JobPrio": 0,
+        "RequestCpus": cpus,
+        "RequestMemory": 2000 * cpus,
+        "RequestDisk": 1000000 * cpus,
+        "RequestGpus": 0,
+        "MaxHosts": 1,
+        "MinHosts": 1,
+        "CurrentHosts": 1 if status == 2 else 0,
+        "NumJobStarts": 1 if status in (2, 3, 4) else 0,
+        "NumShadowStarts": 1 if status in (2, 3, 4) else 0,
+        "JobRunCount": 1 if status in (2, 3, 4) else 0,
+        "ImageSize": rng.randrange(100000, 4000000),
+        "ResidentSetSize": rng.randrange(100000, 4000000),
+        "DiskUsage": rng.randrange(1000, 4000000),
+        "MemoryUsage": classad.ExprTree("((ResidentSetSize + 1023) / 1024)"),
+        "RemoteWallClockTime": float(wall),
+        "CumulativeSlotTime": float(wall),
+        "RemoteUserCpu": float(wall * cpus * 0.8),
+        "RemoteSysCpu": float(wall * cpus * 0.05),
+        "BytesSent": float(rng.randrange(10 ** 8)),
+        "BytesRecvd": float(rng.randrange(10 ** 8)),
+        "Cmd": "/home/%s/jobs/run_%d.sh" % (owner, cluster),
+        "Arguments": "--cluster %d --proc %d --events 1000" % (cluster, proc),
+        "Iwd": "/home/%s/jobs" % owner,
+        "Out": "_condor_stdout",
+        "Err": "_condor_stderr",
+        "UserLog": "/home/%s/jobs/job.log" % owner,
+        "ShouldTransferFiles": "YES",
+        "WhenToTransferOutput": "ON_EXIT",
+        "TransferInput": "input_%d.tar.gz,config.json" % cluster,
+        "Requirements": classad.ExprTree(
+            '(TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX") && '
+            "(TARGET.Disk >= RequestDisk) && (TARGET.Memory >= RequestMemory)"
+        ),
+        "PeriodicRemove": classad.ExprTree("(JobStatus == 5) && (time() - EnteredCurrentStatus > 86400)"),
+        "OnExitRemove": True,
+        "WantRemoteIO": True,
+        "use_x509userproxy": True,
+        "x509UserProxyVOName": "fake",
+        "x509userproxysubject": "/DC=org/DC=fake/OU=People/CN=%s" % owner,
+        "DESIRED_Sites": "T2_FAKE_A,T2_FAKE_B,T2_FAKE_C,T2_FAKE_D",
+        "CondorVersion": VERSION,
+        "CondorPlatform": PLATFORM,
+        "AutoClusterId": rng.randrange(500),
+    }
+    if status in (2, 3, 4):
+        ad.update({
+            "JobStartDate": start,
+            "JobCurrentStartDate": start,
+            "JobCurrentStartExecutingDate": start + 5,
+            "LastMatchTime": start,
+            "RemoteHost": "slot1_%d@%s" % (rng.randrange(1, 32), startd_machine(rng.randrange(1000))),
+            "MATCH_EXP_JOB_GLIDEIN_Site": site,
+            "MATCH_EXP_JOB_GLIDEIN_Entry_Name": "CMSHTPC_%s_ce01" % site,
+            "MachineAttrCpus0": cpus,
+        })
+    if status in (3, 4):
+        ad.update({
+            "CompletionDate": entered if status == 4 else 0,
+            "ExitCode": rng.choice([0, 0, 0, 0, 1, 8001]) if status == 4 else None,
+            "ExitBySignal": False,
+            "LastRemoteHost": ad.pop("RemoteHost"),
+        })
+    if status == 5:
+        ad["HoldReason"] = "Job exceeded its memory request"
+        ad["HoldReasonCode"] = 34
+    return classad.ClassAd({key: value for key, value in ad.items() if value is not None})
+
+
+def history_ads(name, rng_seed, n_jobs, span):
+    """Completed and removed jobs, newest first"""
+    rng = random.Random(rng_seed)
+    for i in range(n_jobs):
+        entered = NOW - int(span * i / max(n_jobs, 1)) - 1
+        status = 3 if rng.random() < 0.05 else 4
+        yield job_ad(name, 1000000 - i, 0, status, entered, rng)
+
+
+def queue_ads(name, rng_seed, n_jobs):
+    rng = random.Random(rng_seed)
+    for i in range(n_jobs):
+        status = rng.choice([1, 1, 2, 2, 2, 5])
+        entered = NOW - rng.randrange(1, 24 * 3600)
+        yield job_ad(name, 2000000 + i // 10, i % 10, status, entered, rng)
+
+
+class Collector(object):
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def locateAll(self, daemon_type):
+        if daemon_type != DaemonTypes.Schedd:
+            return []
+        return [
+            classad.ClassAd({
+                "MyType": "Scheduler",
+                "Name": schedd_name(i),
+                "Machine": schedd_name(i),
+                "MyAddress": "<10.0.0.%d:9618?sock=schedd>" % (i % 250 + 1),
+                "CondorVersion": VERSION,
+                "CondorPlatform": PLATFORM,
+            })
+            for i in range(CONFIG["schedds"])
+        ]
+
+    def query(self, ad_type=AdTypes.Startd, constraint=None, projection=None):
+        if ad_type != AdTypes.Startd:
+            return []
+        constraint = _constraint(constraint)
+        ads = []
+        for i in range(CONFIG["startds"]):
+            ad = classad.ClassAd({
+                "MyType": "Machine",
+                "Name": "slot1@%s" % startd_machine(i),
+                "Machine": startd_machine(i),
+                "SlotType": "Partitionable",
+                "MyAddress": "<10.1.%d.%d:9618?sock=startd>" % (i // 250, i % 250 + 1),
+                "CondorVersion": VERSION,
+                "CondorPlatform": PLATFORM,
+            })
+            if _matches(constraint, ad):
+                ads.append(_project(ad, projection))
+        return ads
+
+
+class Schedd(object):
+    def __init__(self, location_ad=None):
+        self.name = location_ad["Name"] if location_ad is not None else schedd_name(0)
+        self.seed = "%s-%s" % (CONFIG["seed"], self.name)
+
+    def history(self, constraint, projection, match=-1, since=None):
+        constraint = _constraint(constraint)
+        since = _constraint(since)
+        n = 0
+        ads = history_ads(self.name, self.seed, CONFIG["history_jobs"], CONFIG["history_span"])
+        for ad in _paced(ads):
+            if since is not None and since.eval(ad) is True:
+                return
+            if not _matches(constraint, ad):
+                continue
+            yield _project(ad, projection)
+            n += 1
+            if 0 <= match <= n:
+                return
+
+    def xquery(self, requirements=None, projection=[], limit=-1):
+        constraint = _constraint(requirements)
+        n = 0
+        queue = queue_ads(self.name, self.seed + "-queue", CONFIG["queue_jobs"])
+        # Completed jobs stay in the queue for a while
+        recent = history_ads(self.name, self.seed, CONFIG["history_jobs"], CONFIG["history_span"])
+        for ad in _paced(itertools.chain(queue, recent)):
+            if not _matches(constraint, ad):
+                continue
+            yield _project(ad, projection)
+            n += 1
+            if 0 <= limit <= n:
+                return
+
+    def query(self, constraint="true", projection=[], limit=-1):
+        return list(self.xquery(constraint, projection, limit))
+
+
+class Startd(object):
+    def __init__(self, location_ad=None):
+        self.machine = location_ad["Machine"] if location_ad is not None else startd_machine(0)
+        self.seed = "%s-%s" % (CONFIG["seed"], self.machine)
+
+    def history(self, constraint, projection, match=-1, since=None):
+        constraint = _constraint(constraint)
+        since = _constraint(since)
+        n = 0
+        ads = history_ads(self.machine, self.seed, CONFIG["startd_jobs"], CONFIG["history_span"])
+        for ad in _paced(ads):
+            if since is not None and since.eval(ad) is True:
+                return
+            if not _matches(constraint, ad):
+                continue
+            yield _project(ad, projection)
+            n += 1
+            if 0 <= match <= n:
+                return
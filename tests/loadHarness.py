@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+Script for load testing the spider end to end without a pool or ES:
+the real spider.main_driver runs against the stand-in htcondor module
+of tests/fake_htcondor and a local server implementing the _bulk API.
+
+Reports docs/sec, makespan and peak RSS, with the latencies of the
+stages from the run report of the spider, and exits with status 1
+when one of the given thresholds is not met.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import resource
+import threading
+import subprocess
+import socketserver
+import http.server
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+
+CHILD = """
+import sys
+from htcondor_es import spider
+sys.argv = ["spider"] + sys.argv[1:]
+sys.exit(spider.main())
+"""
+
+
+class BulkServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Local Elasticsearch answering index creations and _bulk requests,
+    with the configured latency and failures
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency, doc_latency, reject_rate, item_reject_rate, item_error_rate, seed=1):
+        super().__init__(address, BulkHandler)
+        self.latency = latency
+        self.doc_latency = doc_latency
+        self.reject_rate = reject_rate
+        self.item_reject_rate = item_reject_rate
+        self.item_error_rate = item_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.indices = set()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                "requests": 0,
+                "requests_rejected": 0,
+                "bytes": 0,
+                "docs_indexed": 0,
+                "docs_rejected": 0,
+                "docs_failed": 0,
+                "duplicates": 0,
+            }
+            self.ids = set()
+
+    def draw(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        # Checked by the elasticsearch client since 7.14
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        self.reply(200, {})
+
+    def do_GET(self):
+        self.reply(200, {
+            "name": "fake",
+            "cluster_name": "fake",
+            "version": {"number": "7.17.0", "build_flavor": "default"},
+            "tagline": "You Know, for Search",
+        })
+
+    def do_PUT(self):
+        self.read_body()
+        path = self.path.split("?")[0].strip("/").split("/")
+        server = self.server
+        if len(path) == 1:
+            with server.lock:
+                exists = path[0] in server.indices
+                server.indices.add(path[0])
+            if exists:
+                self.reply(400, {
+                    "error": {
+                        "type": "resource_already_exists_exception",
+                        "reason": "index [%s] already exists" % path[0],
+                    },
+                    "status": 400,
+                })
+                return
+            self.reply(200, {"acknowledged": True, "index": path[0]})
+            return
+        self.reply(200, {"acknowledged": True})
+
+    def do_POST(self):
+        body = self.read_body()
+        path = self.path.split("?")[0].strip("/").split("/")
+        if path[-1] != "_bulk":
+            self.reply(200, {"acknowledged": True})
+            return
+        server = self.server
+        start = time.time()
+        lines = body.decode().splitlines()
+        n_docs = len(lines) // 2
+        time.sleep(server.latency + server.doc_latency * n_docs)
+
+        if server.draw(server.reject_rate):
+            with server.lock:
+                server.stats["requests"] += 1
+                server.stats["requests_rejected"] += 1
+                server.stats["bytes"] += len(body)
+            self.reply(429, {
+                "error": {"type": "es_rejected_execution_exception", "reason": "rejected execution"},
+                "status": 429,
+            })
+            return
+
+        default_index = path[0] if len(path) > 1 else None
+        items = []
+        counts = {"docs_indexed": 0, "docs_rejected": 0, "docs_failed": 0, "duplicates": 0}
+        ids = []
+        for action_line in lines[0::2]:
+            action = json.loads(action_line)["index"]
+            item = {"_index": action.get("_index", default_index), "_id": action.get("_id")}
+            if server.draw(server.item_reject_rate):
+                item["status"] = 429
+                item["error"] = {"type": "es_rejected_execution_exception", "reason": "rejected execution"}
+                counts["docs_rejected"] += 1
+            elif server.draw(server.item_error_rate):
+                item["status"] = 400
+                item["error"] = {"type": "mapper_parsing_exception", "reason": "failed to parse"}
+                counts["docs_failed"] += 1
+            else:
+                item["status"] = 201
+                counts["docs_indexed"] += 1
+                ids.append((item["_index"], item["_id"]))
+            items.append({"index": item})
+
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats["bytes"] += len(body)
+            for key, value in counts.items():
+                server.stats[key] += value
+            for id_ in ids:
+                if id_ in server.ids:
+                    server.stats["duplicates"] += 1
+                server.ids.add(id_)
+        self.reply(200, {
+            "took": int((time.time() - start) * 1000),
+            "errors": len(ids) < len(items),
+            "items": items,
+        })
+
+
+def run_spider(spider_args, pool, work_dir, now):
+    """Run the spider in its own process, return (exit code, makespan)"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [os.path.join(TESTS_DIR, "fake_htcondor"), ROOT_DIR, env.get("PYTHONPATH")])
+    )
+    env["FAKE_HTCONDOR"] = json.dumps(pool)
+    env["FAKE_HTCONDOR_NOW"] = str(now)
+    start = time.time()
+    returncode = subprocess.call([sys.executable, "-c", CHILD] + spider_args, cwd=work_dir, env=env)
+    return returncode, time.time() - start
+
+
+def print_stages(report):
+    print("  %-12s %8s %10s %10s %10s %10s" % ("stage", "count", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    for stage, summary in sorted(report["total"]["stages"].items()):
+        print(
+            "  %-12s %8d %10.2f %10.2f %10.2f %10.2f"
+            % (
+                stage,
+                summary["count"],
+                summary["mean"] * 1000,
+                summary["p50"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    pool = parser.add_argument_group("fake pool")
+    pool.add_argument("--schedds", default=4, type=int, help="Number of Schedds [default: %(default)d]")
+    pool.add_argument(
+        "--history_jobs", default=5000, type=int,
+        help="Jobs in the history of each Schedd [default: %(default)d]",
+    )
+    pool.add_argument(
+        "--queue_jobs", default=2000, type=int,
+        help="Idle, running and held jobs in the queue of each Schedd [default: %(default)d]",
+    )
+    pool.add_argument("--startds", default=0, type=int, help="Number of Startds [default: %(default)d]")
+    pool.add_argument(
+        "--startd_jobs", default=200, type=int,
+        help="Jobs in the history of each Startd [default: %(default)d]",
+    )
+    pool.add_argument(
+        "--query_latency_ms", default=50.0, type=float,
+        help="Latency before the first ad of each query [default: %(default)s]",
+    )
+    pool.add_argument(
+        "--ad_latency_ms", default=0.0, type=float,
+        help="Latency between the ads of a query [default: %(default)s]",
+    )
+    es = parser.add_argument_group("fake ES")
+    es.add_argument(
+        "--es_latency_ms", default=20.0, type=float,
+        help="Latency of each bulk request [default: %(default)s]",
+    )
+    es.add_argument(
+        "--es_doc_latency_ms", default=0.01, type=float,
+        help="Additional latency per document of a bulk request [default: %(default)s]",
+    )
+    es.add_argument(
+        "--es_reject_rate", default=0.0, type=float,
+        help="Fraction of the bulk requests rejected with a 429 [default: %(default)s]",
+    )
+    es.add_argument(
+        "--es_item_reject_rate", default=0.0, type=float,
+        help="Fraction of the documents rejected with a 429 item [default: %(default)s]",
+    )
+    es.add_argument(
+        "--es_item_error_rate", default=0.0, type=float,
+        help="Fraction of the documents failing with a mapping error [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--spider_args",
+        default="--process_schedd_history --process_schedd_queue",
+        help="Spider options enabling the passes and anything else [default: %(default)s]",
+    )
+    parser.add_argument("--runs", default=1, type=int, help="Number of runs [default: %(default)d]")
+    parser.add_argument(
+        "--keep_dir",
+        action="store_true",
+        help="Keep the working directories of the runs (logs, checkpoints, reports)",
+    )
+    thresholds = parser.add_argument_group("regression thresholds")
+    thresholds.add_argument("--min_docs_per_sec", type=float, help="Fail below this many docs/sec")
+    thresholds.add_argument("--max_makespan", type=float, help="Fail above this many seconds")
+    thresholds.add_argument("--max_rss_mb", type=float, help="Fail above this peak RSS")
+    args = parser.parse_args()
+
+    pool = {
+        "schedds": args.schedds,
+        "history_jobs": args.history_jobs,
+        "queue_jobs": args.queue_jobs,
+        "startds": args.startds,
+        "startd_jobs": args.startd_jobs,
+        "query_latency": args.query_latency_ms / 1000.0,
+        "ad_latency": args.ad_latency_ms / 1000.0,
+    }
+    server = BulkServer(
+        ("127.0.0.1", 0),
+        latency=args.es_latency_ms / 1000.0,
+        doc_latency=args.es_doc_latency_ms / 1000.0,
+        reject_rate=args.es_reject_rate,
+        item_reject_rate=args.es_item_reject_rate,
+        item_error_rate=args.es_item_error_rate,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    now = int(time.time())
+
+    failures = []
+    for run in range(args.runs):
+        server.reset()
+        work_dir = tempfile.mkdtemp(prefix="spider-load-")
+        spider_args = args.spider_args.split() + [
+            "--collectors", "collector.fake.pool",
+            "--process_collector_cache_ttl_mins", "0",
+            "--es_host", "127.0.0.1",
+            "--es_port", str(server.server_address[1]),
+            "--es_feed_schedd_history",
+            "--es_feed_schedd_queue",
+            "--es_feed_startd_history",
+            "--log_dir", os.path.join(work_dir, "log"),
+        ]
+        if args.startds:
+            spider_args.append("--process_startd_history")
+        returncode, makespan = run_spider(spider_args, pool, work_dir, now)
+        stats = dict(server.stats)
+        # Largest RSS of any process run so far (spider or pool worker), in kB on Linux
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+        docs_per_sec = stats["docs_indexed"] / makespan
+
+        print("Run %d/%d: spider exited with %d" % (run + 1, args.runs, returncode))
+        print("  makespan        %10.2f s" % makespan)
+        print("  docs indexed    %10d (%.0f docs/sec)" % (stats["docs_indexed"], docs_per_sec))
+        print("  bytes           %10d (%.1f MB/sec)" % (stats["bytes"], stats["bytes"] / makespan / 1e6))
+        print(
+            "  bulk requests   %10d (%d rejected)" % (stats["requests"], stats["requests_rejected"])
+        )
+        print(
+            "  docs rejected   %10d, failed %d, indexed again %d"
+            % (stats["docs_rejected"], stats["docs_failed"], stats["duplicates"])
+        )
+        print("  peak RSS        %10.1f MB" % peak_rss_mb)
+        try:
+            with open(os.path.join(work_dir, "run_report.json"), "r") as fd:
+                print_stages(json.load(fd))
+        except (IOError, ValueError):
+            print("  no run report")
+
+        if returncode:
+            failures.append("run %d: spider exited with %d" % (run + 1, returncode))
+        if args.min_docs_per_sec is not None and docs_per_sec < args.min_docs_per_sec:
+            failures.append("run %d: %.0f docs/sec < %.0f" % (run + 1, docs_per_sec, args.min_docs_per_sec))
+        if args.max_makespan is not None and makespan > args.max_makespan:
+            failures.append("run %d: makespan %.2f s > %.2f s" % (run + 1, makespan, args.max_makespan))
+        if args.max_rss_mb is not None and peak_rss_mb > args.max_rss_mb:
+            failures.append("run %d: peak RSS %.1f MB > %.1f MB" % (run + 1, peak_rss_mb, args.max_rss_mb))
+
+        if args.keep_dir:
+            print("  kept %s" % work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    server.shutdown()
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Tests of the job_queue.log reader (htcondor_es.joblog) against the
+sample log in tests/data/job_queue.log:
+
+    python tests/testJobQueueLog.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from htcondor_es.joblog import JobQueueLog
+
+SAMPLE_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "job_queue.log")
+
+
+class JobQueueLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "job_queue.log")
+        shutil.copy(SAMPLE_LOG, self.path)
+        self.log = JobQueueLog(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, text):
+        with open(self.path, "a") as fd:
+            fd.write(text)
+
+    def test_records(self):
+        self.assertEqual(self.log.poll(), {"1.0", "2.0"})
+        # 102 destroyed 1.1, the header ad 0.0 is not a job
+        self.assertEqual(sorted(self.log.jobs()), ["1.0", "2.0"])
+
+        job = self.log.job_ad("1.0")
+        self.assertEqual(job["JobStatus"], 2)
+        self.assertEqual(job["RemoteHost"], "slot1@node01")
+        # Inherited from the cluster ad, expressions are kept
+        self.assertEqual(job["Owner"], "alice")
+        self.assertEqual(job.eval("RequestMemory"), 2000)
+
+        job = self.log.job_ad("2.0")
+        self.assertEqual(job["Owner"], "bob")
+        # Removed by 104
+        self.assertNotIn("HoldReason", job)
+
+    def test_case_insensitive_attributes(self):
+        self.append("105 \n101 1.2 Job Machine\n103 1.2 requestcpus 8\n106 \n")
+        self.log.poll()
+        job = self.log.job_ad("1.2")
+        # The attribute of the job replaces the one of its cluster
+        self.assertEqual(job.eval("RequestMemory"), 16000)
+        self.assertEqual(len([key for key in job.keys() if key.lower() == "requestcpus"]), 1)
+
+        job = self.log.job_ad("1.0", projection=["owner", "JOBSTATUS", "Missing"])
+        self.assertEqual(job["Owner"], "alice")
+        self.assertEqual(job["JobStatus"], 2)
+        self.assertEqual(len(job), 2)
+
+        self.append("104 01.-1 OWNER\n")
+        self.log.poll()
+        self.assertNotIn("Owner", self.log.job_ad("1.0"))
+
+    def test_changes(self):
+        self.log.poll()
+        self.assertEqual(self.log.poll(), set())
+
+        self.append("103 2.0 JobStatus 2\n")
+        self.assertEqual(self.log.poll(), {"2.0"})
+
+        # A change of the cluster ad changes all its jobs
+        self.append("103 01.-1 JobPrio 10\n")
+        self.assertEqual(self.log.poll(), {"1.0"})
+        self.assertEqual(self.log.job_ad("1.0")["JobPrio"], 10)
+
+    def test_transactions(self):
+        self.log.poll()
+        # Not applied until the transaction ends
+        self.append("105 \n103 2.0 JobStatus 5\n")
+        self.assertEqual(self.log.poll(), set())
+        self.assertEqual(self.log.job_ad("2.0")["JobStatus"], 1)
+
+        self.append("103 2.0 HoldReasonCode 34\n106 \n")
+        self.assertEqual(self.log.poll(), {"2.0"})
+        job = self.log.job_ad("2.0")
+        self.assertEqual(job["JobStatus"], 5)
+        self.assertEqual(job["HoldReasonCode"], 34)
+
+    def test_partial_line(self):
+        self.log.poll()
+        # The schedd is half way writing a record
+        self.append("103 2.0 JobSta")
+        self.assertEqual(self.log.poll(), set())
+        self.assertEqual(self.log.job_ad("2.0")["JobStatus"], 1)
+
+        self.append("tus 2\n")
+        self.assertEqual(self.log.poll(), {"2.0"})
+        self.assertEqual(self.log.job_ad("2.0")["JobStatus"], 2)
+
+    def test_rotation(self):
+        self.log.poll()
+        # Replaced by a new log (new inode), as when the schedd compacts it
+        rotated = self.path + ".new"
+        with open(rotated, "w") as fd:
+            fd.write("105 \n101 03.-1 Job Machine\n101 3.0 Job Machine\n103 3.0 JobStatus 1\n106 \n")
+        os.rename(rotated, self.path)
+        self.assertEqual(self.log.poll(), {"3.0"})
+        self.assertEqual(self.log.jobs(), ["3.0"])
+
+    def test_truncation(self):
+        self.log.poll()
+        # Truncated in place, same inode but shorter than what was read
+        with open(self.path, "w") as fd:
+            fd.write("101 4.0 Job Machine\n103 4.0 JobStatus 1\n")
+        self.assertEqual(self.log.poll(), {"4.0"})
+        self.assertEqual(self.log.jobs(), ["4.0"])
+
+        self.append("103 4.0 JobStatus 2\n")
+        self.assertEqual(self.log.poll(), {"4.0"})
+        self.assertEqual(self.log.job_ad("4.0")["JobStatus"], 2)
+
+    def test_missing_log(self):
+        log = JobQueueLog(os.path.join(self.dir, "missing.log"))
+        self.assertEqual(log.poll(), set())
+        self.assertEqual(log.jobs(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()